@@ -0,0 +1,95 @@
+"""
+::
+
+  Benchmark Poisson blending against the previous pyamg implementation
+
+  Usage:
+    bench_blender.py [--width=<width>] [--height=<height>] [--no-legacy]
+
+  Options:
+    -h, --help         Show this screen.
+    --width=<width>    Width of the blended images [default: 500]
+    --height=<height>  Height of the blended images [default: 600]
+    --no-legacy        Skip the (slow) previous implementation
+"""
+from docopt import docopt
+import time
+import cv2
+import numpy as np
+import scipy.sparse
+
+from facemorpher import blender
+
+def legacy_poisson_blend(img_source, dest_img, img_mask):
+  """ Previous implementation: per-pixel lil matrix assembly and one
+  pyamg solve per channel. Kept only as the benchmark baseline.
+  """
+  import pyamg
+  img_target = np.copy(dest_img)
+  region_size = img_mask.shape[:2]
+  num_pixels = np.prod(region_size)
+
+  coff_mat = scipy.sparse.identity(num_pixels, format='lil')
+  for y in range(region_size[0]):
+    for x in range(region_size[1]):
+      if img_mask[y, x]:
+        index = x + y * region_size[1]
+        coff_mat[index, index] = 4
+        if index + 1 < num_pixels:
+          coff_mat[index, index + 1] = -1
+        if index - 1 >= 0:
+          coff_mat[index, index - 1] = -1
+        if index + region_size[1] < num_pixels:
+          coff_mat[index, index + region_size[1]] = -1
+        if index - region_size[1] >= 0:
+          coff_mat[index, index - region_size[1]] = -1
+  coff_mat = coff_mat.tocsr()
+
+  poisson_mat = pyamg.gallery.poisson(img_mask.shape)
+  for num_layer in range(img_target.shape[2]):
+    t = img_target[..., num_layer].flatten()
+    s = img_source[..., num_layer].flatten()
+    b = np.asarray(poisson_mat @ s, np.float64)
+    for y in range(region_size[0]):
+      for x in range(region_size[1]):
+        if not img_mask[y, x]:
+          index = x + y * region_size[1]
+          b[index] = t[index]
+    x = pyamg.solve(coff_mat, b, verb=False, tol=1e-10)
+    img_target[..., num_layer] = np.clip(np.reshape(x, region_size), 0, 255)
+
+  return img_target
+
+def synthetic_images(size):
+  rng = np.random.default_rng(0)
+  src_img, dest_img = [cv2.GaussianBlur(rng.integers(0, 256, size + (3,), dtype=np.uint8),
+                                        (0, 0), 3) for _ in range(2)]
+  height, width = size
+  mask = np.zeros(size, np.uint8)
+  cv2.ellipse(mask, (width // 2, height // 2), (width // 3, height // 3), 0, 0, 360, 255, -1)
+  return src_img, dest_img, mask
+
+def timed(func, *args):
+  start = time.perf_counter()
+  result = func(*args)
+  return time.perf_counter() - start, result
+
+def main():
+  args = docopt(__doc__)
+  size = (int(args['--height']), int(args['--width']))
+  src_img, dest_img, mask = synthetic_images(size)
+
+  seconds, result = timed(blender.poisson_blend, src_img, dest_img, mask)
+  print('poisson_blend {}x{}: {:.3f} s'.format(size[1], size[0], seconds))
+  cached_seconds, _ = timed(blender.poisson_blend, src_img, dest_img, mask)
+  print('poisson_blend, cached factorization: {:.3f} s'.format(cached_seconds))
+
+  if not args['--no-legacy']:
+    legacy_seconds, expected = timed(legacy_poisson_blend, src_img, dest_img, mask)
+    max_diff = np.abs(result.astype(np.int32) - expected).max()
+    print('legacy poisson_blend: {:.3f} s ({:.1f}x slower), max diff {}'.format(
+      legacy_seconds, legacy_seconds / seconds, max_diff))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,54 @@
+"""
+::
+
+  Benchmark the startup cost of importing facemorpher
+
+  Usage:
+    bench_import.py [--repeat=<n>] [--module=<name>]
+
+  Options:
+    -h, --help       Show this screen.
+    --repeat=<n>     Number of fresh interpreters to time [default: 10]
+    --module=<name>  Module to import [default: facemorpher]
+"""
+from docopt import docopt
+import subprocess
+import sys
+import numpy as np
+
+# Heavy modules that should only load when faces are located or plotted
+LAZY_MODULES = ('dlib', 'matplotlib')
+
+IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(','.join(name for name in {lazy!r} if name in sys.modules))
+'''
+
+def time_import(module):
+  """ Import module in a fresh interpreter
+
+  :returns: (seconds, list of lazy modules that were loaded anyway)
+  """
+  script = IMPORT_SCRIPT.format(module=module, lazy=LAZY_MODULES)
+  output = subprocess.check_output([sys.executable, '-c', script]).decode()
+  seconds, loaded = output.splitlines()
+  return float(seconds), [name for name in loaded.split(',') if name]
+
+def main():
+  args = docopt(__doc__)
+  results = [time_import(args['--module']) for _ in range(int(args['--repeat']))]
+  seconds = np.array([r[0] for r in results]) * 1000
+  print('import {}: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms'.format(
+    args['--module'], np.median(seconds), seconds.min(), seconds.max()))
+
+  loaded = results[-1][1]
+  if loaded:
+    print('Eagerly imported: ' + ', '.join(loaded))
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
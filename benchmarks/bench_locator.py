@@ -0,0 +1,56 @@
+"""
+::
+
+  Benchmark face detection on downscaled proxies against full resolution.
+  Needs dlib, the shape predictor in DLIB_DATA_DIR and real face photos.
+
+  Usage:
+    bench_locator.py --images=<folder> [--max_sides=<sides>]
+
+  Options:
+    -h, --help             Show this screen.
+    --images=<folder>      Folder to face images (.jpg, .jpeg, .png)
+    --max_sides=<sides>    Comma separated proxy max sides [default: 2048,1280,800,512]
+"""
+from docopt import docopt
+import time
+import cv2
+import numpy as np
+
+from facemorpher import locator
+from facemorpher.morpher import list_imgpaths
+
+def timed_points(img, max_side):
+  start = time.perf_counter()
+  points = locator.face_points(img, add_boundary_points=False, detect_max_side=max_side)
+  return time.perf_counter() - start, points
+
+def main():
+  args = docopt(__doc__)
+  max_sides = [int(side) for side in args['--max_sides'].split(',')]
+  imgs = [cv2.imread(path) for path in list_imgpaths(args['--images'])]
+
+  # Warm up the lazily loaded models before timing
+  locator.get_detector()
+  locator.get_predictor()
+
+  references = [timed_points(img, 0) for img in imgs]
+  print('{:>10} {:>12} {:>8} {:>16} {:>16}'.format(
+    'max side', 'latency', 'found', 'mean error px', 'max error px'))
+  print('{:>10} {:9.1f} ms {:>8}'.format(
+    'full', 1000 * np.mean([seconds for seconds, _ in references]),
+    sum(len(points) > 0 for _, points in references)))
+
+  for max_side in max_sides:
+    results = [timed_points(img, max_side) for img in imgs]
+    errors = [np.linalg.norm(points - ref_points, axis=1)
+              for (_, points), (_, ref_points) in zip(results, references)
+              if len(points) > 0 and len(ref_points) > 0]
+    errors = np.concatenate(errors) if errors else np.array([np.nan])
+    print('{:>10} {:9.1f} ms {:>8} {:16.2f} {:16.2f}'.format(
+      max_side, 1000 * np.mean([seconds for seconds, _ in results]),
+      sum(len(points) > 0 for _, points in results), errors.mean(), errors.max()))
+
+
+if __name__ == "__main__":
+  main()
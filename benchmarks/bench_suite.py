@@ -0,0 +1,329 @@
+"""
+::
+
+  Benchmark the face morpher pipeline offline on synthetic faces and
+  compare the results against a stored baseline. The dlib models are
+  replaced by a detector and predictor that look up the drawn faces.
+
+  Usage:
+    bench_suite.py [--sizes=<sizes>] [--counts=<counts>] [--repeat=<n>]
+                   [--only=<names>] [--save=<filename>] [--compare=<filename>]
+                   [--tolerance=<ratio>] [--profile=<filename>]
+
+  Options:
+    -h, --help            Show this screen.
+    --sizes=<sizes>       Comma separated WIDTHxHEIGHT output sizes [default: 250x300,500x600,1000x1200]
+    --counts=<counts>     Comma separated numbers of images to average [default: 4,16]
+    --repeat=<n>          Timed runs of every case. The fastest run is kept [default: 3]
+    --only=<names>        Comma separated benchmark names to run. Defaults to all
+    --save=<filename>     Save the results as a JSON baseline
+    --compare=<filename>  Compare against a JSON baseline and exit 1 on a regression
+    --tolerance=<ratio>   Slowdown over the baseline that counts as a regression [default: 1.25]
+    --profile=<filename>  Profile all runs with cProfile, save the stats and print the top functions
+"""
+from docopt import docopt
+from collections import namedtuple
+import contextlib
+import cProfile
+import hashlib
+import importlib
+import io
+import json
+import os
+import platform
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+from facemorpher import locator
+from facemorpher import aligner
+from facemorpher import warper
+from facemorpher import blender
+from facemorpher import videoer
+
+# The package exports functions of the same names as these modules
+morpher = importlib.import_module('facemorpher.morpher')
+averager = importlib.import_module('facemorpher.averager')
+
+BENCHMARKS = ('face_points', 'resize_align', 'bilinear_interpolate', 'warp_image',
+              'mask_from_points', 'poisson_blend', 'video', 'morph', 'averager')
+
+Point = namedtuple('Point', 'x y')
+Result = namedtuple('Result', 'name case seconds rate unit peak_mb')
+
+def template_points():
+  """ 68 dlib style face points in a unit face box """
+  def ellipse(cx, cy, rx, ry, angles):
+    return np.column_stack((cx + rx * np.cos(angles), cy - ry * np.sin(angles)))
+
+  eye_angles = np.linspace(np.pi, -np.pi, 6, endpoint=False)
+  brow_y = 0.22 - 0.05 * np.sin(np.linspace(0, np.pi, 5))
+  return np.vstack([
+    ellipse(0.5, 0.35, 0.5, -0.65, np.linspace(np.pi, 0, 17)),  # jaw
+    np.column_stack((np.linspace(0.12, 0.42, 5), brow_y)),
+    np.column_stack((np.linspace(0.58, 0.88, 5), brow_y)),
+    np.column_stack((np.full(4, 0.5), np.linspace(0.35, 0.58, 4))),  # nose bridge
+    np.column_stack((np.linspace(0.4, 0.6, 5), 0.65 + 0.02 * np.abs(np.linspace(-1, 1, 5)))),
+    ellipse(0.3, 0.38, 0.08, 0.03, eye_angles),
+    ellipse(0.7, 0.38, 0.08, 0.03, eye_angles),
+    ellipse(0.5, 0.8, 0.17, 0.07, np.linspace(np.pi, -np.pi, 12, endpoint=False)),
+    ellipse(0.5, 0.8, 0.1, 0.03, np.linspace(np.pi, -np.pi, 8, endpoint=False))])
+
+TEMPLATE = template_points()
+
+class Rect(object):
+  """ Stand-in for dlib.rectangle """
+  def __init__(self, left, top, right, bottom):
+    self.box = (left, top, right, bottom)
+
+  def left(self):
+    return self.box[0]
+
+  def top(self):
+    return self.box[1]
+
+  def right(self):
+    return self.box[2]
+
+  def bottom(self):
+    return self.box[3]
+
+class Shape(object):
+  """ Stand-in for dlib.full_object_detection """
+  def __init__(self, points):
+    self.points = points
+
+  def part(self, i):
+    return Point(*self.points[i])
+
+class SyntheticModels(object):
+  """ Face detector and shape predictor that return the face box and
+  points of images drawn by :func:`synthetic_face`
+  """
+  def __init__(self):
+    self.faces = {}
+
+  @staticmethod
+  def key(rgbimg):
+    return hashlib.sha1(np.ascontiguousarray(rgbimg)).hexdigest()
+
+  def add(self, img, rect, points):
+    self.faces[self.key(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))] = (rect, points)
+
+  def detector(self, rgbimg, upsample=1):
+    face = self.faces.get(self.key(rgbimg))
+    return [face[0]] if face else []
+
+  def predictor(self, rgbimg, rect):
+    return Shape(self.faces[self.key(rgbimg)][1])
+
+def synthetic_face(rng, size):
+  """ Draw a face at a random position and scale
+
+  :param size: (height, width) of the image
+  :returns: (img, rect, 68 face points)
+  """
+  height, width = size
+  img = cv2.GaussianBlur(rng.integers(0, 256, size + (3,), dtype=np.uint8), (0, 0), 5)
+  face_w = int(width * rng.uniform(0.45, 0.6))
+  face_h = int(face_w * 1.25)
+  left = int(rng.integers(width // 10, width - face_w - width // 10))
+  top = int(rng.integers(height // 10, max(height - face_h - height // 20, height // 10 + 1)))
+
+  points = TEMPLATE * (face_w, face_h) + (left, top)
+  points += rng.normal(0, face_w * 0.01, points.shape)
+  points = points.astype(np.int32)
+
+  skin = tuple(int(c) for c in rng.integers(90, 230, 3))
+  cv2.fillConvexPoly(img, cv2.convexHull(points[:27]), skin)
+  for start, end in ((36, 42), (42, 48), (48, 60)):
+    cv2.fillConvexPoly(img, points[start:end], (40, 40, 120) if start == 48 else (30, 30, 30))
+  cv2.polylines(img, [points[17:22], points[22:27], points[27:36]], False, (20, 20, 20), 2)
+  return img, Rect(left, top, left + face_w, top + face_h), points
+
+def synthetic_faces(models, size, count, seed=0):
+  """ Synthetic faces registered with the models
+
+  :returns: list of (img, face points with boundary points)
+  """
+  rng = np.random.default_rng(seed)
+  faces = []
+  for _ in range(count):
+    img, rect, points = synthetic_face(rng, size)
+    models.add(img, rect, points)
+    faces.append((img, locator.shape_points(Shape(points))))
+  return faces
+
+def measure(func, repeat, setup=None):
+  """ Fastest wall time of repeat runs, and the peak memory traced by
+  tracemalloc (numpy allocations, not those made inside OpenCV) of one more run
+
+  :returns: (seconds, peak bytes)
+  """
+  times = []
+  for _ in range(repeat + 1):
+    if setup is not None:
+      setup()
+    if len(times) < repeat:
+      start = time.perf_counter()
+      func()
+      times.append(time.perf_counter() - start)
+    else:
+      tracemalloc.start()
+      func()
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+  return min(times), peak
+
+def cases(models, sizes, counts, workdir):
+  """ Benchmark cases
+
+  :returns: generator of (name, case, units per run, unit, func, setup)
+  """
+  for width, height in sizes:
+    size = (height, width)
+    case = '%dx%d' % (width, height)
+    (src_img, src_points), (dest_img, dest_points) = synthetic_faces(models, size, 2)
+
+    yield ('face_points', case, 1, 'images/s',
+           lambda: locator.face_points(src_img), None)
+
+    big_img, big_rect, big_points = synthetic_face(np.random.default_rng(1), (height * 2, width * 2))
+    yield ('resize_align', case, 1, 'images/s',
+           lambda: aligner.resize_align(big_img, big_points, size), None)
+
+    plan = warper.WarpPlan(dest_points, size)
+    coords = plan.source_coords(src_points)
+    yield ('bilinear_interpolate', case, len(plan.xs) / 1e6, 'Mpixels/s',
+           lambda: warper.bilinear_interpolate(src_img, coords), None)
+
+    yield ('warp_image', case, 1, 'warps/s',
+           lambda: warper.warp_image(src_img, src_points, dest_points, size), None)
+
+    yield ('mask_from_points', case, 1, 'masks/s',
+           lambda: blender.mask_from_points(size, dest_points), blender._mask_cache.clear)
+
+    mask = blender.mask_from_points(size, dest_points)
+    yield ('poisson_blend', case, 1, 'blends/s',
+           lambda: blender.poisson_blend(src_img, dest_img, mask), blender._poisson_cache.clear)
+
+    num_frames = 20
+    frames = [src_img, dest_img] * (num_frames // 2)
+    def write_video():
+      video = videoer.Video(os.path.join(workdir, 'bench.avi'), 10, width, height)
+      for frame in frames:
+        video.write(frame)
+      video.end()
+    yield ('video', case, num_frames, 'frames/s', write_video, None)
+
+    def morph():
+      video = videoer.Video(None, 10, width, height)
+      morpher.morph(src_img, src_points, dest_img, dest_points, video,
+                    width, height, num_frames)
+    yield ('morph', case, num_frames, 'frames/s', morph, None)
+
+    for count in counts:
+      folder = os.path.join(workdir, '%s-%d' % (case, count))
+      os.makedirs(folder)
+      imgpaths = []
+      for i, (img, _) in enumerate(synthetic_faces(models, size, count, seed=count)):
+        imgpaths.append(os.path.join(folder, '%03d.png' % i))
+        cv2.imwrite(imgpaths[-1], img)
+      out_filename = os.path.join(workdir, 'average.png')
+      yield ('averager', '%s/%d' % (case, count), count, 'images/s',
+             lambda imgpaths=imgpaths: averager.averager(
+               imgpaths, width=width, height=height, out_filename=out_filename), None)
+
+def run(sizes, counts, repeat, only, profiler=None):
+  models = SyntheticModels()
+  locator.set_models(models.detector, models.predictor)
+  workdir = tempfile.mkdtemp(prefix='facemorpher-bench-')
+  results = []
+  try:
+    for name, case, units, unit, func, setup in cases(models, sizes, counts, workdir):
+      if only and name not in only:
+        continue
+      with contextlib.redirect_stdout(io.StringIO()):
+        if profiler is not None:
+          profiler.enable()
+        seconds, peak = measure(func, repeat, setup)
+        if profiler is not None:
+          profiler.disable()
+      result = Result(name, case, seconds, units / seconds, unit, peak / 2**20)
+      print_result(result)
+      results.append(result)
+  finally:
+    shutil.rmtree(workdir)
+  return results
+
+def print_result(result, baseline=None):
+  line = '{:<22} {:<14} {:10.2f} ms {:10.1f} {:<10} {:8.1f} MB'.format(
+    result.name, result.case, result.seconds * 1000, result.rate, result.unit, result.peak_mb)
+  if baseline is not None:
+    line += '  {:5.2f}x baseline'.format(result.seconds / baseline['seconds'])
+  print(line)
+
+def save(results, filename):
+  with open(filename, 'w') as f:
+    json.dump({
+      'python': platform.python_version(),
+      'numpy': np.__version__,
+      'opencv': cv2.__version__,
+      'machine': platform.machine(),
+      'results': {'%s %s' % (r.name, r.case): r._asdict() for r in results},
+    }, f, indent=2)
+  print(filename + ' saved')
+
+def compare(results, filename, tolerance):
+  """ Print every result against the baseline
+
+  :returns: list of results slower than the baseline by more than tolerance
+  """
+  with open(filename) as f:
+    baseline = json.load(f)['results']
+  regressions = []
+  print('\nCompared to ' + filename)
+  for result in results:
+    expected = baseline.get('%s %s' % (result.name, result.case))
+    if expected is None:
+      continue
+    print_result(result, expected)
+    if result.seconds > expected['seconds'] * tolerance:
+      regressions.append(result)
+  return regressions
+
+def parse_sizes(sizes):
+  return [tuple(int(side) for side in size.split('x')) for size in sizes.split(',')]
+
+def main():
+  args = docopt(__doc__)
+  only = args['--only'].split(',') if args['--only'] else None
+  unknown = set(only or ()) - set(BENCHMARKS)
+  if unknown:
+    print('Unknown benchmarks %s. Must be in %s' % (', '.join(sorted(unknown)), BENCHMARKS))
+    sys.exit(1)
+
+  profiler = cProfile.Profile() if args['--profile'] else None
+  results = run(parse_sizes(args['--sizes']),
+                [int(count) for count in args['--counts'].split(',')],
+                int(args['--repeat']), only, profiler)
+
+  if profiler is not None:
+    profiler.dump_stats(args['--profile'])
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+  if args['--save']:
+    save(results, args['--save'])
+  if args['--compare']:
+    regressions = compare(results, args['--compare'], float(args['--tolerance']))
+    if regressions:
+      print('%d regressions over %sx the baseline' % (len(regressions), args['--tolerance']))
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,64 @@
+"""
+::
+
+  Benchmark warper engines on synthetic face points
+
+  Usage:
+    bench_warper.py [--width=<width>] [--height=<height>] [--repeat=<n>]
+
+  Options:
+    -h, --help         Show this screen.
+    --width=<width>    Width of the warped image [default: 500]
+    --height=<height>  Height of the warped image [default: 600]
+    --repeat=<n>       Number of warps timed per engine [default: 10]
+"""
+from docopt import docopt
+import time
+import cv2
+import numpy as np
+
+from facemorpher import warper
+
+def synthetic_points(rng, size, num_points=76):
+  """ Random landmarks inside the image plus its 4 corners """
+  height, width = size
+  points = np.column_stack((
+    rng.integers(width // 8, width - width // 8, num_points),
+    rng.integers(height // 8, height - height // 8, num_points)))
+  corners = [[1, 1], [width - 2, 1], [1, height - 2], [width - 2, height - 2]]
+  return np.vstack([points, corners]).astype(np.int32)
+
+def time_warp(src_img, src_points, dest_points, size, dtype, plan, engine, repeat):
+  start = time.perf_counter()
+  for _ in range(repeat):
+    result = warper.warp_image(src_img, src_points, dest_points, size,
+                               dtype, plan, engine)
+  return (time.perf_counter() - start) / repeat, result
+
+def main():
+  args = docopt(__doc__)
+  size = (int(args['--height']), int(args['--width']))
+  repeat = int(args['--repeat'])
+
+  rng = np.random.default_rng(0)
+  src_img = cv2.GaussianBlur(rng.integers(0, 256, size + (3,), dtype=np.uint8), (0, 0), 3)
+  src_points = synthetic_points(rng, size)
+  dest_points = synthetic_points(rng, size)
+  plans = {'tiled': warper.TiledWarpPlan(dest_points, size)}
+  plan = warper.WarpPlan(dest_points, size)
+
+  for dtype in (np.uint8, np.float32):
+    baseline, expected = time_warp(src_img, src_points, dest_points, size,
+                                   dtype, plan, 'numpy', repeat)
+    for engine in warper.ENGINES:
+      seconds, result = time_warp(src_img, src_points, dest_points, size,
+                                  dtype, plans.get(engine, plan), engine, repeat)
+      # uint8 numpy truncates while cv2 rounds, so allow one intensity level
+      max_diff = np.abs(result.astype(np.float64) - expected).max()
+      assert max_diff <= 1, '%s differs from numpy engine by %s' % (engine, max_diff)
+      print('{:>8} {:>12} {:8.2f} ms {:6.2f}x  max diff {:.4f}'.format(
+        np.dtype(dtype).name, engine, seconds * 1000, baseline / seconds, max_diff))
+
+
+if __name__ == "__main__":
+  main()
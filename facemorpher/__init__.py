@@ -1,9 +1,11 @@
 """
 Face Morpher module init code
 """
-from .morpher import morpher, list_imgpaths
+from .morpher import morpher, list_imgpaths, iter_morph_frames, iter_morph_sequence
 from .averager import averager
 
 __all__ = ['list_imgpaths',
            'morpher',
+           'iter_morph_frames',
+           'iter_morph_sequence',
            'averager']
@@ -4,6 +4,8 @@ Align face and image sizes
 import cv2
 import numpy as np
 
+from facemorpher import instrument
+
 def positive_cap(num):
   """ Cap a number to ensure positivity
 
@@ -69,6 +71,32 @@ def resize_image(img, scale):
 
   return cv2.resize(img, (new_scaled_width, new_scaled_height))
 
+def alignment(points, size):
+  """ Scaling factor and ROI that center the face points within the new size
+
+  :param points: *m* x 2 array of points
+  :param size: (height, width) tuple of new desired size
+  :returns: (scale, roi_x, roi_y, border_x, border_y)
+  """
+  rect = cv2.boundingRect(np.array([points], np.int32))
+  scale = scaling_factor(rect, size)
+  return (scale,) + roi_coordinates(rect, size, scale)
+
+def align_points(points, size):
+  """ Scale and align face points exactly as :func:`resize_align` does,
+    without resizing or cropping the image
+
+  :param points: *m* x 2 array of points
+  :param size: (height, width) tuple of new desired size
+  :returns: new *m* x 2 array of aligned points
+  """
+  scale, roi_x, roi_y, border_x, border_y = alignment(points, size)
+  aligned = np.array(points, copy=True)
+  aligned[:, 0] = (points[:, 0] * scale) + (border_x - roi_x)
+  aligned[:, 1] = (points[:, 1] * scale) + (border_y - roi_y)
+  return aligned
+
+@instrument.timed('align')
 def resize_align(img, points, size):
   """ Resize image and associated points, align face to the center
     and crop to the desired size
@@ -80,13 +108,11 @@ def resize_align(img, points, size):
   new_height, new_width = size
 
   # Resize image based on bounding rectangle
-  rect = cv2.boundingRect(np.array([points], np.int32))
-  scale = scaling_factor(rect, size)
+  scale, roi_x, roi_y, border_x, border_y = alignment(points, size)
   img = resize_image(img, scale)
 
   # Align bounding rect to center
   cur_height, cur_width = img.shape[:2]
-  roi_x, roi_y, border_x, border_y = roi_coordinates(rect, size, scale)
   roi_h = np.min([new_height-border_y, cur_height-roi_y])
   roi_w = np.min([new_width-border_x, cur_width-roi_x])
 
@@ -100,3 +126,82 @@ def resize_align(img, points, size):
   points[:, 1] = (points[:, 1] * scale) + (border_y - roi_y)
 
   return (crop, points)
+
+def alignment_matrix(points, size, shape=None):
+  """ 2 x 3 affine matrix that maps original image coordinates to the
+    aligned coordinates of :func:`resize_align`
+
+  :param points: *m* x 2 array of points
+  :param size: (height, width) tuple of new desired size
+  :param shape: optional shape of the original image. The matrix then maps
+    pixel centres as the cv2.resize of :func:`resize_align` does, with the
+    scale of its rounded size and the half pixel offset 0.5 * (scale - 1)
+  """
+  scale, roi_x, roi_y, border_x, border_y = alignment(points, size)
+  if shape is None:
+    return np.array([[scale, 0, border_x - roi_x],
+                     [0, scale, border_y - roi_y]], np.float64)
+  scale_x = int(scale * shape[1]) / float(shape[1])
+  scale_y = int(scale * shape[0]) / float(shape[0])
+  return np.array([[scale_x, 0, border_x - roi_x + 0.5 * (scale_x - 1)],
+                   [0, scale_y, border_y - roi_y + 0.5 * (scale_y - 1)]], np.float64)
+
+@instrument.timed('align')
+def fused_source(img, points, size, antialias=True):
+  """ Prepare an original image to be warped straight into the aligned frame,
+    instead of resizing and cropping it with :func:`resize_align` first.
+    The source points are the aligned points of :func:`align_points` mapped
+    back through the pixel mapping of cv2.resize, so the warp samples the
+    same positions as the two step path, with one interpolation instead of two.
+    With antialias, while the alignment shrinks the image by more than half,
+    it is downscaled with cv2.pyrDown so that bilinear sampling does not alias.
+
+  :param img: original image
+  :param points: *m* x 2 array of face points in the original image
+  :param size: (height, width) tuple of the aligned size
+  :param antialias: downscale with cv2.pyrDown first. cv2.resize does not,
+    so switch it off to sample like :func:`resize_align`
+  :returns: (img, src_points, matrix). src_points are float face points in
+    img coordinates and matrix maps img to aligned coordinates
+  """
+  matrix = alignment_matrix(points, size, img.shape)
+  inverse = cv2.invertAffineTransform(matrix)
+  aligned_points = align_points(points, size).astype(np.float64)
+  src_points = aligned_points @ inverse[:, :2].T + inverse[:, 2]
+  while antialias and matrix[0, 0] < 0.5 and min(img.shape[:2]) > 1:
+    img = cv2.pyrDown(img)
+    src_points = src_points / 2
+    matrix[:, :2] *= 2
+  return img, src_points, matrix
+
+def resized_extent(row, side):
+  """ First and last + 1 aligned pixel that one axis of an image covers
+
+  :param row: row of an alignment matrix, [scale, 0, offset] or [0, scale, offset]
+  :param side: image width or height
+  """
+  scale, offset = max(row[:2]), row[2]
+  start = int(round(offset - 0.5 * scale + 0.5))
+  stop = int(round(offset + (side - 0.5) * scale + 0.5))
+  return max(start, 0), max(stop, 0)
+
+@instrument.timed('align')
+def warp_align(img, matrix, size):
+  """ Aligned crop of an image in a single interpolation
+
+  :param img: image from :func:`fused_source`
+  :param matrix: alignment matrix from :func:`fused_source`
+  :param size: (height, width) tuple of the aligned size
+  """
+  height, width = size
+  aligned = cv2.warpAffine(img[..., :3], matrix, (width, height),
+                           flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+  # Like the crop of resize_align, black outside the resized image, with
+  # its edge pixels replicated up to there as cv2.resize does
+  (x0, x1), (y0, y1) = [resized_extent(row, side)
+                        for row, side in zip(matrix, img.shape[1::-1])]
+  aligned[:, :x0] = 0
+  aligned[:, x1:] = 0
+  aligned[:y0] = 0
+  aligned[y1:] = 0
+  return aligned
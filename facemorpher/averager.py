@@ -4,33 +4,49 @@
   Face averager
 
   Usage:
-    averager.py --images=<images_folder> [--blur] [--plot]
-              [--background=(black|transparent|average)]
+    averager.py (--images=<images_folder> | --corpus=<folder>) [--subset=<selector>]
+              [--blur] [--plot]
+              [--background=(black|transparent|average|median|blur)]
               [--width=<width>] [--height=<height>]
-              [--out=<filename>] [--destimg=<filename>]
+              [--out=<filename>] [--destimg=<filename>] [--streaming]
+              [--workers=<num>] [--cache=<filename>] [--fused]
+              [--tile=<pixels>] [--profile] [--weights=<filename>]
 
   Options:
     -h, --help             Show this screen.
     --images=<folder>      Folder to images (.jpg, .jpeg, .png)
+    --corpus=<folder>      Aligned face corpus built by corpus.py, used instead of images
+    --subset=<selector>    Faces to average: a start:stop[:step] slice, comma separated indices or a path pattern
     --blur                 Flag to blur edges of image [default: False]
     --width=<width>        Custom width of the images/video [default: 500]
     --height=<height>      Custom height of the images/video [default: 600]
     --out=<filename>       Filename to save the average face [default: result.png]
     --destimg=<filename>   Destination face image to overlay average face
     --plot                 Flag to display the average face [default: False]
-    --background=<bg>      Background of image to be one of (black|transparent|average) [default: black]
+    --background=<bg>      Background of image to be one of (black|transparent|average|median|blur) [default: black]
+    --streaming            Kept for compatibility, images always stream in constant memory [default: False]
+    --workers=<num>        Number of processes to load images and find faces [default: 1]
+    --cache=<filename>     SQLite file to cache face points across runs
+    --fused                Flag to warp straight from the original images [default: False]
+    --tile=<pixels>        Warp in square tiles of this size to bound memory of large outputs
+    --profile              Print the time spent in each stage at the end [default: False]
+    --weights=<filename>   CSV of image filename,weight rows. Images that are not listed are left out
     --version              Show version.
 """
 
 from docopt import docopt
+import collections
+import csv
 import os
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 
 from facemorpher import locator
 from facemorpher import aligner
+from facemorpher import loader
+from facemorpher import cache as cache_module
+from facemorpher import corpus as corpus_module
+from facemorpher import instrument
 from facemorpher import warper
 from facemorpher import blender
 from facemorpher import plotter
@@ -47,76 +63,535 @@ def sharpen(img):
   return cv2.addWeighted(img, 1.4, blured, -0.4, 0)
 
 def load_image_points(path, size):
-  img = cv2.imread(path)
-  points = locator.face_points(img)
+  return loader.load_image_points(path, size)
 
-  if len(points) == 0:
-    print('No face in %s' % path)
-    return None, None
+# Backgrounds drawn from the aligned images
+IMAGE_BACKGROUNDS = ('average', 'median', 'blur')
+DEFAULT_RESERVOIR_SIZE = 15
+# Sigma of the blurred background, as a fraction of the longest side
+BACKGROUND_BLUR = 0.02
+
+def kept_background(background):
+  """ Accumulator background argument of an averager background """
+  return background if background in IMAGE_BACKGROUNDS else False
+
+class BackgroundReservoir(object):
+  """ Weighted random sample of a fixed number of aligned images, for a per
+  pixel median background in bounded memory. Keeps the images with the
+  largest random keys u ** (1 / weight), see Efraimidis and Spirakis,
+  Weighted random sampling with a reservoir. The median is exact while no
+  more images than the capacity were added.
+  """
+  def __init__(self, size, capacity=DEFAULT_RESERVOIR_SIZE, seed=0):
+    """
+    :param size: (height, width) of the images
+    :param capacity: number of images kept
+    :param seed: seed of the random keys, so averages are repeatable
+    """
+    self.images = np.zeros((capacity,) + tuple(size) + (3,), np.uint8)
+    self.keys = np.full(capacity, -np.inf)
+    self.random = np.random.RandomState(seed)
+
+  def add(self, img, weight=1):
+    key = self.random.random_sample() ** (1.0 / weight)
+    slot = np.argmin(self.keys)
+    if key > self.keys[slot]:
+      self.keys[slot] = key
+      self.images[slot] = img[..., :3]
+
+  def median(self):
+    return np.uint8(np.median(self.images[np.isfinite(self.keys)], axis=0))
+
+class Accumulator(object):
+  """ Running sum of faces warped onto the same destination points.
+  Memory stays at the size of one output image however many faces are added.
+  """
+  def __init__(self, dest_points, size, dtype=np.float32, background=False,
+               tile_size=None):
+    """
+    :param dest_points: *m* x 2 array of destination face points
+    :param size: (height, width) of the output image
+    :param dtype: float dtype of the running sums
+    :param background: also keep a running sum of the aligned images if True,
+      'average' or 'blur', or a :class:`BackgroundReservoir` if 'median'
+    :param tile_size: warp in tiles of this size, added straight to the sum.
+      Bounds the memory of a warp for print resolution outputs
+    """
+    self.dest_points = dest_points
+    self.size = size
+    self.tile_size = tile_size
+    self.plan = self.warp_plan(dest_points)
+    self.face_sum = np.zeros(size + (3,), dtype)
+    self.background_sum = None
+    self.reservoir = None
+    if background == 'median':
+      self.reservoir = BackgroundReservoir(size)
+    elif background:
+      self.background_sum = np.zeros(size + (3,), dtype)
+    self.count = 0
+    # Sum of the weights of the added images
+    self.weight = 0
+
+  def add(self, img, points, matrix=None, weight=1, warped=None):
+    """ Warp an image onto the destination points and add it to the sum
+
+    :param img: aligned image, or an original image when matrix is supplied
+    :param points: face points in img coordinates
+    :param matrix: alignment matrix of an original image from
+      :func:`facemorpher.aligner.fused_source`
+    :param weight: weight of the image in the average
+    :param warped: optional face already warped onto the destination points
+      by :meth:`warp`, such as one shared by accumulators of the same points.
+      It is not modified
+    """
+    if warped is not None:
+      self.face_sum += warped if weight == 1 else float(weight) * warped
+    elif isinstance(self.plan, warper.TiledWarpPlan):
+      warper.warp_tiled(img[..., :3], points, self.plan, self.face_sum, add=True,
+                        weight=weight)
+    else:
+      warped = warper.warp_image(img, points, self.dest_points, self.size,
+                                 self.face_sum.dtype, self.plan)
+      if weight != 1:
+        warped *= weight
+      self.face_sum += warped
+    if matrix is not None and (self.background_sum is not None or self.reservoir is not None):
+      img = aligner.warp_align(img, matrix, self.size)
+    if self.background_sum is not None:
+      if weight != 1:
+        self.background_sum += float(weight) * img[..., :3]
+      else:
+        self.background_sum += img[..., :3]
+    if self.reservoir is not None:
+      self.reservoir.add(img, weight)
+    self.count += 1
+    self.weight += weight
+    instrument.count('images')
+
+  def remove(self, img, points, weight=1):
+    """ Subtract an aligned image that was added before with the same weight.
+    Needs a float dtype that holds the sums exactly, such as float64 """
+    if self.tile_size:
+      raise ValueError('Images cannot be removed from a tiled accumulator')
+    if self.reservoir is not None:
+      raise ValueError('Images cannot be removed from a median background')
+    warped = warper.warp_image(img, points, self.dest_points, self.size,
+                               self.face_sum.dtype, self.plan)
+    if weight != 1:
+      warped *= weight
+    self.face_sum -= warped
+    if self.background_sum is not None:
+      if weight != 1:
+        self.background_sum -= float(weight) * img[..., :3]
+      else:
+        self.background_sum -= img[..., :3]
+    self.count -= 1
+    self.weight -= weight
+
+  def warp(self, img, points):
+    """ Face of an aligned image warped onto the destination points, as
+    :meth:`add` would sum it """
+    return warper.warp_image(img, points, self.dest_points, self.size,
+                             self.face_sum.dtype, self.plan)
+
+  def warp_plan(self, dest_points):
+    if self.tile_size:
+      return warper.TiledWarpPlan(dest_points, self.size, tile_size=self.tile_size)
+    return warper.WarpPlan(dest_points, self.size)
+
+  def rebase(self, dest_points):
+    """ Move the sum of faces onto new destination points with one warp of
+    the sum, instead of warping every added image again. Resamples the sum,
+    so rebase only when the points moved more than a pixel or so """
+    plan = self.warp_plan(dest_points)
+    engine = 'tiled' if self.tile_size else 'numpy'
+    self.face_sum = warper.warp_image(self.face_sum, self.dest_points, dest_points,
+                                      self.size, self.face_sum.dtype, plan, engine)
+    self.dest_points = dest_points
+    self.plan = plan
+
+  def average(self):
+    return np.uint8(self.face_sum / self.weight)
+
+  def average_background(self):
+    return np.uint8(self.background_sum / self.weight)
+
+  def background_image(self, background='average'):
+    """ Background of the aligned images
+
+    :param background: one of (average|median|blur). A median needs an
+      accumulator made with background='median'
+    """
+    if background == 'median':
+      if self.reservoir is None:
+        raise ValueError('A median background needs an accumulator with background=median')
+      return self.reservoir.median()
+
+    average_background = self.average_background()
+    if background == 'blur':
+      sigma = BACKGROUND_BLUR * max(self.size)
+      average_background = cv2.GaussianBlur(average_background, (0, 0), sigma)
+    return average_background
+
+def no_images_error():
+  return FileNotFoundError('Could not find any valid images.' +
+                           ' Supported formats are .jpg, .png, .jpeg')
+
+def load_dest_image_points(dest_filename, size, cache=None):
+  dest_img, dest_points = loader.load_image_points(dest_filename, size, cache)
+  if dest_img is None or dest_points is None:
+    raise Exception('No face or detected face points in dest img: ' + dest_filename)
+  return dest_img, dest_points
+
+def stream_average(imgpaths, dest_filename, size, background, workers=1, cache=None,
+                   fused=False, tile_size=None, weights=None):
+  """ Average faces while holding only running sums in memory.
+
+  With a destination image, every image is warped as soon as it is loaded.
+  Otherwise a first pass collects the face points only, to find the
+  average destination points, and a second pass streams the pixels.
+
+  :param fused: warp straight from the original images, without first
+    resizing and cropping them to the aligned size
+  :param tile_size: see :class:`Accumulator`
+  :param weights: optional dict of image path to weight
+  :returns: (accumulator, dest_img)
+  """
+  weights = weights or {}
+  keep_background = kept_background(background)
+  if dest_filename is not None:
+    dest_img, dest_points = load_dest_image_points(dest_filename, size, cache)
+    accumulator = Accumulator(dest_points, size, background=keep_background,
+                              tile_size=tile_size)
+    if fused:
+      sources = loader.iter_source_points(imgpaths, size, workers, cache)
+      for path, img, src_points, matrix in sources:
+        accumulator.add(img, src_points, matrix, weights.get(path, 1))
+    else:
+      for path, img, points in loader.iter_image_points(imgpaths, size, workers, cache):
+        accumulator.add(img, points, weight=weights.get(path, 1))
   else:
-    return aligner.resize_align(img, points, size)
+    # Pass one: face points only
+    path_points = list(loader.iter_raw_points(imgpaths, workers, cache))
+    if len(path_points) == 0:
+      raise no_images_error()
 
-def averager(imgpaths, dest_filename=None, width=500, height=600, background='black',
-             blur_edges=False, out_filename='result.png', plot=False):
+    path_weights = [weights.get(path, 1) for path, _ in path_points]
+    dest_points = locator.average_points(
+      [aligner.align_points(points, size) for _, points in path_points], path_weights)
+    dest_img = np.zeros(size + (3,), np.uint8)
 
-  size = (height, width)
+    # Pass two: stream the pixels
+    accumulator = Accumulator(dest_points, size, background=keep_background,
+                              tile_size=tile_size)
+    if fused:
+      sources = loader.iter_sources(path_points, size, workers)
+      for weight, (img, src_points, matrix) in zip(path_weights, sources):
+        accumulator.add(img, src_points, matrix, weight)
+    else:
+      aligned = loader.iter_aligned(path_points, size, workers)
+      for weight, (img, points) in zip(path_weights, aligned):
+        accumulator.add(img, points, weight=weight)
 
-  images = []
-  point_set = []
-  for path in imgpaths:
-    img, points = load_image_points(path, size)
-    if img is not None:
-      images.append(img)
-      point_set.append(points)
+  if accumulator.count == 0:
+    raise no_images_error()
+  return accumulator, dest_img
 
-  if len(images) == 0:
-    raise FileNotFoundError('Could not find any valid images.' +
-                            ' Supported formats are .jpg, .png, .jpeg')
+def corpus_average(corpus, subset=None, dest_filename=None, background='black',
+                   cache=None, tile_size=None, weights=None):
+  """ Average faces of an aligned corpus, read straight from its memory map
+  without decoding or detection
+
+  :param corpus: :class:`facemorpher.corpus.Corpus`
+  :param subset: faces to average, see :meth:`facemorpher.corpus.Corpus.select`
+  :param tile_size: see :class:`Accumulator`
+  :param weights: optional weight of every face of the corpus
+  :returns: (accumulator, dest_img)
+  """
+  indices = corpus.select(subset)
+  face_weights = np.ones(len(indices)) if weights is None else np.asarray(weights)[indices]
+  # Faces without weight are never read
+  indices, face_weights = indices[face_weights != 0], face_weights[face_weights != 0]
+  if len(indices) == 0:
+    raise no_images_error()
 
   if dest_filename is not None:
-    dest_img, dest_points = load_image_points(dest_filename, size)
-    if dest_img is None or dest_points is None:
-      raise Exception('No face or detected face points in dest img: ' + dest_filename)
+    dest_img, dest_points = load_dest_image_points(dest_filename, corpus.size, cache)
   else:
-    dest_img = np.zeros(images[0].shape, np.uint8)
-    dest_points = locator.average_points(point_set)
+    dest_img = np.zeros(corpus.size + (3,), np.uint8)
+    dest_points = locator.average_points(corpus.points[indices], face_weights)
+
+  keep_background = kept_background(background)
+  accumulator = Accumulator(dest_points, corpus.size, background=keep_background,
+                            tile_size=tile_size)
+  for weight, (_, img, points) in zip(face_weights, corpus.iter_image_points(indices)):
+    accumulator.add(img, points, weight=weight)
+  return accumulator, dest_img
+
+SUBSET_BATCH_SIZE = 16
 
-  num_images = len(images)
-  result_images = np.zeros(images[0].shape, np.float32)
-  for i in range(num_images):
-    result_images += warper.warp_image(images[i], point_set[i],
-                                       dest_points, size, np.float32)
+def subset_averages(imgpaths, subsets, weights=None, width=500, height=600, workers=1,
+                    cache=None, corpus=None, background=False, shared_reference=False):
+  """ Averages of several subsets of the same images, such as one per group.
 
-  result_image = np.uint8(result_images / num_images)
-  face_indexes = np.nonzero(result_image)
-  dest_img[face_indexes] = result_image[face_indexes]
+  Every image is read and located once, and warped onto the weighted mean
+  face points of every subset it is in, so each average is the same as an
+  :func:`averager` run over its subset. Subsets with the same mean face
+  points share that warp.
 
-  mask = blender.mask_from_points(size, dest_points)
+  With shared_reference, every image is warped only once, onto the weighted
+  mean face points of all subsets, and added to the sums of its subsets with
+  one matrix product per batch of images. The sum of every subset is then
+  moved onto its own mean face points with :meth:`Accumulator.rebase`, so K
+  subsets of N images cost N + K warps instead of up to N x K. That second
+  warp resamples the sums with another triangulation, so these averages are
+  approximate. Against :func:`averager`, four subsets of 2 to 5 of 10
+  synthetic faces were off by up to 29 to 40 levels, and 161 for the 2 face
+  subset whose mean points are furthest from the reference, on 2400 to 4000
+  face pixels each.
+
+  :param imgpaths: array of image paths. Ignored with a corpus
+  :param subsets: list of subsets of imgpaths or the corpus, see
+    :func:`facemorpher.corpus.select`
+  :param weights: optional weight of every image of imgpaths or face of the corpus
+  :param workers: number of processes that load images and locate face points
+  :param cache: landmark cache filepath or :class:`facemorpher.cache.LandmarkCache`
+  :param corpus: :class:`facemorpher.corpus.Corpus` or its folder. The faces
+    keep the size of the corpus
+  :param background: also keep the aligned images, see :class:`Accumulator`.
+    Only sums, for average and blur backgrounds, with shared_reference
+  :param shared_reference: warp every image once and move the subset sums,
+    trading exactness for fewer warps
+  :returns: list of :class:`Accumulator`, one per subset. Draw them with
+    :func:`compose_average`
+  """
+  corpus = corpus_module.open_corpus(corpus)
+  if corpus is not None:
+    paths, size = corpus.paths, corpus.size
+  else:
+    paths, size = list(imgpaths), (height, width)
+
+  # Weight of every image in every subset
+  subset_weights = np.zeros((len(subsets), len(paths)))
+  for k, subset in enumerate(subsets):
+    subset_weights[k, corpus_module.select(paths, subset)] = 1
+  if weights is not None:
+    subset_weights *= np.asarray(weights, np.float64)
+  # Images in no subset are never read
+  used = np.flatnonzero(subset_weights.any(axis=0))
+
+  if corpus is not None:
+    point_set = corpus.points[used]
+    images_points = ((img, points) for _, img, points in corpus.iter_image_points(used))
+  else:
+    positions = {path: i for i, path in enumerate(paths)}
+    path_points = list(loader.iter_raw_points([paths[i] for i in used], workers,
+                                              cache_module.open_cache(cache)))
+    used = np.array([positions[path] for path, _ in path_points], np.intp)
+    point_set = np.array([aligner.align_points(points, size) for _, points in path_points])
+    images_points = loader.iter_aligned(path_points, size, workers)
+  if len(used) == 0:
+    raise no_images_error()
+
+  subset_weights = subset_weights[:, used]
+  totals = subset_weights.sum(axis=1)
+  if not totals.all():
+    raise ValueError('Subset {} has no faces'.format(np.flatnonzero(totals == 0)[0]))
+  # Mean face points of every subset, as averager() finds them
+  subset_points = []
+  for image_weights in subset_weights:
+    members = np.flatnonzero(image_weights)
+    subset_points.append(locator.average_points(point_set[members], image_weights[members]))
+
+  if not shared_reference:
+    accumulators = [Accumulator(points, size, background=background)
+                    for points in subset_points]
+    # Subsets with the same mean face points, such as subsets of the same
+    # faces, share one warp of every image
+    groups = collections.defaultdict(list)
+    for k, points in enumerate(subset_points):
+      groups[points.tobytes()].append(k)
+    for i, (img, points) in enumerate(images_points):
+      for members in groups.values():
+        members = [k for k in members if subset_weights[k, i]]
+        if not members:
+          continue
+        warped = accumulators[members[0]].warp(img, points)
+        for k in members:
+          accumulators[k].add(img, points, weight=subset_weights[k, i], warped=warped)
+    return accumulators
+
+  if background == 'median':
+    raise ValueError('A shared reference only sums the backgrounds, it has no median')
+  reference = locator.average_points(point_set, subset_weights.sum(axis=0))
+  plan = warper.WarpPlan(reference, size)
+  face_sums = np.zeros((len(subsets),) + size + (3,), np.float32)
+  faces = np.empty((SUBSET_BATCH_SIZE,) + size + (3,), np.float32)
+  if background:
+    background_sums = np.zeros_like(face_sums)
+    backgrounds = np.empty_like(faces)
+
+  for i, (img, points) in enumerate(images_points):
+    j = i % SUBSET_BATCH_SIZE
+    warper.warp_image(img, points, reference, size, np.float32, plan, out=faces[j])
+    if background:
+      backgrounds[j] = img[..., :3]
+    instrument.count('images')
+    if j == SUBSET_BATCH_SIZE - 1 or i == len(used) - 1:
+      batch_weights = subset_weights[:, i - j:i + 1].astype(np.float32)
+      face_sums += np.tensordot(batch_weights, faces[:j + 1], axes=1)
+      if background:
+        background_sums += np.tensordot(batch_weights, backgrounds[:j + 1], axes=1)
+
+  accumulators = []
+  for k in range(len(subsets)):
+    accumulator = Accumulator(reference, size, background=bool(background))
+    accumulator.face_sum = face_sums[k]
+    if background:
+      accumulator.background_sum = background_sums[k]
+    accumulator.count = np.count_nonzero(subset_weights[k])
+    accumulator.weight = totals[k]
+    accumulator.rebase(subset_points[k])
+    accumulators.append(accumulator)
+  return accumulators
+
+def select_weighted(imgpaths, subset=None, weights=None):
+  """ Subset of image paths with a non-zero weight
+
+  :param imgpaths: array or generator of image paths
+  :param subset: see :func:`facemorpher.corpus.select`
+  :param weights: optional weight of every image of imgpaths
+  :returns: (imgpaths, dict of image path to weight)
+  """
+  if subset is None and weights is None:
+    return imgpaths, {}
+  imgpaths = list(imgpaths)
+  if weights is not None and len(weights) != len(imgpaths):
+    raise ValueError('Got {} weights for {} images'.format(len(weights), len(imgpaths)))
+
+  indices = corpus_module.select(imgpaths, subset)
+  if weights is None:
+    return [imgpaths[i] for i in indices], {}
+  path_weights = {imgpaths[i]: weights[i] for i in indices if weights[i] != 0}
+  return [imgpaths[i] for i in indices if weights[i] != 0], path_weights
+
+def compose_average(accumulator, dest_img=None, background='black', blur_edges=False,
+                    average_background=None):
+  """ Draw the average face of an accumulator onto a destination image
+
+  :param accumulator: :class:`Accumulator` of at least one image
+  :param dest_img: image to draw the face on. Defaults to black
+  :param background: one of (black|transparent|average|median|blur)
+  :param blur_edges: blur the edges of the face mask
+  :param average_background: background image for the average, median and
+    blur backgrounds. Defaults to :meth:`Accumulator.background_image`
+  :returns: BGR image, or BGRA for transparent backgrounds
+  """
+  size = accumulator.size
+  if dest_img is None:
+    dest_img = np.zeros(size + (3,), np.uint8)
+  result_image = accumulator.average()
+  np.copyto(dest_img, result_image, where=result_image > 0)
+
+  mask = blender.mask_from_points(size, np.int32(accumulator.dest_points))
   if blur_edges:
     blur_radius = 10
     mask = cv2.blur(mask, (blur_radius, blur_radius))
 
-  if background in ('transparent', 'average'):
+  if background == 'transparent' or background in IMAGE_BACKGROUNDS:
     dest_img = np.dstack((dest_img, mask))
 
-    if background == 'average':
-      average_background = locator.average_points(images)
+    if background in IMAGE_BACKGROUNDS:
+      if average_background is None:
+        average_background = accumulator.background_image(background)
       dest_img = blender.overlay_image(dest_img, mask, average_background)
 
-  print('Averaged {} images'.format(num_images))
-  plt = plotter.Plotter(plot, num_images=1, out_filename=out_filename)
+  return dest_img
+
+def averager(imgpaths, dest_filename=None, width=500, height=600, background='black',
+             blur_edges=False, out_filename='result.png', plot=False, streaming=False,
+             workers=1, cache=None, fused=False, tile_size=None, corpus=None, subset=None,
+             weights=None):
+  """
+  Average the faces in imgpaths
+
+  :param imgpaths: array or generator of image paths. Ignored with a corpus
+  :param streaming: kept for compatibility. Images are always warped as they
+    are loaded and only running sums are kept, see :func:`stream_average`,
+    so memory does not grow with the number of images
+  :param workers: number of processes that load images and locate face points
+  :param cache: landmark cache filepath or :class:`facemorpher.cache.LandmarkCache`
+  :param fused: warp straight from the original images with the alignment
+    folded into the warp, so aligned crops are never made.
+    Each pixel is interpolated once instead of twice, so the result is not
+    identical: on smooth photos faces differ by a few levels (up to about 14
+    where the alignment more than halves the image), more on hard edges.
+    Images shrunk by more than half are downscaled with cv2.pyrDown first,
+    which blurs them less than the aliasing cv2.resize of the default path
+  :param tile_size: warp in square tiles of this many pixels, so the memory of
+    a warp stays bounded for high resolution outputs
+  :param corpus: :class:`facemorpher.corpus.Corpus` or its folder to average
+    instead of imgpaths. The faces keep the size of the corpus
+  :param subset: faces of the corpus or imgpaths to average, see
+    :func:`facemorpher.corpus.select`
+  :param weights: optional weight of every image of imgpaths or face of the
+    corpus, before the subset is taken. Images without weight are never read
+  """
+  size = (height, width)
+  cache = cache_module.open_cache(cache)
+  corpus = corpus_module.open_corpus(corpus)
+
+  if corpus is not None:
+    accumulator, dest_img = corpus_average(corpus, subset, dest_filename, background,
+                                           cache, tile_size, weights)
+  else:
+    imgpaths, path_weights = select_weighted(imgpaths, subset, weights)
+    accumulator, dest_img = stream_average(imgpaths, dest_filename, size, background,
+                                           workers, cache, fused, tile_size, path_weights)
+
+  dest_img = compose_average(accumulator, dest_img, background, blur_edges)
+
+  print('Averaged {} images'.format(accumulator.count))
+  plt = plotter.Plotter(plot, num_images=1, out_filename=out_filename, save_workers=0)
   plt.save(dest_img)
+  plt.end()
   plt.plot_one(dest_img)
   plt.show()
 
+def read_weights(filename, imgpaths):
+  """ Weights of image paths from a CSV file of filename,weight rows.
+  Images are matched by file name, and images that are not listed get no weight
+
+  :returns: list of weights in imgpaths order
+  """
+  with open(filename) as f:
+    weights = {os.path.basename(row[0]): float(row[1]) for row in csv.reader(f) if row}
+  return [weights.get(os.path.basename(path), 0) for path in imgpaths]
+
 def main():
   args = docopt(__doc__, version='Face Averager 1.0')
+  instrument.enable(args['--profile'])
   try:
-    averager(list_imgpaths(args['--images']), args['--destimg'],
+    if args['--images']:
+      imgpaths = list(list_imgpaths(args['--images']))
+    else:
+      imgpaths = None
+    weights = None
+    if args['--weights']:
+      if args['--corpus']:
+        weights = read_weights(args['--weights'], corpus_module.Corpus(args['--corpus']).paths)
+      else:
+        weights = read_weights(args['--weights'], imgpaths)
+    averager(imgpaths, args['--destimg'],
              int(args['--width']), int(args['--height']),
-             args['--background'], args['--blur'], args['--out'], args['--plot'])
+             args['--background'], args['--blur'], args['--out'], args['--plot'],
+             args['--streaming'], int(args['--workers']), args['--cache'],
+             args['--fused'], int(args['--tile']) if args['--tile'] else None,
+             args['--corpus'], args['--subset'], weights)
   except Exception as e:
     print(e)
+  if args['--profile']:
+    instrument.report(instrument.TableSink())
 
 
 if __name__ == "__main__":
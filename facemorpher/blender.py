@@ -1,69 +1,216 @@
+import collections
+import hashlib
 import cv2
 import numpy as np
 import scipy.sparse
+import scipy.sparse.linalg
+
+from facemorpher import instrument
+
+# Masks of recently used point sets
+MASK_CACHE_SIZE = 8
+_mask_cache = collections.OrderedDict()
+
+@instrument.timed('mask')
+def mask_from_points(size, points, radius=10):
+  """ Create a mask of supplied size from supplied points.
+  Recent masks are cached by size and points, and a copy of the cached
+  mask is returned, so callers may write to it
 
-def mask_from_points(size, points):
-  """ Create a mask of supplied size from supplied points
   :param size: tuple of output mask size
   :param points: array of [x, y] points
+  :param radius: size of the kernel that erodes the edge of the mask
   :returns: mask of values 0 and 255 where
             255 indicates the convex hull containing the points
   """
-  radius = 10  # kernel size
-  kernel = np.ones((radius, radius), np.uint8)
+  points = np.ascontiguousarray(points, np.int32)
+  key = (tuple(size[:2]), radius, points.shape, hashlib.sha1(points).hexdigest())
+  if key in _mask_cache:
+    _mask_cache.move_to_end(key)
+    return _mask_cache[key].copy()
 
+  kernel = np.ones((radius, radius), np.uint8)
   mask = np.zeros(size, np.uint8)
-  cv2.fillConvexPoly(mask, cv2.convexHull(points), 255)
-  mask = cv2.erode(mask, kernel)
-
-  return mask
-
-def overlay_image(foreground_image, mask, background_image):
+  hull = cv2.convexHull(points)
+  cv2.fillConvexPoly(mask, hull, 255)
+
+  # Only erode around the hull. The zero margin keeps the result unchanged
+  x, y, w, h = cv2.boundingRect(hull)
+  y0, x0 = max(y - radius, 0), max(x - radius, 0)
+  roi = mask[y0:y + h + radius, x0:x + w + radius]
+  roi[...] = cv2.erode(roi, kernel)
+
+  mask.flags.writeable = False
+  _mask_cache[key] = mask
+  if len(_mask_cache) > MASK_CACHE_SIZE:
+    _mask_cache.popitem(last=False)
+  return mask.copy()
+
+@instrument.timed('blend')
+def overlay_image(foreground_image, mask, background_image, out=None):
   """ Overlay foreground image onto the background given a mask
   :param foreground_image: foreground image points
   :param mask: [0-255] values in mask
   :param background_image: background image points
+  :param out: optional result image. By default the background image is
+    overlaid in place
   :returns: image with foreground where mask > 0 overlaid on background image
   """
-  foreground_pixels = mask > 0
-  background_image[..., :3][foreground_pixels] = foreground_image[..., :3][foreground_pixels]
-  return background_image
-
-def apply_mask(img, mask):
+  if out is None:
+    out = background_image
+  elif out is not background_image:
+    np.copyto(out, background_image)
+  np.copyto(out[..., :3], foreground_image[..., :3], where=(mask > 0)[..., np.newaxis])
+  return out
+
+@instrument.timed('blend')
+def apply_mask(img, mask, out=None):
   """ Apply mask to supplied image
   :param img: max 3 channel image
   :param mask: [0-255] values in mask
-  :returns: new image with mask applied
+  :param out: optional result image of the shape and dtype of img
+  :returns: image with mask applied
+  """
+  if out is None:
+    out = np.empty_like(img)
+  if img.shape[2] > 3:
+    out[..., 3:] = img[..., 3:]
+
+  if img.dtype == np.uint8:
+    # Rounded uint8 product, broadcast over channels by cv2
+    masked = cv2.multiply(img[..., :3], cv2.merge((mask, mask, mask)), scale=1 / 255,
+                          dst=out if img.shape[2] == 3 else None)
+    if masked is not out:
+      out[..., :3] = masked
+  else:
+    np.multiply(img[..., :3], mask[..., np.newaxis] / 255, out=out[..., :3],
+                casting='unsafe')
+  return out
+
+@instrument.timed('blend')
+def weighted_average(img1, img2, percent=0.5, out=None):
+  """ Weighted average of two images
+  :param percent: [0, 1] weight of img1
+  :param out: optional preallocated result image. At percent 0 or 1 the
+    input image itself is returned and out is left untouched
+  :returns: weighted average image
   """
-  masked_img = np.copy(img)
-  num_channels = 3
-  for c in range(num_channels):
-    masked_img[..., c] = img[..., c] * (mask / 255)
-
-  return masked_img
-
-def weighted_average(img1, img2, percent=0.5):
   if percent <= 0:
     return img2
   elif percent >= 1:
     return img1
   else:
-    return cv2.addWeighted(img1, percent, img2, 1-percent, 0)
-
-def alpha_feathering(src_img, dest_img, img_mask, blur_radius=15):
-  mask = cv2.blur(img_mask, (blur_radius, blur_radius))
-  mask = mask / 255.0
-
-  result_img = np.empty(src_img.shape, np.uint8)
-  for i in range(3):
-    result_img[..., i] = src_img[..., i] * mask + dest_img[..., i] * (1-mask)
+    return cv2.addWeighted(img1, percent, img2, 1-percent, 0, dst=out)
 
-  return result_img
+@instrument.timed('blend')
+def weighted_average_batch(imgs1, imgs2, percents, out=None):
+  """ Weighted averages of two images, or stacks of images, for several weights
 
+  :param imgs1: uint8 image, or *k* x height x width x channels stack
+  :param imgs2: uint8 image, or stack, of the shape of imgs1
+  :param percents: *k* weights of imgs1 in [0, 1]
+  :param out: optional uint8 *k* x height x width x channels result
+  :returns: uint8 stack of *k* weighted average images
+  """
+  weights = np.asarray(percents, np.float32).reshape(-1, 1, 1, 1)
+  averages = imgs1 * weights
+  averages += imgs2 * (1 - weights)
+  averages += 0.5
+  if out is None:
+    out = np.empty(averages.shape, np.uint8)
+  np.copyto(out, averages, casting='unsafe')
+  return out
+
+@instrument.timed('blend')
+def alpha_feathering(src_img, dest_img, img_mask, blur_radius=15, out=None):
+  """ Blend the source into the destination image through a blurred mask
+
+  :param src_img: uint8 source image
+  :param dest_img: uint8 destination image
+  :param img_mask: [0-255] values in mask of source pixels
+  :param out: optional uint8 result image
+  :returns: blended image
+  """
+  src_weights = cv2.blur(img_mask, (blur_radius, blur_radius)).astype(np.float32)
+  src_weights *= 1 / 255
+  return cv2.blendLinear(src_img[..., :3], dest_img[..., :3],
+                         src_weights, 1 - src_weights, dst=out)
+
+# Factorized Poisson systems of recently blended masks
+POISSON_CACHE_SIZE = 4
+_poisson_cache = collections.OrderedDict()
+
+def shift(img, dy, dx):
+  """ Shift a 2D (or 3D) array by (dy, dx), filling with zeros """
+  shifted = np.zeros_like(img)
+  height, width = img.shape[:2]
+  shifted[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = (
+    img[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)])
+  return shifted
+
+NEIGHBOURS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+def poisson_system(mask):
+  """ Factorize the Poisson system whose unknowns are the masked pixels.
+  Each unknown has 4 on the diagonal and -1 for each masked 4-neighbour.
+  Factorizations are cached by mask content, so blending the same mask
+  again (e.g. all 3 channels or consecutive frames) skips this step.
+
+  :param mask: 2D boolean mask of pixels to be solved
+  :returns: (ys, xs, solve) where solve(b) returns the unknowns for
+    b of shape (*n*,) or (*n*, channels)
+  """
+  key = (mask.shape, hashlib.sha1(np.packbits(mask)).hexdigest())
+  if key in _poisson_cache:
+    _poisson_cache.move_to_end(key)
+    return _poisson_cache[key]
+
+  ys, xs = np.nonzero(mask)
+  num_unknowns = len(ys)
+  # Index of every unknown, padded with -1 for pixels that are not solved
+  index_map = np.full((mask.shape[0] + 2, mask.shape[1] + 2), -1, np.int64)
+  index_map[ys + 1, xs + 1] = np.arange(num_unknowns)
+
+  rows = [np.arange(num_unknowns)]
+  cols = [np.arange(num_unknowns)]
+  vals = [np.full(num_unknowns, 4.0)]
+  for dy, dx in NEIGHBOURS:
+    neighbour = index_map[ys + 1 + dy, xs + 1 + dx]
+    linked = neighbour >= 0
+    rows.append(rows[0][linked])
+    cols.append(neighbour[linked])
+    vals.append(np.full(np.count_nonzero(linked), -1.0))
+
+  coff_mat = scipy.sparse.csc_matrix(
+    (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+    shape=(num_unknowns, num_unknowns))
+  system = (ys, xs, scipy.sparse.linalg.splu(coff_mat).solve)
+
+  _poisson_cache[key] = system
+  if len(_poisson_cache) > POISSON_CACHE_SIZE:
+    _poisson_cache.popitem(last=False)
+  return system
+
+def laplacian(img):
+  """ 4-neighbour Laplacian with zeros outside the image """
+  lap = 4 * img
+  for dy, dx in NEIGHBOURS:
+    lap -= shift(img, dy, dx)
+  return lap
+
+@instrument.timed('poisson')
 def poisson_blend(img_source, dest_img, img_mask, offset=(0, 0)):
-  # http://opencv.jp/opencv2-x-samples/poisson-blending
+  """ Seamlessly clone the masked source pixels onto the destination image
+  by solving the Poisson equation for the masked pixels only
+  http://opencv.jp/opencv2-x-samples/poisson-blending
+
+  :param img_source: source image
+  :param dest_img: destination image
+  :param img_mask: [0-255] values in mask of source pixels to be blended
+  :param offset: (y, x) offset of the source within the destination
+  :returns: new blended image
+  """
   img_target = np.copy(dest_img)
-  import pyamg
   # compute regions to be blended
   region_source = (
     max(-offset[0], 0),
@@ -75,59 +222,28 @@ def poisson_blend(img_source, dest_img, img_mask, offset=(0, 0)):
     max(offset[1], 0),
     min(img_target.shape[0], img_source.shape[0] + offset[0]),
     min(img_target.shape[1], img_source.shape[1] + offset[1]))
-  region_size = (region_source[2] - region_source[0],
-                 region_source[3] - region_source[1])
 
   # clip and normalize mask image
-  img_mask = img_mask[region_source[0]:region_source[2],
-                      region_source[1]:region_source[3]]
-
-  # create coefficient matrix
-  coff_mat = scipy.sparse.identity(np.prod(region_size), format='lil')
-  for y in range(region_size[0]):
-    for x in range(region_size[1]):
-      if img_mask[y, x]:
-        index = x + y * region_size[1]
-        coff_mat[index, index] = 4
-        if index + 1 < np.prod(region_size):
-          coff_mat[index, index + 1] = -1
-        if index - 1 >= 0:
-          coff_mat[index, index - 1] = -1
-        if index + region_size[1] < np.prod(region_size):
-          coff_mat[index, index + region_size[1]] = -1
-        if index - region_size[1] >= 0:
-          coff_mat[index, index - region_size[1]] = -1
-  coff_mat = coff_mat.tocsr()
-
-  # create poisson matrix for b
-  poisson_mat = pyamg.gallery.poisson(img_mask.shape)
-  # for each layer (ex. RGB)
-  for num_layer in range(img_target.shape[2]):
-    # get subimages
-    t = img_target[region_target[0]:region_target[2],
-                   region_target[1]:region_target[3], num_layer]
-    s = img_source[region_source[0]:region_source[2],
-                   region_source[1]:region_source[3], num_layer]
-    t = t.flatten()
-    s = s.flatten()
-
-    # create b
-    b = poisson_mat * s
-    for y in range(region_size[0]):
-      for x in range(region_size[1]):
-        if not img_mask[y, x]:
-          index = x + y * region_size[1]
-          b[index] = t[index]
-
-    # solve Ax = b
-    x = pyamg.solve(coff_mat, b, verb=False, tol=1e-10)
-
-    # assign x to target image
-    x = np.reshape(x, region_size)
-    x[x > 255] = 255
-    x[x < 0] = 0
-    x = np.array(x, img_target.dtype)
-    img_target[region_target[0]:region_target[2],
-               region_target[1]:region_target[3], num_layer] = x
+  mask = img_mask[region_source[0]:region_source[2],
+                  region_source[1]:region_source[3]] > 0
+  if not mask.any():
+    return img_target
+
+  num_chans = img_target.shape[2]
+  t = img_target[region_target[0]:region_target[2],
+                 region_target[1]:region_target[3]].astype(np.float64)
+  s = img_source[region_source[0]:region_source[2],
+                 region_source[1]:region_source[3], :num_chans].astype(np.float64)
+
+  # b = source gradients plus the known target values bordering the mask
+  ys, xs, solve = poisson_system(mask)
+  known = np.where(mask[..., None], 0, t)
+  b = laplacian(s) + 4 * known - laplacian(known)
+
+  # solve Ax = b for all channels with one factorization
+  x = solve(b[ys, xs])
+  t[ys, xs] = x
+  img_target[region_target[0]:region_target[2],
+             region_target[1]:region_target[3]] = np.clip(t, 0, 255)
 
   return img_target
@@ -0,0 +1,183 @@
+"""
+::
+
+  Persistent landmark cache keyed by image content
+
+  Usage:
+    cache.py warm --cache=<filename> --images=<folder> [--workers=<num>]
+    cache.py info --cache=<filename>
+    cache.py invalidate --cache=<filename> [--images=<folder>]
+
+  Options:
+    -h, --help            Show this screen.
+    --cache=<filename>    SQLite file of cached face points
+    --images=<folder>     Folder to images (.jpg, .jpeg, .png)
+    --workers=<num>       Number of processes to find faces [default: 1]
+    --version             Show version.
+"""
+from docopt import docopt
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+
+from facemorpher import locator
+from facemorpher import loader
+from facemorpher import instrument
+
+DEFAULT_MAX_ENTRIES = 100000
+
+class LandmarkCache(object):
+  """ SQLite store of face points keyed by a hash of the image file
+  and the detector configuration. Images without a face are cached too,
+  as an empty array. Least recently used entries are evicted once the
+  cache holds more than max_entries images.
+
+  The database connection is opened lazily, so a cache can be pickled
+  and shared with worker processes.
+  """
+  def __init__(self, filename, max_entries=DEFAULT_MAX_ENTRIES, config=None):
+    """
+    :param filename: SQLite database filepath
+    :param max_entries: maximum number of cached images
+    :param config: detector configuration. Defaults to
+      :func:`facemorpher.locator.detector_config`
+    """
+    self.filename = filename
+    self.max_entries = max_entries
+    self.config = config or locator.detector_config()
+    self._connection = None
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state['_connection'] = None
+    return state
+
+  @property
+  def connection(self):
+    if self._connection is None:
+      self._connection = sqlite3.connect(self.filename, timeout=60)
+      self._connection.execute('PRAGMA journal_mode=WAL')
+      self._connection.execute(
+        'CREATE TABLE IF NOT EXISTS landmarks ('
+        'key TEXT PRIMARY KEY, points BLOB, num_points INTEGER, accessed REAL)')
+      self._connection.execute(
+        'CREATE INDEX IF NOT EXISTS landmarks_accessed ON landmarks (accessed)')
+    return self._connection
+
+  def close(self):
+    if self._connection is not None:
+      self._connection.close()
+      self._connection = None
+
+  def key(self, path):
+    """ Hash of the image file content and the detector configuration """
+    sha = hashlib.sha1(self.config.encode('utf-8'))
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+  def get(self, key):
+    """
+    :returns: *m* x 2 array of face points, an empty array if the image
+      has no face or None if the image is not cached
+    """
+    with self.connection as conn:
+      row = conn.execute('SELECT points, num_points FROM landmarks WHERE key = ?',
+                         (key,)).fetchone()
+      if row is None:
+        return None
+      conn.execute('UPDATE landmarks SET accessed = ? WHERE key = ?', (time.time(), key))
+    points, num_points = row
+    return np.frombuffer(points, np.int32).reshape(num_points, 2).copy()
+
+  def put(self, key, points):
+    points = np.asarray(points, np.int32).reshape(-1, 2)
+    with self.connection as conn:
+      conn.execute('INSERT OR REPLACE INTO landmarks VALUES (?, ?, ?, ?)',
+                   (key, points.tobytes(), len(points), time.time()))
+      self.evict(conn)
+
+  def evict(self, conn):
+    excess = len(self) - self.max_entries
+    if excess > 0:
+      conn.execute('DELETE FROM landmarks WHERE key IN ('
+                   'SELECT key FROM landmarks ORDER BY accessed LIMIT ?)', (excess,))
+
+  def invalidate(self, paths=None):
+    """ Remove the supplied image paths from the cache, or every entry if None """
+    with self.connection as conn:
+      if paths is None:
+        conn.execute('DELETE FROM landmarks')
+      else:
+        conn.executemany('DELETE FROM landmarks WHERE key = ?',
+                         [(self.key(path),) for path in paths])
+
+  def __len__(self):
+    return self.connection.execute('SELECT COUNT(*) FROM landmarks').fetchone()[0]
+
+  def info(self):
+    """ :returns: dict of entry counts and database size """
+    num_faces = self.connection.execute(
+      'SELECT COUNT(*) FROM landmarks WHERE num_points > 0').fetchone()[0]
+    num_entries = len(self)
+    return {'filename': self.filename,
+            'entries': num_entries,
+            'faces': num_faces,
+            'no_faces': num_entries - num_faces,
+            'max_entries': self.max_entries,
+            'bytes': os.path.getsize(self.filename)}
+
+  def face_points(self, path, decode=True):
+    """ Face points of the image file, located only on a cache miss
+
+    :param path: image filepath
+    :param decode: always return the decoded image
+    :returns: (img, points). img is None if decode is False and the points
+      were cached. points is empty if no face was found
+    """
+    key = self.key(path)
+    points = self.get(key)
+    img = None
+    if points is None:
+      instrument.count('cache_misses')
+      img = loader.read_image(path)
+      points = locator.face_points(img)
+      self.put(key, points)
+    else:
+      instrument.count('cache_hits')
+      if decode:
+        img = loader.read_image(path)
+    return img, np.asarray(points, np.int32).reshape(-1, 2)
+
+def open_cache(cache):
+  """ :param cache: None, a :class:`LandmarkCache` or a cache filepath """
+  if cache is None or isinstance(cache, LandmarkCache):
+    return cache
+  return LandmarkCache(cache)
+
+def main():
+  args = docopt(__doc__, version='Face Landmark Cache 1.0')
+  cache = LandmarkCache(args['--cache'])
+
+  if args['warm']:
+    from facemorpher.morpher import list_imgpaths
+    imgpaths = list_imgpaths(args['--images'])
+    num_faces = len(list(loader.iter_raw_points(imgpaths, int(args['--workers']), cache)))
+    print('Cached {} faces'.format(num_faces))
+  elif args['invalidate']:
+    if args['--images'] is None:
+      cache.invalidate()
+    else:
+      from facemorpher.morpher import list_imgpaths
+      cache.invalidate(list(list_imgpaths(args['--images'])))
+
+  for name, value in sorted(cache.info().items()):
+    print('{}: {}'.format(name, value))
+  cache.close()
+
+
+if __name__ == "__main__":
+  main()
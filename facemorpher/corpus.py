@@ -0,0 +1,176 @@
+"""
+::
+
+  Aligned face corpus. Faces are located and aligned once, and saved as
+  one memory-mapped array, so averages and morphs over the corpus read the
+  aligned crops straight from disk without decoding or detection
+
+  Usage:
+    corpus.py build --corpus=<folder> --images=<folder>
+              [--width=<width>] [--height=<height>] [--workers=<num>] [--cache=<filename>]
+    corpus.py info --corpus=<folder> [--subset=<selector>]
+
+  Options:
+    -h, --help             Show this screen.
+    --corpus=<folder>      Folder of the corpus files
+    --images=<folder>      Folder to images (.jpg, .jpeg, .png)
+    --width=<width>        Width of the aligned faces [default: 500]
+    --height=<height>      Height of the aligned faces [default: 600]
+    --workers=<num>        Number of processes to load images and find faces [default: 1]
+    --cache=<filename>     SQLite file to cache face points across runs
+    --subset=<selector>    Faces to use: a start:stop[:step] slice, comma separated indices or a path pattern
+    --version              Show version.
+"""
+from docopt import docopt
+import fnmatch
+import json
+import os
+import re
+import numpy as np
+
+from facemorpher import loader
+from facemorpher import cache as cache_module
+
+CORPUS_VERSION = 1
+IMAGES_FILENAME = 'images.npy'
+POINTS_FILENAME = 'points.npy'
+INDEX_FILENAME = 'index.json'
+
+class Corpus(object):
+  """ Aligned faces of a folder written by :func:`build_corpus`.
+
+  images is an *n* x height x width x 3 uint8 memory map, so a face is only
+  read from disk when it is used. points is the *n* x *m* x 2 array of the
+  aligned face points and paths the source image of each face.
+  """
+  def __init__(self, folder):
+    """ :param folder: corpus folder """
+    with open(os.path.join(folder, INDEX_FILENAME)) as f:
+      index = json.load(f)
+    if index['version'] != CORPUS_VERSION:
+      raise ValueError('Unsupported corpus version %s in %s' % (index['version'], folder))
+    self.folder = folder
+    self.size = tuple(index['size'])
+    self.paths = index['paths']
+    self.images = np.load(os.path.join(folder, IMAGES_FILENAME), mmap_mode='r')
+    self.points = np.load(os.path.join(folder, POINTS_FILENAME))
+
+  def __len__(self):
+    return len(self.paths)
+
+  def select(self, subset=None):
+    """ Indices of the faces in a subset, see :func:`select` """
+    return select(self.paths, subset)
+
+  def iter_image_points(self, subset=None):
+    """ Faces of a subset, like :func:`facemorpher.loader.iter_image_points`.
+    Images are read-only views of the memory map
+
+    :returns: generator of (path, aligned_img, aligned_points)
+    """
+    for i in self.select(subset):
+      yield self.paths[i], self.images[i], np.array(self.points[i])
+
+def select(paths, subset=None):
+  """ Indices of a subset of paths
+
+  :param paths: list of image paths
+  :param subset: None for every path, a slice, a boolean mask, a sequence of
+    indices or paths, a function of a path or a string parsed by :func:`parse_subset`
+  :returns: array of indices, in subset order
+  """
+  if subset is None:
+    return np.arange(len(paths))
+  if isinstance(subset, str):
+    subset = parse_subset(subset)
+  if isinstance(subset, slice):
+    return np.arange(len(paths))[subset]
+  if callable(subset):
+    return np.array([i for i, path in enumerate(paths) if subset(path)], np.intp)
+
+  subset = list(subset)
+  if len(subset) > 0 and isinstance(subset[0], str):
+    positions = {path: i for i, path in enumerate(paths)}
+    return np.array([positions[path] for path in subset], np.intp)
+  subset = np.asarray(subset)
+  if subset.dtype == bool:
+    return np.flatnonzero(subset)
+  return subset.astype(np.intp)
+
+def parse_subset(text):
+  """ Subset of a command line selector: a start:stop[:step] slice,
+  comma separated indices or a path pattern such as '*smiling*' """
+  if re.match(r'^-?\d*:-?\d*(:-?\d*)?$', text):
+    return slice(*[int(part) if part else None for part in text.split(':')])
+  if re.match(r'^\d+(,\d+)*$', text):
+    return [int(part) for part in text.split(',')]
+  return lambda path: fnmatch.fnmatch(path, text)
+
+def build_corpus(imgpaths, folder, size=(600, 500), workers=1, cache=None):
+  """ Locate, align and write the faces of images to a corpus folder.
+  Images without a face are skipped
+
+  :param imgpaths: array or generator of image paths
+  :param folder: corpus folder. Existing corpus files are replaced
+  :param size: (height, width) of the aligned faces
+  :param workers: number of processes that load images and locate face points
+  :param cache: landmark cache filepath or :class:`facemorpher.cache.LandmarkCache`
+  :returns: :class:`Corpus`
+  """
+  cache = cache_module.open_cache(cache)
+  index_filename = os.path.join(folder, INDEX_FILENAME)
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+  elif os.path.exists(index_filename):
+    os.remove(index_filename)
+
+  # Face points first, so the image array is allocated once at its final size
+  path_points = list(loader.iter_raw_points(imgpaths, workers, cache))
+  if len(path_points) == 0:
+    raise FileNotFoundError('Could not find any faces to build a corpus from')
+  images_filename = os.path.join(folder, IMAGES_FILENAME)
+  points_filename = os.path.join(folder, POINTS_FILENAME)
+  images = np.lib.format.open_memmap(images_filename + '.tmp', mode='w+', dtype=np.uint8,
+                                     shape=(len(path_points),) + tuple(size) + (3,))
+  points = []
+  for i, (img, aligned_points) in enumerate(loader.iter_aligned(path_points, size, workers)):
+    images[i] = img
+    points.append(aligned_points)
+  images.flush()
+  del images
+
+  with open(points_filename + '.tmp', 'wb') as f:
+    np.save(f, np.array(points, np.int32).reshape(len(path_points), -1, 2))
+  os.replace(images_filename + '.tmp', images_filename)
+  os.replace(points_filename + '.tmp', points_filename)
+  # The index is written last, so a folder with an index is a complete corpus
+  with open(index_filename, 'w') as f:
+    json.dump({'version': CORPUS_VERSION, 'size': list(size),
+               'paths': [path for path, _ in path_points]}, f, indent=1)
+  return Corpus(folder)
+
+def open_corpus(corpus):
+  """ :class:`Corpus` of a folder, or the corpus itself """
+  if corpus is None or isinstance(corpus, Corpus):
+    return corpus
+  return Corpus(corpus)
+
+def main():
+  args = docopt(__doc__, version='Face Corpus 1.0')
+  if args['build']:
+    from facemorpher.morpher import list_imgpaths
+    corpus = build_corpus(list_imgpaths(args['--images']), args['--corpus'],
+                          (int(args['--height']), int(args['--width'])),
+                          int(args['--workers']), args['--cache'])
+    print('Built a corpus of {} faces in {}'.format(len(corpus), args['--corpus']))
+  else:
+    corpus = Corpus(args['--corpus'])
+
+  print('faces: {}'.format(len(corpus)))
+  print('size: {}x{}'.format(corpus.size[1], corpus.size[0]))
+  if args['--subset'] is not None:
+    print('subset: {}'.format(len(corpus.select(args['--subset']))))
+
+
+if __name__ == "__main__":
+  main()
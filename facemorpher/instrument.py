@@ -0,0 +1,224 @@
+"""
+Per-stage timers and counters
+
+Instrumentation is off by default, and a disabled stage costs one flag
+check. :func:`enable` it, time stages with ``with stage('warp'):`` or the
+:func:`timed` decorator, count events with :func:`count`, and :func:`report`
+the totals to sinks. Stages that run in worker processes are not counted.
+"""
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from functools import wraps
+
+_enabled = False
+_lock = threading.Lock()
+_started = time.perf_counter()
+# Stage name -> [calls, total seconds, max seconds]
+_stages = {}
+_counters = {}
+
+def enable(on=True):
+  """ Turn instrumentation on or off. Totals are kept until :func:`reset` """
+  global _enabled
+  _enabled = on
+
+def is_enabled():
+  return _enabled
+
+def reset():
+  """ Clear all totals and restart the elapsed time """
+  global _started
+  with _lock:
+    _stages.clear()
+    _counters.clear()
+    _started = time.perf_counter()
+
+def record(name, seconds):
+  """ Add one call of a stage that took seconds """
+  with _lock:
+    stats = _stages.get(name)
+    if stats is None:
+      stats = _stages[name] = [0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] = max(stats[2], seconds)
+
+def count(name, value=1):
+  """ Add value to a counter """
+  if _enabled:
+    with _lock:
+      _counters[name] = _counters.get(name, 0) + value
+
+class _Timer(object):
+  __slots__ = ('name', 'start')
+
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    record(self.name, time.perf_counter() - self.start)
+    return False
+
+class _NullTimer(object):
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+_NULL_TIMER = _NullTimer()
+
+def stage(name):
+  """ Context manager that times a stage while instrumentation is enabled """
+  if _enabled:
+    return _Timer(name)
+  return _NULL_TIMER
+
+def timed(name):
+  """ Decorator that times every call of a function as a stage """
+  def decorate(func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+      if not _enabled:
+        return func(*args, **kwargs)
+      with _Timer(name):
+        return func(*args, **kwargs)
+    return inner
+  return decorate
+
+def snapshot():
+  """ Copy of the current totals
+
+  :returns: dict of elapsed_seconds, stages (name -> calls, seconds,
+    max_seconds) and counters (name -> value)
+  """
+  with _lock:
+    return {
+      'elapsed_seconds': time.perf_counter() - _started,
+      'stages': {name: {'calls': calls, 'seconds': seconds, 'max_seconds': max_seconds}
+                 for name, (calls, seconds, max_seconds) in _stages.items()},
+      'counters': dict(_counters),
+    }
+
+def report(*sinks):
+  """ Write the current totals to every sink
+
+  :param sinks: objects with a write(snapshot) method
+  :returns: the snapshot that was written
+  """
+  totals = snapshot()
+  for sink in sinks:
+    sink.write(totals)
+  return totals
+
+@contextlib.contextmanager
+def profiling(*sinks):
+  """ Count a block from zero, then report it to sinks """
+  was_enabled = _enabled
+  reset()
+  enable()
+  try:
+    yield
+  finally:
+    enable(was_enabled)
+    report(*sinks)
+
+class TableSink(object):
+  """ Per-stage breakdown table, slowest stage first """
+  def __init__(self, stream=None):
+    """ :param stream: file object. Defaults to sys.stdout """
+    self.stream = stream
+
+  def write(self, totals):
+    stream = self.stream or sys.stdout
+    elapsed = totals['elapsed_seconds']
+    stages = sorted(totals['stages'].items(), key=lambda item: -item[1]['seconds'])
+    rows = [(name, stats['calls'], stats['seconds'], 1000 * stats['seconds'] / stats['calls'])
+            for name, stats in stages]
+    # Stages overlap when the video is encoded on its own thread
+    other = elapsed - sum(stats['seconds'] for _, stats in stages)
+    if other > 0:
+      rows.append(('other', '', other, None))
+
+    stream.write('{:<14} {:>8} {:>10} {:>10} {:>7}\n'.format(
+      'stage', 'calls', 'total s', 'mean ms', 'share'))
+    for name, calls, seconds, mean_ms in rows:
+      stream.write('{:<14} {:>8} {:10.3f} {:>10} {:6.1f}%\n'.format(
+        name, calls, seconds, '' if mean_ms is None else '%.2f' % mean_ms,
+        100 * seconds / elapsed if elapsed else 0))
+    stream.write('{:<14} {:>8} {:10.3f}\n'.format('elapsed', '', elapsed))
+    for name, value in sorted(totals['counters'].items()):
+      stream.write('{:<14} {:>8} {:10.1f}/s\n'.format(
+        name, value, value / elapsed if elapsed else 0))
+
+class LogSink(object):
+  """ One log record per stage and counter """
+  def __init__(self, logger=None, level=logging.INFO):
+    self.logger = logger or logging.getLogger('facemorpher')
+    self.level = level
+
+  def write(self, totals):
+    for name, stats in sorted(totals['stages'].items()):
+      self.logger.log(self.level, 'stage %s: %d calls, %.3f s total, %.3f s max',
+                      name, stats['calls'], stats['seconds'], stats['max_seconds'])
+    for name, value in sorted(totals['counters'].items()):
+      self.logger.log(self.level, 'counter %s: %s', name, value)
+
+class JsonLinesSink(object):
+  """ Appends every report as one JSON line with a unix timestamp """
+  def __init__(self, filename):
+    self.filename = filename
+
+  def write(self, totals):
+    with open(self.filename, 'a') as f:
+      f.write(json.dumps(dict(totals, time=time.time()), sort_keys=True) + '\n')
+
+def prometheus_text(totals, prefix='facemorpher'):
+  """ Totals in the Prometheus text exposition format """
+  lines = []
+  def metric(name, kind, help_text, samples):
+    lines.append('# HELP %s_%s %s' % (prefix, name, help_text))
+    lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+    for labels, value in samples:
+      lines.append('%s_%s%s %r' % (prefix, name, labels, value))
+
+  stages = sorted(totals['stages'].items())
+  metric('stage_seconds_total', 'counter', 'Time spent in each stage',
+         [('{stage="%s"}' % name, stats['seconds']) for name, stats in stages])
+  metric('stage_calls_total', 'counter', 'Calls of each stage',
+         [('{stage="%s"}' % name, stats['calls']) for name, stats in stages])
+  metric('stage_max_seconds', 'gauge', 'Slowest call of each stage',
+         [('{stage="%s"}' % name, stats['max_seconds']) for name, stats in stages])
+  for name, value in sorted(totals['counters'].items()):
+    metric('%s_total' % name, 'counter', 'Number of %s' % name.replace('_', ' '),
+           [('', value)])
+  return '\n'.join(lines) + '\n'
+
+class PrometheusSink(object):
+  """ Prometheus text dump, e.g. for the node exporter textfile collector """
+  def __init__(self, filename=None, prefix='facemorpher'):
+    """ :param filename: file replaced on every report. Defaults to sys.stdout """
+    self.filename = filename
+    self.prefix = prefix
+
+  def write(self, totals):
+    text = prometheus_text(totals, self.prefix)
+    if self.filename is None:
+      sys.stdout.write(text)
+    else:
+      # Replace atomically so a collector never reads a partial file
+      tmp_filename = self.filename + '.tmp'
+      with open(tmp_filename, 'w') as f:
+        f.write(text)
+      os.replace(tmp_filename, self.filename)
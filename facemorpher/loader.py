@@ -0,0 +1,158 @@
+"""
+Load images and locate their face points, optionally in worker processes
+"""
+from functools import partial
+import cv2
+
+from facemorpher import locator
+from facemorpher import aligner
+from facemorpher import instrument
+from facemorpher.parallel import imap_ordered
+
+@instrument.timed('decode')
+def read_image(path):
+  return cv2.imread(path)
+
+def read_face_points(path, cache=None, decode=True):
+  """ Read an image and locate its face points, through the cache if supplied
+
+  :param path: image filepath
+  :param cache: optional :class:`facemorpher.cache.LandmarkCache`
+  :param decode: always return the decoded image
+  :returns: (img, points). img may be None if decode is False
+  """
+  if cache is not None:
+    return cache.face_points(path, decode)
+  img = read_image(path)
+  return img, locator.face_points(img)
+
+def locate_image_points(path, size, cache=None):
+  """ Read an image, locate its face points and align it to the given size
+
+  :param path: image filepath
+  :param size: (height, width) tuple of the aligned image
+  :param cache: optional :class:`facemorpher.cache.LandmarkCache`
+  :returns: (aligned_img, aligned_points) or (None, None) if no face was found
+  """
+  img, points = read_face_points(path, cache)
+
+  if len(points) == 0:
+    return None, None
+  else:
+    return aligner.resize_align(img, points, size)
+
+def load_image_points(path, size, cache=None):
+  img, points = locate_image_points(path, size, cache)
+  if img is None:
+    print('No face in %s' % path)
+    instrument.count('no_face')
+  return img, points
+
+def locate_raw_points(path, cache=None):
+  """ Locate face points on the original image without aligning it
+
+  :param path: image filepath
+  :param cache: optional :class:`facemorpher.cache.LandmarkCache`
+  :returns: *m* x 2 array of face points or None if no face was found
+  """
+  _, points = read_face_points(path, cache, decode=False)
+  return points if len(points) > 0 else None
+
+def load_aligned(path_points, size):
+  """ Read an image and align it with previously located face points
+
+  :param path_points: (path, points) tuple of raw face points
+  :param size: (height, width) tuple of the aligned image
+  :returns: (aligned_img, aligned_points)
+  """
+  path, points = path_points
+  return aligner.resize_align(read_image(path), points.copy(), size)
+
+def locate_source_points(path, size, cache=None):
+  """ Read an image and locate its face points, for warping it directly
+  into the aligned frame (see :func:`facemorpher.aligner.fused_source`)
+
+  :returns: (img, src_points, matrix) or (None, None, None) if no face was found
+  """
+  img, points = read_face_points(path, cache)
+  if len(points) == 0:
+    return None, None, None
+  return aligner.fused_source(img, points, size)
+
+def load_source(path_points, size):
+  """ Read an image whose face points were already located, for warping it
+  directly into the aligned frame
+
+  :param path_points: (path, points) tuple of raw face points
+  :returns: (img, src_points, matrix)
+  """
+  path, points = path_points
+  return aligner.fused_source(read_image(path), points, size)
+
+def iter_image_points(imgpaths, size, workers=1, cache=None):
+  """ Load and align every image, skipping (and reporting) images without a face
+
+  :param imgpaths: array or generator of image paths
+  :param size: (height, width) tuple of the aligned images
+  :param workers: number of worker processes
+  :param cache: optional :class:`facemorpher.cache.LandmarkCache`
+  :returns: generator of (path, aligned_img, aligned_points) in input order
+  """
+  imgpaths = list(imgpaths)
+  results = imap_ordered(partial(locate_image_points, size=size, cache=cache),
+                         imgpaths, workers)
+  for path, (img, points) in zip(imgpaths, results):
+    if img is None:
+      print('No face in %s' % path)
+      instrument.count('no_face')
+    else:
+      yield path, img, points
+
+def iter_raw_points(imgpaths, workers=1, cache=None):
+  """ Locate face points of every image without keeping any pixels
+
+  :param imgpaths: array or generator of image paths
+  :param workers: number of worker processes
+  :param cache: optional :class:`facemorpher.cache.LandmarkCache`
+  :returns: generator of (path, raw_points) in input order
+  """
+  imgpaths = list(imgpaths)
+  results = imap_ordered(partial(locate_raw_points, cache=cache), imgpaths, workers)
+  for path, points in zip(imgpaths, results):
+    if points is None:
+      print('No face in %s' % path)
+      instrument.count('no_face')
+    else:
+      yield path, points
+
+def iter_aligned(path_points, size, workers=1):
+  """ Read and align images whose face points were already located
+
+  :param path_points: array of (path, raw_points) tuples
+  :param size: (height, width) tuple of the aligned images
+  :param workers: number of worker processes
+  :returns: generator of (aligned_img, aligned_points) in input order
+  """
+  return imap_ordered(partial(load_aligned, size=size), path_points, workers)
+
+def iter_source_points(imgpaths, size, workers=1, cache=None):
+  """ Like :func:`iter_image_points`, but without resizing or cropping
+
+  :returns: generator of (path, img, src_points, matrix) in input order
+  """
+  imgpaths = list(imgpaths)
+  results = imap_ordered(partial(locate_source_points, size=size, cache=cache),
+                         imgpaths, workers)
+  for path, (img, src_points, matrix) in zip(imgpaths, results):
+    if img is None:
+      print('No face in %s' % path)
+      instrument.count('no_face')
+    else:
+      yield path, img, src_points, matrix
+
+def iter_sources(path_points, size, workers=1):
+  """ Like :func:`iter_aligned`, but without resizing or cropping
+
+  :returns: generator of (img, src_points, matrix) in input order
+  """
+  return imap_ordered(partial(load_source, size=size), path_points, workers)
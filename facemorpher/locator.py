@@ -5,16 +5,75 @@ Locate face points
 import cv2
 import numpy as np
 import os.path as path
-import dlib
 import os
+import threading
 
+from facemorpher import instrument
 
 DATA_DIR = os.environ.get(
   'DLIB_DATA_DIR',
   path.join(path.dirname(path.dirname(path.realpath(__file__))), 'data')
 )
-dlib_detector = dlib.get_frontal_face_detector()
-dlib_predictor = dlib.shape_predictor(path.join(DATA_DIR, 'shape_predictor_68_face_landmarks.dat'))
+PREDICTOR_FILENAME = 'shape_predictor_68_face_landmarks.dat'
+# Detect faces on a copy downscaled to this max side. None detects at full size,
+# as does an unset, empty or 0 DLIB_DETECT_MAX_SIDE
+DETECT_MAX_SIDE = int(os.environ.get('DLIB_DETECT_MAX_SIDE', '').strip() or 0) or None
+
+# dlib and its ~100MB predictor model are only loaded on first use
+_models_lock = threading.Lock()
+_models = {'detector': None, 'predictor': None}
+
+def _load_detector():
+  import dlib
+  return dlib.get_frontal_face_detector()
+
+def _load_predictor():
+  import dlib
+  filepath = path.join(DATA_DIR, PREDICTOR_FILENAME)
+  if not path.isfile(filepath):
+    raise FileNotFoundError(
+      '%s not found. Download http://dlib.net/files/%s.bz2 and set DLIB_DATA_DIR'
+      % (filepath, PREDICTOR_FILENAME))
+  return dlib.shape_predictor(filepath)
+
+def _get_model(name, load):
+  model = _models[name]
+  if model is None:
+    with _models_lock:
+      model = _models[name]
+      if model is None:
+        model = _models[name] = load()
+  return model
+
+def get_detector():
+  """ dlib frontal face detector, created on first call """
+  return _get_model('detector', _load_detector)
+
+def get_predictor():
+  """ dlib 68 point shape predictor, loaded from DLIB_DATA_DIR on first call """
+  return _get_model('predictor', _load_predictor)
+
+def set_models(detector=None, predictor=None):
+  """ Inject a face detector and/or shape predictor instead of loading dlib's.
+  They must be callable like dlib's: detector(img, upsample) returns
+  rectangles and predictor(img, rect) returns a shape with part(i).x/.y
+
+  :param detector: face detector. None leaves the current one unchanged
+  :param predictor: shape predictor. None leaves the current one unchanged
+  """
+  with _models_lock:
+    if detector is not None:
+      _models['detector'] = detector
+    if predictor is not None:
+      _models['predictor'] = predictor
+
+def __getattr__(name):
+  # Backwards compatible module attributes, loaded lazily
+  if name == 'dlib_detector':
+    return get_detector()
+  if name == 'dlib_predictor':
+    return get_predictor()
+  raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 def boundary_points(points, width_percent=0.1, height_percent=0.1):
   """ Produce additional boundary points
@@ -30,35 +89,158 @@ def boundary_points(points, width_percent=0.1, height_percent=0.1):
           [x+w-spacerw, y+spacerh]]
 
 
-def face_points(img, add_boundary_points=True):
-  return face_points_dlib(img, add_boundary_points)
+def face_points(img, add_boundary_points=True, detect_max_side=None):
+  return face_points_dlib(img, add_boundary_points, detect_max_side)
+
+def detector_config(add_boundary_points=True, detect_max_side=None):
+  """ Identifies the detector settings that produce the face points.
+  Landmarks cached under one config are not valid for another.
+  """
+  return 'dlib-hog:upsample=1:%s:boundary=%d:max_side=%s' % (
+    PREDICTOR_FILENAME, add_boundary_points, resolve_max_side(detect_max_side))
+
+def resolve_max_side(max_side=None):
+  """ Proxy max side to detect on: DETECT_MAX_SIDE if max_side is None,
+  and None for full resolution if max_side is 0 """
+  if max_side is None:
+    return DETECT_MAX_SIDE
+  return max_side or None
+
+def detection_proxy(rgbimg, max_side=None):
+  """ Downscale the image so its longest side is at most max_side
+
+  :param rgbimg: an image array
+  :param max_side: maximum side of the proxy. Defaults to DETECT_MAX_SIDE,
+    0 keeps the full resolution
+  :returns: (proxy_img, scale). scale is 1 if the image is small enough
+  """
+  max_side = resolve_max_side(max_side)
+  height, width = rgbimg.shape[:2]
+  if max_side is None or max(height, width) <= max_side:
+    return rgbimg, 1.0
+  scale = max_side / float(max(height, width))
+  proxy = cv2.resize(rgbimg, (int(round(width * scale)), int(round(height * scale))),
+                     interpolation=cv2.INTER_AREA)
+  return proxy, scale
+
+def scale_rect(rect, scale):
+  """ Rectangle of a detection, mapped from a proxy back to the original image """
+  # CNN detections wrap their rectangle with a confidence
+  rect = getattr(rect, 'rect', rect)
+  if scale == 1:
+    return rect
+  return type(rect)(int(round(rect.left() / scale)), int(round(rect.top() / scale)),
+                    int(round(rect.right() / scale)), int(round(rect.bottom() / scale)))
+
+@instrument.timed('detect')
+def detect(detector, rgbimg, max_side=None):
+  """ Detect faces on a downscaled proxy, in original image coordinates """
+  proxy, scale = detection_proxy(rgbimg, max_side)
+  return [scale_rect(rect, scale) for rect in detector(proxy, 1)]
+
+@instrument.timed('predict')
+def predict_points(predictor, rgbimg, rect, add_boundary_points=True):
+  """ Face points of the face in rect, see :func:`shape_points` """
+  return shape_points(predictor(rgbimg, rect), add_boundary_points)
+
+def shape_points(shape, add_boundary_points=True):
+  """ Face points of a dlib full_object_detection
+
+  :param shape: predicted shape with 68 parts
+  :param add_boundary_points: bool to add additional boundary points
+  :returns: Array of x,y face points
+  """
+  points = np.array([(shape.part(i).x, shape.part(i).y) for i in range(68)], np.int32)
+
+  if add_boundary_points:
+    # Add more points inwards and upwards as dlib only detects up to eyebrows
+    points = np.vstack([
+      points,
+      boundary_points(points, 0.1, -0.03),
+      boundary_points(points, 0.13, -0.05),
+      boundary_points(points, 0.15, -0.08),
+      boundary_points(points, 0.33, -0.12)])
+
+  return points
+
+@instrument.timed('detect')
+def detect_faces(detector, rgbimgs, max_side=None):
+  """ Run the detector on a list of RGB images, as one batch when the
+  detector supports it (dlib's CNN detector on equally sized images)
+
+  :param max_side: detect on proxies downscaled to this max side
+  :returns: list of face rectangles for every image, in original coordinates
+  """
+  proxies, scales = zip(*[detection_proxy(rgbimg, max_side) for rgbimg in rgbimgs])
+  if len(proxies) > 1 and is_batch_detector(detector) and \
+     len(set(proxy.shape for proxy in proxies)) == 1:
+    batch_rects = detector(list(proxies), 1)
+  else:
+    batch_rects = [detector(proxy, 1) for proxy in proxies]
+  return [[scale_rect(rect, scale) for rect in rects]
+          for rects, scale in zip(batch_rects, scales)]
+
+def is_batch_detector(detector):
+  try:
+    import dlib
+  except ImportError:
+    return False
+  return isinstance(detector, getattr(dlib, 'cnn_face_detection_model_v1', ()))
+
+def face_points_all(img, add_boundary_points=True, detect_max_side=None):
+  """ Locates 68 face points of every face in the image with one detector pass
+
+  :param img: an image array
+  :param add_boundary_points: bool to add additional boundary points
+  :param detect_max_side: see :func:`face_points_dlib`
+  :returns: list of arrays of x,y face points, one per face. Empty if no face found
+  """
+  return face_points_batch([img], add_boundary_points, detect_max_side)[0]
+
+def face_points_batch(imgs, add_boundary_points=True, detect_max_side=None):
+  """ Locates 68 face points of every face in every image, sharing the
+  detector and predictor and batching detection where dlib supports it
+
+  :param imgs: list of image arrays
+  :param add_boundary_points: bool to add additional boundary points
+  :param detect_max_side: see :func:`face_points_dlib`
+  :returns: list with a list of face point arrays for every image
+  """
+  detector = get_detector()
+  predictor = get_predictor()
+  try:
+    rgbimgs = [cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in imgs]
+    batch_rects = detect_faces(detector, rgbimgs, detect_max_side)
+    return [[predict_points(predictor, rgbimg, rect, add_boundary_points) for rect in rects]
+            for rgbimg, rects in zip(rgbimgs, batch_rects)]
+  except Exception as e:
+    # Fall back to one image at a time so one bad image does not fail the batch
+    if len(imgs) > 1:
+      return [face_points_all(img, add_boundary_points, detect_max_side) for img in imgs]
+    print(e)
+    return [[]]
 
-def face_points_dlib(img, add_boundary_points=True):
+def face_points_dlib(img, add_boundary_points=True, detect_max_side=None):
   """ Locates 68 face points using dlib (http://dlib.net)
     Requires shape_predictor_68_face_landmarks.dat to be in face_morpher/data
     Download at: http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2
   :param img: an image array
   :param add_boundary_points: bool to add additional boundary points
+  :param detect_max_side: detect faces on a copy downscaled to this max side,
+    then predict the face points at full resolution. 0 detects at full
+    resolution. Defaults to the DLIB_DETECT_MAX_SIDE environment variable
   :returns: Array of x,y face points. Empty array if no face found
   """
+  detector = get_detector()
+  predictor = get_predictor()
   try:
     points = []
     rgbimg = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    rects = dlib_detector(rgbimg, 1)
+    rects = detect(detector, rgbimg, detect_max_side)
 
     if rects and len(rects) > 0:
       # We only take the first found face
-      shapes = dlib_predictor(rgbimg, rects[0])
-      points = np.array([(shapes.part(i).x, shapes.part(i).y) for i in range(68)], np.int32)
-
-      if add_boundary_points:
-        # Add more points inwards and upwards as dlib only detects up to eyebrows
-        points = np.vstack([
-          points,
-          boundary_points(points, 0.1, -0.03),
-          boundary_points(points, 0.13, -0.05),
-          boundary_points(points, 0.15, -0.08),
-          boundary_points(points, 0.33, -0.12)])
+      points = predict_points(predictor, rgbimg, rects[0], add_boundary_points)
 
     return points
   except Exception as e:
@@ -88,13 +270,14 @@ def face_points_stasm(img, add_boundary_points=True):
 
   return points
 
-def average_points(point_set):
+def average_points(point_set, weights=None):
   """ Averages a set of face points from images
 
   :param point_set: *n* x *m* x 2 array of face points. \\
   *n* = number of images. *m* = number of face points per image
+  :param weights: optional *n* weights of the images
   """
-  return np.mean(point_set, 0).astype(np.int32)
+  return np.average(point_set, 0, weights).astype(np.int32)
 
 def weighted_average_points(start_points, end_points, percent=0.5):
   """ Weighted average of two sets of supplied points
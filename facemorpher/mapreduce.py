@@ -0,0 +1,304 @@
+"""
+::
+
+  Map-reduce averaging. Shards of images are summed separately, on any
+  number of processes or machines, and the partial sums are merged in any
+  order into the final average.
+
+  A first map and reduce over face points settles the mean face points,
+  then every shard warps its faces onto them. With --destimg, faces are
+  warped onto the destination face and the points pass is skipped.
+
+  Usage:
+    mapreduce.py points --images=<folder> --out=<filename> [--shard=<index/count>]
+              [--width=<width>] [--height=<height>] [--workers=<num>] [--cache=<filename>]
+    mapreduce.py map --images=<folder> --out=<filename> (--points=<filename> | --destimg=<filename>)
+              [--shard=<index/count>] [--width=<width>] [--height=<height>]
+              [--workers=<num>] [--cache=<filename>]
+    mapreduce.py reduce <partials>... --out=<filename>
+    mapreduce.py finish <partials>... [--out=<filename>] [--blur]
+              [--background=(black|transparent|average|blur)]
+    mapreduce.py local --images=<folder> --dir=<folder> [--shards=<num>] [--destimg=<filename>]
+              [--width=<width>] [--height=<height>] [--workers=<num>] [--cache=<filename>]
+              [--out=<filename>] [--blur] [--background=(black|transparent|average|blur)]
+
+  Options:
+    -h, --help              Show this screen.
+    --images=<folder>       Folder to images (.jpg, .jpeg, .png)
+    --out=<filename>        Partial average (.npz) of points, map and reduce, or image of finish [default: result.png]
+    --shard=<index/count>   Only use every count-th image of the sorted images, from index [default: 0/1]
+    --points=<filename>     Reduced partial average of face points to warp the faces onto
+    --destimg=<filename>    Destination face image to overlay average face
+    --dir=<folder>          Shared folder for the partial averages of a local run
+    --shards=<num>          Number of shards of a local run [default: 4]
+    --width=<width>         Custom width of the images [default: 500]
+    --height=<height>       Custom height of the images [default: 600]
+    --workers=<num>         Number of processes, per shard for map or shards in parallel for local [default: 1]
+    --cache=<filename>      SQLite file to cache face points across runs
+    --blur                  Flag to blur edges of image [default: False]
+    --background=<bg>       Background of image to be one of (black|transparent|average|blur) [default: black]
+    --version               Show version.
+"""
+from docopt import docopt
+from functools import partial
+import os
+import numpy as np
+
+from facemorpher import aligner
+from facemorpher import loader
+from facemorpher import cache as cache_module
+from facemorpher import plotter
+from facemorpher.averager import (Accumulator, compose_average, list_imgpaths,
+                                  load_dest_image_points, no_images_error)
+from facemorpher.parallel import imap_ordered
+
+class PartialAverage(object):
+  """ Sums of a shard of images: the count, the sum of aligned face points
+  and, once faces are warped, the float64 sums of faces and backgrounds.
+  Partial averages add up exactly, so they merge in any order or tree shape.
+  A partial of face points only settles the points to warp faces onto.
+  """
+  def __init__(self, size, count=0, points_sum=None, dest_points=None,
+               face_sum=None, background_sum=None, dest_img=None):
+    """
+    :param size: (height, width) of the average
+    :param count: number of images
+    :param points_sum: *m* x 2 sum of the aligned face points
+    :param dest_points: *m* x 2 points the faces were warped onto
+    :param face_sum: sum of the warped faces. None for points only
+    :param background_sum: sum of the aligned images
+    :param dest_img: destination image the average face is drawn on
+    """
+    self.size = tuple(size)
+    self.count = count
+    self.points_sum = points_sum
+    self.dest_points = dest_points
+    self.face_sum = face_sum
+    self.background_sum = background_sum
+    self.dest_img = dest_img
+
+  @property
+  def has_faces(self):
+    return self.face_sum is not None
+
+  def mean_points(self):
+    """ Mean face points, truncated like :func:`facemorpher.locator.average_points` """
+    return (self.points_sum / self.count).astype(np.int32)
+
+  def merge(self, other):
+    """ Add the sums of another partial average to this one
+
+    :returns: self
+    """
+    if self.size != other.size:
+      raise ValueError('Cannot merge partial averages of sizes %s and %s' % (
+        self.size, other.size))
+    if other.count == 0:
+      return self
+    if self.count == 0:
+      self.__dict__.update(other.__dict__)
+      return self
+    if self.has_faces != other.has_faces:
+      raise ValueError('Cannot merge a partial average of face points with one of faces')
+    if self.has_faces and not np.array_equal(self.dest_points, other.dest_points):
+      raise ValueError('Cannot merge partial averages warped onto different face points')
+
+    self.count += other.count
+    self.points_sum = self.points_sum + other.points_sum
+    if self.has_faces:
+      self.face_sum = self.face_sum + other.face_sum
+      self.background_sum = self.background_sum + other.background_sum
+    return self
+
+  def accumulator(self):
+    """ :class:`facemorpher.averager.Accumulator` holding the sums """
+    accumulator = Accumulator(self.dest_points, self.size, np.float64, background=True)
+    accumulator.face_sum = self.face_sum
+    accumulator.background_sum = self.background_sum
+    accumulator.count = accumulator.weight = self.count
+    return accumulator
+
+  def save(self, filename):
+    """ Write the sums to an .npz file. The file is replaced atomically,
+    so a shared folder never holds a partial file """
+    arrays = {'size': self.size, 'count': self.count}
+    for name in ('points_sum', 'dest_points', 'face_sum', 'background_sum', 'dest_img'):
+      value = getattr(self, name)
+      if value is not None:
+        arrays[name] = value
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+      np.savez(f, **arrays)
+    os.replace(tmp_filename, filename)
+
+  @classmethod
+  def load(cls, filename):
+    with np.load(filename) as arrays:
+      optional = {name: arrays[name] for name in
+                  ('points_sum', 'dest_points', 'face_sum', 'background_sum', 'dest_img')
+                  if name in arrays}
+      return cls(tuple(int(side) for side in arrays['size']), int(arrays['count']),
+                 **optional)
+
+def shard(imgpaths, index, count):
+  """ Every count-th image path from index, in sorted order so that every
+  machine agrees on the shards """
+  return sorted(imgpaths)[index::count]
+
+def parse_shard(text):
+  """ (index, count) of an 'index/count' string """
+  index, count = (int(part) for part in text.split('/'))
+  if not 0 <= index < count:
+    raise ValueError('Shard index must be in [0, %d), got %d' % (count, index))
+  return index, count
+
+def map_points(imgpaths, size, workers=1, cache=None):
+  """ Partial average of the aligned face points of images
+
+  :param imgpaths: array or generator of image paths
+  :param size: (height, width) of the average
+  :returns: :class:`PartialAverage` without faces
+  """
+  cache = cache_module.open_cache(cache)
+  aligned = [aligner.align_points(points, size)
+             for _, points in loader.iter_raw_points(imgpaths, workers, cache)]
+  if len(aligned) == 0:
+    return PartialAverage(size)
+  return PartialAverage(size, len(aligned), np.sum(aligned, axis=0, dtype=np.float64))
+
+def map_faces(imgpaths, dest_points, size, workers=1, cache=None, dest_img=None):
+  """ Partial average of the faces of images warped onto dest_points
+
+  :param imgpaths: array or generator of image paths
+  :param dest_points: *m* x 2 points shared by every shard, such as the
+    :meth:`PartialAverage.mean_points` of the reduced points
+  :param size: (height, width) of the average
+  :param dest_img: destination image kept for :func:`finish`
+  :returns: :class:`PartialAverage`
+  """
+  cache = cache_module.open_cache(cache)
+  accumulator = Accumulator(dest_points, size, np.float64, background=True)
+  points_sum = np.zeros(np.shape(dest_points), np.float64)
+  for _, img, points in loader.iter_image_points(imgpaths, size, workers, cache):
+    accumulator.add(img, points)
+    points_sum += points
+  return PartialAverage(size, accumulator.count, points_sum, np.asarray(dest_points),
+                        accumulator.face_sum, accumulator.background_sum, dest_img)
+
+def reduce_partials(partials):
+  """ Merge partial averages, given as objects or filenames. Only two are
+  held in memory at a time
+
+  :returns: :class:`PartialAverage`
+  """
+  result = None
+  for item in partials:
+    if not isinstance(item, PartialAverage):
+      item = PartialAverage.load(item)
+    result = item if result is None else result.merge(item)
+  if result is None:
+    raise ValueError('No partial averages to reduce')
+  return result
+
+def finish(partial_average, background='black', blur_edges=False):
+  """ Final average face image of reduced partial averages, see
+  :func:`facemorpher.averager.compose_average` """
+  if not partial_average.has_faces:
+    raise ValueError('The partial average holds face points only. Map the faces first')
+  if partial_average.count == 0:
+    raise no_images_error()
+  dest_img = partial_average.dest_img
+  if dest_img is not None:
+    dest_img = np.copy(dest_img)
+  return compose_average(partial_average.accumulator(), dest_img, background, blur_edges)
+
+def _map_shard_points(index, imgpaths, num_shards, size, cache, folder):
+  filename = os.path.join(folder, 'points-%d.npz' % index)
+  map_points(shard(imgpaths, index, num_shards), size, 1, cache).save(filename)
+  return filename
+
+def _map_shard_faces(index, imgpaths, num_shards, dest_points, size, cache, folder, dest_img):
+  filename = os.path.join(folder, 'faces-%d.npz' % index)
+  map_faces(shard(imgpaths, index, num_shards), dest_points, size, 1, cache,
+            dest_img).save(filename)
+  return filename
+
+def map_reduce(imgpaths, folder, num_shards=4, size=(600, 500), workers=1, cache=None,
+               dest_filename=None):
+  """ Average images shard by shard in worker processes that write their
+  partial averages to a shared folder, then reduce them. The same steps
+  run across machines with the command line
+
+  :param folder: shared folder for the partial average files
+  :param num_shards: number of shards
+  :param workers: number of shards mapped in parallel
+  :param dest_filename: destination face image. Skips the points pass
+  :returns: reduced :class:`PartialAverage`
+  """
+  imgpaths = list(imgpaths)
+  cache = cache_module.open_cache(cache)
+  if not os.path.exists(folder):
+    os.makedirs(folder)
+
+  dest_img = None
+  if dest_filename is not None:
+    dest_img, dest_points = load_dest_image_points(dest_filename, size, cache)
+  else:
+    filenames = imap_ordered(partial(_map_shard_points, imgpaths=imgpaths,
+                                     num_shards=num_shards, size=size, cache=cache,
+                                     folder=folder),
+                             range(num_shards), workers)
+    points = reduce_partials(filenames)
+    if points.count == 0:
+      raise no_images_error()
+    dest_points = points.mean_points()
+
+  filenames = imap_ordered(partial(_map_shard_faces, imgpaths=imgpaths,
+                                   num_shards=num_shards, dest_points=dest_points,
+                                   size=size, cache=cache, folder=folder, dest_img=dest_img),
+                           range(num_shards), workers)
+  return reduce_partials(filenames)
+
+def save_image(img, filename):
+  plt = plotter.Plotter(False, out_filename=filename, save_workers=0)
+  plt.save(img)
+  plt.end()
+
+def main():
+  args = docopt(__doc__, version='Face Map Reduce Averager 1.0')
+  size = (int(args['--height']), int(args['--width']))
+  workers = int(args['--workers'])
+
+  if args['points'] or args['map']:
+    index, num_shards = parse_shard(args['--shard'])
+    imgpaths = shard(list_imgpaths(args['--images']), index, num_shards)
+    if args['points']:
+      result = map_points(imgpaths, size, workers, args['--cache'])
+    else:
+      dest_img = None
+      if args['--destimg'] is not None:
+        dest_img, dest_points = load_dest_image_points(args['--destimg'], size,
+                                                       cache_module.open_cache(args['--cache']))
+      else:
+        dest_points = PartialAverage.load(args['--points']).mean_points()
+      result = map_faces(imgpaths, dest_points, size, workers, args['--cache'], dest_img)
+    result.save(args['--out'])
+    print('Mapped {} images to {}'.format(result.count, args['--out']))
+  elif args['reduce']:
+    result = reduce_partials(args['<partials>'])
+    result.save(args['--out'])
+    print('Reduced {} images to {}'.format(result.count, args['--out']))
+  else:
+    if args['local']:
+      result = map_reduce(list_imgpaths(args['--images']), args['--dir'],
+                          int(args['--shards']), size, workers, args['--cache'],
+                          args['--destimg'])
+    else:
+      result = reduce_partials(args['<partials>'])
+    print('Averaged {} images'.format(result.count))
+    save_image(finish(result, args['--background'], args['--blur']), args['--out'])
+
+
+if __name__ == "__main__":
+  main()
@@ -5,17 +5,23 @@
   Morph through all images in a folder
 
   Usage:
-    morpher.py (--src=<src_path> --dest=<dest_path> | --images=<folder>)
+    morpher.py (--src=<src_path> --dest=<dest_path> | --images=<folder> | --corpus=<folder>)
+              [--subset=<selector>]
               [--width=<width>] [--height=<height>]
               [--num=<num_frames>] [--fps=<frames_per_second>]
               [--out_frames=<folder>] [--out_video=<filename>]
               [--plot] [--background=(black|transparent|average)]
+              [--workers=<num>] [--cache=<filename>] [--codec=(mjpg|h264|y4m)]
+              [--fixed_topology] [--batch=<frames>] [--profile]
+              [--frame_format=(png|jpg|webp)] [--frame_quality=<quality>]
 
   Options:
     -h, --help              Show this screen.
     --src=<src_imgpath>     Filepath to source image (.jpg, .jpeg, .png)
     --dest=<dest_imgpath>   Filepath to destination image (.jpg, .jpeg, .png)
     --images=<folder>       Folderpath to images
+    --corpus=<folder>       Aligned face corpus built by corpus.py, used instead of images
+    --subset=<selector>     Corpus faces to morph: a start:stop[:step] slice, comma separated indices or a path pattern
     --width=<width>         Custom width of the images/video [default: 500]
     --height=<height>       Custom height of the images/video [default: 600]
     --num=<num_frames>      Number of morph frames [default: 20]
@@ -24,22 +30,39 @@
     --out_video=<filename>  Filename to save a video
     --plot                  Flag to plot images to result.png [default: False]
     --background=<bg>       Background of images to be one of (black|transparent|average) [default: black]
+    --workers=<num>         Number of processes to load images, find faces and render frames [default: 1]
+    --cache=<filename>      SQLite file to cache face points across runs
+    --codec=<codec>         Video codec to be one of (mjpg|h264|y4m). h264 needs ffmpeg [default: mjpg]
+    --fixed_topology        Triangulate once per image pair instead of every frame. Faces are cut into other triangles, so frames are not identical to the default [default: False]
+    --batch=<frames>        Render this many frames at once in stacked arrays, implies --fixed_topology [default: 1]
+    --profile               Print the time spent in each stage at the end [default: False]
+    --frame_format=<ext>    Image format of --out_frames to be one of (png|jpg|webp) [default: png]
+    --frame_quality=<q>     PNG compression level 0-9, or JPEG/WebP quality 0-100 of --out_frames
     --version               Show version.
 """
 from docopt import docopt
+from functools import partial
 import os
 import numpy as np
 import cv2
 
 from facemorpher import locator
-from facemorpher import aligner
+from facemorpher import loader
+from facemorpher import parallel
+from facemorpher import cache as cache_module
+from facemorpher import corpus as corpus_module
+from facemorpher import instrument
 from facemorpher import warper
 from facemorpher import blender
 from facemorpher import plotter
 from facemorpher import videoer
 
 def verify_args(args):
-  if args['--images'] is None:
+  if args['--corpus'] is not None:
+    if not os.path.isdir(args['--corpus']):
+      print('--corpus=%s is not a valid directory' % args['--corpus'])
+      exit(1)
+  elif args['--images'] is None:
     valid = os.path.isfile(args['--src']) & os.path.isfile(args['--dest'])
     if not valid:
       print('--src=%s or --dest=%s file does not exist. Double check the supplied paths' % (
@@ -51,22 +74,19 @@ def verify_args(args):
       print('--images=%s is not a valid directory' % args['--images'])
       exit(1)
 
+DEFAULT_BATCH_SIZE = 8
+
 def load_image_points(path, size):
-  img = cv2.imread(path)
-  points = locator.face_points(img)
+  return loader.load_image_points(path, size)
 
-  if len(points) == 0:
-    print('No face in %s' % path)
-    return None, None
+def load_valid_image_points(imgpaths, size, workers=1, cache=None, corpus=None, subset=None):
+  if corpus is None:
+    path_img_points = loader.iter_image_points(imgpaths, size, workers, cache)
   else:
-    return aligner.resize_align(img, points, size)
-
-def load_valid_image_points(imgpaths, size):
-  for path in imgpaths:
-    img, points = load_image_points(path, size)
-    if img is not None:
-      print(path)
-      yield (img, points)
+    path_img_points = corpus.iter_image_points(subset)
+  for path, img, points in path_img_points:
+    print(path)
+    yield (img, points)
 
 def list_imgpaths(images_folder=None, src_image=None, dest_image=None):
   if images_folder is None:
@@ -79,74 +99,394 @@ def list_imgpaths(images_folder=None, src_image=None, dest_image=None):
          fname.lower().endswith('.jpeg')):
         yield os.path.join(images_folder, fname)
 
-def morph(src_img, src_points, dest_img, dest_points,
-          video, width=500, height=600, num_frames=20, fps=10,
-          out_frames=None, out_video=None, plot=False, background='black'):
+class FrameBuffers(object):
+  """ Preallocated images that :func:`morph_frame` renders into, so that
+  rendering a sequence does not allocate new output images for every frame
   """
-  Create a morph sequence from source to destination image
+  def __init__(self, size, background='black'):
+    """
+    :param size: (height, width) of the frames
+    :param background: (black|transparent|average) background of the frames
+    """
+    self.src_face = np.zeros(size + (3,), np.uint8)
+    self.end_face = np.zeros(size + (3,), np.uint8)
+    self.face = np.zeros(size + (3,), np.uint8)
+    self.background = np.zeros(size + (3,), np.uint8) if background == 'average' else None
+    self.frame = np.zeros(size + (4,), np.uint8) if background == 'transparent' else None
+
+def morph_frame(src_img, src_points, dest_img, dest_points, percent, size,
+                background='black', buffers=None, topology=None):
+  """
+  Render one morph frame between source and destination image
+
+  :param percent: [0, 1] weight of the source image
+  :param size: (height, width) of the frame
+  :param buffers: optional :class:`FrameBuffers` to render into. The returned
+    frame is then one of the buffers and is overwritten by the next render
+  :param topology: optional :class:`facemorpher.warper.Topology` to reuse
+    instead of triangulating the frame points
+  :returns: frame with an alpha channel if background is transparent
+  """
+  if buffers is None:
+    buffers = FrameBuffers(size, background)
+
+  points = locator.weighted_average_points(src_points, dest_points, percent)
+  plan = warper.WarpPlan(points, size, topology)
+  src_face = warper.warp_image(src_img, src_points, points, size, plan=plan,
+                               out=buffers.src_face)
+  end_face = warper.warp_image(dest_img, dest_points, points, size, plan=plan,
+                               out=buffers.end_face)
+  average_face = blender.weighted_average(src_face, end_face, percent, out=buffers.face)
+
+  if background == 'transparent':
+    mask = blender.mask_from_points(average_face.shape[:2], points)
+    buffers.frame[..., :3] = average_face
+    buffers.frame[..., 3] = mask
+    average_face = buffers.frame
+  elif background == 'average':
+    mask = blender.mask_from_points(average_face.shape[:2], points)
+    average_background = blender.weighted_average(src_img, dest_img, percent,
+                                                  out=buffers.background)
+    if average_background is not buffers.background:
+      # Overlaying in place must not overwrite the source images of later frames
+      buffers.background[...] = average_background[..., :3]
+    average_face = blender.overlay_image(average_face, mask, buffers.background)
+
+  return average_face
+
+def morph_batch(src_img, src_points, dest_img, dest_points, percents, size,
+                background='black', topology=None):
+  """
+  Render the morph frames of several percents between source and destination
+  image in stacked array operations. Triangles of the topology that flip in a
+  frame fall back per triangle, see :meth:`facemorpher.warper.Topology.labels`
+
+  :param percents: [0, 1] weights of the source image, one per frame
+  :param size: (height, width) of the frames
+  :param topology: :class:`facemorpher.warper.Topology` shared by the frames.
+    Defaults to :func:`pair_topology`
+  :returns: *n* x height x width x channels frames, with an alpha channel
+    if background is transparent
+  """
+  if topology is None:
+    topology = pair_topology(src_points, dest_points)
+
+  frame_points = [locator.weighted_average_points(src_points, dest_points, percent)
+                  for percent in percents]
+  plan = warper.BatchWarpPlan(frame_points, size, topology)
+  src_faces = warper.warp_batch(src_img, src_points, plan)
+  end_faces = warper.warp_batch(dest_img, dest_points, plan)
+  faces = blender.weighted_average_batch(src_faces, end_faces, percents)
+
+  if background in ('transparent', 'average'):
+    masks = np.array([blender.mask_from_points(size, points) for points in plan.dest_points])
+  if background == 'transparent':
+    frames = np.empty(faces.shape[:-1] + (4,), np.uint8)
+    frames[..., :3] = faces
+    frames[..., 3] = masks
+    return frames
+  elif background == 'average':
+    backgrounds = blender.weighted_average_batch(src_img[..., :3], dest_img[..., :3], percents)
+    np.copyto(backgrounds, faces, where=masks[..., np.newaxis] > 0)
+    return backgrounds
+  return faces
+
+def iter_morph_batches(src_img, src_points, dest_img, dest_points, percents, size,
+                       background='black', batch_size=DEFAULT_BATCH_SIZE):
+  """
+  Lazily render the morph frames of percents in stacks of at most
+  batch_size frames. Larger batches trade memory for throughput
+
+  :returns: generator of *k* x height x width x channels frame stacks,
+    see :func:`morph_batch`
+  """
+  topology = pair_topology(src_points, dest_points)
+  for start in range(0, len(percents), batch_size):
+    yield morph_batch(src_img, src_points, dest_img, dest_points,
+                      percents[start:start + batch_size], size, background, topology)
+
+def stall_frame_count(fps):
+  return np.clip(int(fps*0.15), 1, fps)  # Show first & last longer
+
+def pair_topology(src_points, dest_points):
+  """ Triangulation of the halfway shape, shared by every frame of a pair """
+  return warper.Topology(locator.weighted_average_points(src_points, dest_points, 0.5))
+
+def morph_items(pairs, size, num_frames, fps, background, fixed_topology=False,
+                batch_size=1, chunks=1):
+  """ Tagged work items of a morph sequence, in output order
+
+  :param pairs: iterable of (src_img, src_points, dest_img, dest_points)
+  :param fixed_topology: triangulate once per pair, see :func:`pair_topology`
+  :param batch_size: number of frames per 'frames' item. Implies fixed_topology
+  :param chunks: split the frames of a pair into this many 'frame_chunk'
+    items, so the images of a pair are sent to a worker process once per
+    chunk instead of once per frame
+  :returns: generator of (kind, payload). kind 'src' and 'dest' carry an image,
+    'frame' carries the arguments of :func:`morph_frame` and its topology,
+    'frame_chunk' the same with an array of percents, and 'frames' the
+    arguments of :func:`morph_batch`
+  """
+  num_frames -= (stall_frame_count(fps) * 2)  # No need to process src and dest image
+  for src_img, src_points, dest_img, dest_points in pairs:
+    topology = None
+    if fixed_topology or batch_size > 1:
+      topology = pair_topology(src_points, dest_points)
+    percents = np.linspace(1, 0, num=num_frames)
+    yield 'src', src_img
+    if batch_size > 1:
+      for start in range(0, num_frames, batch_size):
+        yield 'frames', (src_img, src_points, dest_img, dest_points,
+                         percents[start:start + batch_size], size, background, topology)
+    elif chunks > 1:
+      for chunk_percents in np.array_split(percents, min(chunks, num_frames)):
+        yield 'frame_chunk', (src_img, src_points, dest_img, dest_points, chunk_percents,
+                              size, background, topology)
+    else:
+      for percent in percents:
+        yield 'frame', (src_img, src_points, dest_img, dest_points, percent, size,
+                        background, topology)
+    yield 'dest', dest_img
+
+def render_item(item, buffers=None):
+  kind, payload = item
+  if kind == 'frame':
+    args, topology = payload[:-1], payload[-1]
+    payload = morph_frame(*args, buffers=buffers, topology=topology)
+  elif kind == 'frame_chunk':
+    src_img, src_points, dest_img, dest_points, percents = payload[:5]
+    args, topology = payload[5:-1], payload[-1]
+    payload = [morph_frame(src_img, src_points, dest_img, dest_points, percent, *args,
+                           topology=topology) for percent in percents]
+  elif kind == 'frames':
+    payload = morph_batch(*payload)
+  return kind, payload
+
+def is_passthrough(item):
+  """ True for 'src' and 'dest' items, which need no rendering """
+  return item[0] in ('src', 'dest')
+
+def unbatch(items):
+  """ Split rendered 'frames' and 'frame_chunk' items into one 'frame' item per frame """
+  for kind, payload in items:
+    if kind in ('frames', 'frame_chunk'):
+      for frame in payload:
+        yield 'frame', frame
+    else:
+      yield kind, payload
+
+def iter_morph_items(pairs, width=500, height=600, num_frames=20, fps=10,
+                     background='black', workers=1, reuse_buffers=False,
+                     max_in_flight=None, fixed_topology=False, batch_size=1):
+  """
+  Lazily render the morph sequences of consecutive image pairs. With several
+  workers, frames (also of the following pairs) render in a process pool
+  and are yielded in order. The frames of a pair are then split into one
+  chunk per worker, so the images of a pair are sent to each worker once,
+  and the source and destination images are passed through in this process.
+
+  :param pairs: iterable of (src_img, src_points, dest_img, dest_points)
+  :param workers: number of processes that render frames
+  :param reuse_buffers: render every frame into the same preallocated
+    buffers. Only applies when rendering in this process (workers=1).
+    A yielded frame is then only valid until the next one is requested
+  :param max_in_flight: maximum number of work items (frames, or chunks or
+    batches of frames) rendered ahead of the consumer
+  :param fixed_topology: triangulate once per pair and reuse the triangles for
+    every frame. Triangles that flip in a frame, and pixels the triangles no
+    longer cover, fall back to the frame's own triangulation. Frames warp
+    with other triangles than their own triangulation, so they are close to
+    but not identical to the default frames. About 10% faster per frame
+  :param batch_size: render this many frames of a pair at once with
+    :func:`morph_batch`, in one work item. Implies fixed_topology and
+    takes precedence over reuse_buffers
+  :returns: generator of (kind, frame). kind is 'src', 'frame' or 'dest'
+  """
+  size = (height, width)
+  items = morph_items(pairs, size, num_frames, fps, background, fixed_topology,
+                      batch_size, max(workers, 1))
+  render = render_item
+  if reuse_buffers and workers <= 1:
+    render = partial(render_item, buffers=FrameBuffers(size, background))
+  return unbatch(parallel.imap_ordered(render, items, workers, max_in_flight,
+                                       local=is_passthrough))
+
+def expand_frames(items, fps):
+  """ Video frames of tagged items, repeating the destination image to stall """
+  stall_frames = stall_frame_count(fps)
+  for kind, img in items:
+    for _ in range(stall_frames if kind == 'dest' else 1):
+      yield img
+
+def iter_morph_frames(src_img, src_points, dest_img, dest_points,
+                      width=500, height=600, num_frames=20, fps=10,
+                      background='black', workers=1, reuse_buffers=False,
+                      max_in_flight=None, fixed_topology=False, batch_size=1):
+  """
+  Lazily yield every video frame of the morph from source to destination image.
+  Frames are only rendered as they are consumed (plus up to max_in_flight ahead).
 
   :param src_img: ndarray source image
   :param src_points: source image array of x,y face points
   :param dest_img: ndarray destination image
   :param dest_points: destination image array of x,y face points
-  :param video: facemorpher.videoer.Video object
+  :param reuse_buffers: see :func:`iter_morph_items`
+  :param fixed_topology: see :func:`iter_morph_items`
+  :param batch_size: see :func:`iter_morph_items`
+  :returns: generator of ndarray frames
   """
-  size = (height, width)
-  stall_frames = np.clip(int(fps*0.15), 1, fps)  # Show first & last longer
-  plt = plotter.Plotter(plot, num_images=num_frames, out_folder=out_frames)
-  num_frames -= (stall_frames * 2)  # No need to process src and dest image
+  items = iter_morph_items([(src_img, src_points, dest_img, dest_points)],
+                           width, height, num_frames, fps, background,
+                           workers, reuse_buffers, max_in_flight, fixed_topology,
+                           batch_size)
+  return expand_frames(items, fps)
 
-  plt.plot_one(src_img)
-  video.write(src_img, 1)
+def iter_morph_sequence(imgpaths, width=500, height=600, num_frames=20, fps=10,
+                        background='black', workers=1, cache=None,
+                        reuse_buffers=False, max_in_flight=None,
+                        fixed_topology=False, batch_size=1, corpus=None, subset=None):
+  """
+  Lazily yield every video frame of the morph through all images in imgpaths
 
-  # Produce morph frames!
-  for percent in np.linspace(1, 0, num=num_frames):
-    points = locator.weighted_average_points(src_points, dest_points, percent)
-    src_face = warper.warp_image(src_img, src_points, points, size)
-    end_face = warper.warp_image(dest_img, dest_points, points, size)
-    average_face = blender.weighted_average(src_face, end_face, percent)
+  :param imgpaths: array or generator of image paths. Ignored with a corpus
+  :param cache: landmark cache filepath or :class:`facemorpher.cache.LandmarkCache`
+  :param reuse_buffers: see :func:`iter_morph_items`
+  :param fixed_topology: see :func:`iter_morph_items`
+  :param batch_size: see :func:`iter_morph_items`
+  :param corpus: :class:`facemorpher.corpus.Corpus` or its folder to morph
+    through instead of imgpaths. Frames keep the size of the corpus
+  :param subset: corpus faces to morph through, see :meth:`facemorpher.corpus.Corpus.select`
+  :returns: generator of ndarray frames
+  """
+  corpus = corpus_module.open_corpus(corpus)
+  if corpus is not None:
+    height, width = corpus.size
+  images_points_gen = load_valid_image_points(imgpaths, (height, width), workers,
+                                              cache_module.open_cache(cache), corpus, subset)
+  items = iter_morph_items(image_pairs(images_points_gen), width, height,
+                           num_frames, fps, background, workers,
+                           reuse_buffers, max_in_flight, fixed_topology, batch_size)
+  return expand_frames(items, fps)
+
+def render_sequence(pairs, video, width=500, height=600, num_frames=20, fps=10,
+                    out_frames=None, plot=False, background='black', workers=1,
+                    fixed_topology=False, batch_size=1, frame_format='png', frame_quality=None):
+  """
+  Write the morph sequences of consecutive image pairs to the video, frames
+  folder and plot
 
-    if background in ('transparent', 'average'):
-      mask = blender.mask_from_points(average_face.shape[:2], points)
-      average_face = np.dstack((average_face, mask))
+  :param pairs: iterable of (src_img, src_points, dest_img, dest_points)
+  :param video: facemorpher.videoer.Video object
+  :param workers: number of processes that render frames
+  :param fixed_topology: triangulate once per image pair
+  :param batch_size: number of frames rendered at once in stacked arrays
+  :param frame_format: image format of out_frames to be one of (png|jpg|webp)
+  :param frame_quality: PNG compression level 0-9, or JPEG/WebP quality 0-100
+  """
+  stall_frames = stall_frame_count(fps)
+  items = iter_morph_items(pairs, width, height, num_frames, fps, background, workers,
+                           fixed_topology=fixed_topology, batch_size=batch_size)
+  plt = None
 
-      if background == 'average':
-        average_background = blender.weighted_average(src_img, dest_img, percent)
-        average_face = blender.overlay_image(average_face, mask, average_background)
+  # Produce morph frames!
+  for kind, img in items:
+    instrument.count('frames', int(stall_frames) if kind == 'dest' else 1)
+    if kind == 'src':
+      plt = plotter.Plotter(plot, num_images=num_frames, out_folder=out_frames,
+                            image_format=frame_format, quality=frame_quality)
+      plt.plot_one(img)
+      video.write(img, 1)
+    elif kind == 'frame':
+      plt.plot_one(img)
+      plt.save(img)
+      video.write(img)
+    else:
+      plt.plot_one(img)
+      video.write(img, stall_frames)
+      plt.show()
+      plt.end()
 
-    plt.plot_one(average_face)
-    plt.save(average_face)
-    video.write(average_face)
+def morph(src_img, src_points, dest_img, dest_points,
+          video, width=500, height=600, num_frames=20, fps=10,
+          out_frames=None, out_video=None, plot=False, background='black',
+          workers=1, fixed_topology=False, batch_size=1, frame_format='png', frame_quality=None):
+  """
+  Create a morph sequence from source to destination image
+
+  :param src_img: ndarray source image
+  :param src_points: source image array of x,y face points
+  :param dest_img: ndarray destination image
+  :param dest_points: destination image array of x,y face points
+  :param video: facemorpher.videoer.Video object
+  :param workers: number of processes that render frames
+  :param fixed_topology: triangulate once instead of for every frame
+  :param batch_size: number of frames rendered at once in stacked arrays
+  :param frame_format: image format of out_frames to be one of (png|jpg|webp)
+  :param frame_quality: PNG compression level 0-9, or JPEG/WebP quality 0-100
+  """
+  render_sequence([(src_img, src_points, dest_img, dest_points)], video,
+                  width, height, num_frames, fps, out_frames, plot, background, workers,
+                  fixed_topology, batch_size, frame_format, frame_quality)
 
-  plt.plot_one(dest_img)
-  video.write(dest_img, stall_frames)
-  plt.show()
+def image_pairs(images_points):
+  """ Consecutive (src_img, src_points, dest_img, dest_points) pairs """
+  images_points = iter(images_points)
+  for src_img, src_points in images_points:
+    for dest_img, dest_points in images_points:
+      yield src_img, src_points, dest_img, dest_points
+      src_img, src_points = dest_img, dest_points
 
 def morpher(imgpaths, width=500, height=600, num_frames=20, fps=10,
-            out_frames=None, out_video=None, plot=False, background='black'):
+            out_frames=None, out_video=None, plot=False, background='black',
+            workers=1, cache=None, codec='mjpg', fixed_topology=False, batch_size=1,
+            frame_format='png', frame_quality=None, corpus=None, subset=None):
   """
   Create a morph sequence from multiple images in imgpaths
 
-  :param imgpaths: array or generator of image paths
+  :param imgpaths: array or generator of image paths. Ignored with a corpus
+  :param workers: number of processes that load images, locate face points
+    and render frames
+  :param cache: landmark cache filepath or :class:`facemorpher.cache.LandmarkCache`
+  :param codec: video codec to be one of (mjpg|h264|y4m)
+  :param fixed_topology: triangulate once per image pair instead of every frame
+  :param batch_size: render this many frames at once in stacked arrays.
+    Larger batches trade memory for throughput. Implies fixed_topology
+  :param frame_format: image format of out_frames to be one of (png|jpg|webp)
+  :param frame_quality: PNG compression level 0-9, or JPEG/WebP quality 0-100
+  :param corpus: :class:`facemorpher.corpus.Corpus` or its folder to morph
+    through instead of imgpaths. Frames keep the size of the corpus
+  :param subset: corpus faces to morph through, see :meth:`facemorpher.corpus.Corpus.select`
   """
-  video = videoer.Video(out_video, fps, width, height)
-  images_points_gen = load_valid_image_points(imgpaths, (height, width))
-  src_img, src_points = next(images_points_gen)
-  for dest_img, dest_points in images_points_gen:
-    morph(src_img, src_points, dest_img, dest_points, video,
-          width, height, num_frames, fps, out_frames, out_video, plot, background)
-    src_img, src_points = dest_img, dest_points
+  corpus = corpus_module.open_corpus(corpus)
+  if corpus is not None:
+    height, width = corpus.size
+  video = videoer.Video(out_video, fps, width, height, codec)
+  images_points_gen = load_valid_image_points(imgpaths, (height, width), workers,
+                                              cache_module.open_cache(cache), corpus, subset)
+  render_sequence(image_pairs(images_points_gen), video, width, height,
+                  num_frames, fps, out_frames, plot, background, workers,
+                  fixed_topology, batch_size, frame_format, frame_quality)
   video.end()
 
 def main():
   args = docopt(__doc__, version='Face Morpher 1.0')
   verify_args(args)
+  instrument.enable(args['--profile'])
 
-  morpher(list_imgpaths(args['--images'], args['--src'], args['--dest']),
+  imgpaths = None
+  if args['--corpus'] is None:
+    imgpaths = list_imgpaths(args['--images'], args['--src'], args['--dest'])
+  morpher(imgpaths,
           int(args['--width']), int(args['--height']),
           int(args['--num']), int(args['--fps']),
           args['--out_frames'], args['--out_video'],
-          args['--plot'], args['--background'])
+          args['--plot'], args['--background'], int(args['--workers']),
+          args['--cache'], args['--codec'], args['--fixed_topology'],
+          int(args['--batch']), args['--frame_format'],
+          int(args['--frame_quality']) if args['--frame_quality'] else None,
+          args['--corpus'], args['--subset'])
+  if args['--profile']:
+    instrument.report(instrument.TableSink())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+"""
+Ordered and bounded parallel map over process or thread pools
+"""
+import collections
+from concurrent import futures
+
+def imap_ordered(func, items, workers=1, max_in_flight=None, threads=False, local=None):
+  """ Lazily map func over items and yield results in input order.
+  Results that finish early wait in a reorder buffer, and at most
+  max_in_flight items are submitted but not yet consumed, which caps memory.
+
+  :param func: function of one argument. Must be picklable for processes
+  :param items: iterable of arguments
+  :param workers: number of workers. 1 runs in this process
+  :param max_in_flight: maximum number of submitted but unconsumed results.
+    Defaults to twice the number of workers
+  :param threads: use a thread pool instead of a process pool
+  :param local: optional predicate of items that func maps in this process,
+    such as items that need no work, so they are not sent to a worker
+  """
+  if workers <= 1:
+    for item in items:
+      yield func(item)
+    return
+
+  max_in_flight = max_in_flight or 2 * workers
+  Executor = futures.ThreadPoolExecutor if threads else futures.ProcessPoolExecutor
+  with Executor(workers) as executor:
+    pending = collections.deque()
+    try:
+      for item in items:
+        if local is not None and local(item):
+          future = futures.Future()
+          future.set_result(func(item))
+        else:
+          future = executor.submit(func, item)
+        pending.append(future)
+        if len(pending) >= max_in_flight:
+          yield pending.popleft().result()
+      while pending:
+        yield pending.popleft().result()
+    finally:
+      for future in pending:
+        future.cancel()
@@ -2,12 +2,18 @@
 Plot and save images
 """
 
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
+import collections
 import os.path
+import time
+from concurrent import futures
 import numpy as np
 import cv2
 
+from facemorpher import instrument
+
+IMAGE_FORMATS = ('png', 'jpg', 'webp')
+DEFAULT_SAVE_WORKERS = 2
+
 def bgr2rgb(img):
   # OpenCV's BGR to RGB
   rgb = np.copy(img)
@@ -28,14 +34,115 @@ def check_do_save(func):
 
   return inner
 
+def imwrite_params(filename, quality=None):
+  """ cv2.imwrite params for the image format of filename
+
+  :param quality: PNG compression level 0-9, or JPEG and WebP quality 0-100.
+    None keeps the OpenCV default
+  """
+  if quality is None:
+    return []
+  ext = os.path.splitext(filename)[1].lower()
+  if ext in ('', '.png'):
+    return [cv2.IMWRITE_PNG_COMPRESSION, int(quality)]
+  elif ext in ('.jpg', '.jpeg'):
+    return [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+  elif ext == '.webp':
+    return [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+  return []
+
+@instrument.timed('save')
+def write_image(filename, img, params=()):
+  """ Encode a BGR or BGRA image by the extension of filename and write it.
+  Filenames without an extension are written as PNG
+
+  :returns: number of bytes written
+  """
+  ext = os.path.splitext(filename)[1] or '.png'
+  ok, data = cv2.imencode(ext, img, list(params))
+  if not ok:
+    raise IOError('Could not encode ' + filename)
+  with open(filename, 'wb') as f:
+    f.write(data)
+  instrument.count('saved_images')
+  instrument.count('saved_bytes', data.size)
+  return data.size
+
+class ImageSaver(object):
+  """ Writes images on a pool of background threads, so encoding overlaps with
+  rendering. cv2 releases the GIL while it encodes """
+  def __init__(self, workers=DEFAULT_SAVE_WORKERS, max_pending=None):
+    """
+    :param workers: number of writer threads. 0 writes on the calling thread
+    :param max_pending: maximum number of queued images, which caps memory.
+      Defaults to twice the number of workers
+    """
+    self.executor = futures.ThreadPoolExecutor(workers) if workers > 0 else None
+    self.max_pending = max_pending or 2 * workers
+    self.pending = collections.deque()
+    self.count = 0
+    self.nbytes = 0
+    self.started = None
+
+  def save(self, filename, img, params=()):
+    if self.started is None:
+      self.started = time.perf_counter()
+    if self.executor is None:
+      self.done(write_image(filename, img, params))
+      return
+
+    # Time blocked on a full queue, when saving is the bottleneck
+    with instrument.stage('save_wait'):
+      while len(self.pending) >= self.max_pending:
+        self.done(self.pending.popleft().result())
+    # Copy, as the caller may reuse its buffer before the image is written
+    self.pending.append(self.executor.submit(write_image, filename,
+                                             np.array(img, order='C'), params))
+
+  def done(self, nbytes):
+    self.count += 1
+    self.nbytes += nbytes
+
+  def end(self):
+    """ Wait for all queued images
+
+    :returns: (number of images, bytes, seconds since the first save)
+    """
+    try:
+      while self.pending:
+        self.done(self.pending.popleft().result())
+    finally:
+      for future in self.pending:
+        future.cancel()
+      if self.executor is not None:
+        self.executor.shutdown()
+    seconds = 0 if self.started is None else time.perf_counter() - self.started
+    return self.count, self.nbytes, seconds
+
 class Plotter(object):
-  def __init__(self, plot=True, rows=0, cols=0, num_images=0, out_folder=None, out_filename=None):
+  def __init__(self, plot=True, rows=0, cols=0, num_images=0, out_folder=None, out_filename=None,
+               image_format='png', quality=None, save_workers=DEFAULT_SAVE_WORKERS):
+    """
+    :param out_folder: folder to save frames to, numbered in save order
+    :param out_filename: filepath to save a single image to
+    :param image_format: one of (png|jpg|webp) for the frames of out_folder
+    :param quality: PNG compression level 0-9, or JPEG and WebP quality 0-100
+    :param save_workers: number of threads that encode and write images.
+      0 saves on the calling thread
+    """
+    if image_format not in IMAGE_FORMATS:
+      raise ValueError('Unknown image format %s. Must be one of %s' % (image_format, IMAGE_FORMATS))
     self.save_counter = 1
     self.plot_counter = 1
     self.do_plot = plot
     self.do_save = out_filename is not None
     self.out_filename = out_filename
+    self.out_folder = out_folder
+    self.image_format = image_format
+    self.quality = quality
+    self.filenames = []
     self.set_filepath(out_folder)
+    self.saver = ImageSaver(save_workers) if self.do_save else None
 
     if (rows + cols) == 0 and num_images > 0:
       # Auto-calculate the number of rows and cols for the figure
@@ -52,22 +159,37 @@ class Plotter(object):
 
     if not os.path.exists(folder):
       os.makedirs(folder)
-    self.filepath = os.path.join(folder, 'frame{0:03d}.png')
+    self.filepath = os.path.join(folder, 'frame{0:03d}.' + self.image_format)
     self.do_save = True
 
   @check_do_save
   def save(self, img, filename=None):
+    """ Queue a BGR or BGRA image to be saved. Call :meth:`end` to wait for it """
     if self.filepath:
       filename = self.filepath.format(self.save_counter)
       self.save_counter += 1
-    elif filename is None:
-      filename = self.out_filename
+    else:
+      filename = filename or self.out_filename
+      self.filenames.append(filename)
 
-    mpimg.imsave(filename, bgr2rgb(img))
-    print(filename + ' saved')
+    self.saver.save(filename, img, imwrite_params(filename, self.quality))
+
+  @check_do_save
+  def end(self):
+    """ Wait for all saved images to be written and print the throughput """
+    count, nbytes, seconds = self.saver.end()
+    if self.filepath:
+      print('{} frames saved to {} in {:.2f} s ({:.1f} frames/s, {:.1f} MB/s)'.format(
+        count, self.out_folder, seconds, count / seconds if seconds else 0,
+        nbytes / 1e6 / seconds if seconds else 0))
+    else:
+      for filename in self.filenames:
+        print(filename + ' saved')
+      self.filenames = []
 
   @check_do_plot
   def plot_one(self, img):
+    import matplotlib.pyplot as plt
     p = plt.subplot(self.rows, self.cols, self.plot_counter)
     p.axes.get_xaxis().set_visible(False)
     p.axes.get_yaxis().set_visible(False)
@@ -76,6 +198,7 @@ class Plotter(object):
 
   @check_do_plot
   def show(self):
+    import matplotlib.pyplot as plt
     plt.gcf().subplots_adjust(hspace=0.05, wspace=0,
                               left=0, bottom=0, right=1, top=0.98)
     plt.axis('off')
@@ -85,6 +208,7 @@ class Plotter(object):
   @check_do_plot
   def plot_mesh(self, points, tri, color='k'):
     """ plot triangles """
+    import matplotlib.pyplot as plt
     for tri_indices in tri.simplices:
       t_ext = [tri_indices[0], tri_indices[1], tri_indices[2], tri_indices[0]]
       plt.plot(points[t_ext, 0], points[t_ext, 1], color)
@@ -0,0 +1,276 @@
+"""
+::
+
+  Running average of faces, kept in a state file so images can be added
+  and removed without averaging every image again
+
+  Usage:
+    running.py add --state=<filename> --images=<folder>
+              [--width=<width>] [--height=<height>] [--tolerance=<pixels>]
+              [--workers=<num>] [--cache=<filename>]
+    running.py remove --state=<filename> --images=<folder>
+              [--tolerance=<pixels>] [--workers=<num>] [--cache=<filename>]
+    running.py render --state=<filename> [--out=<filename>] [--blur]
+              [--background=(black|transparent|average|blur)]
+    running.py info --state=<filename>
+
+  Options:
+    -h, --help             Show this screen.
+    --state=<filename>     Average state file (.npz). Created by the first add
+    --images=<folder>      Folder to images (.jpg, .jpeg, .png)
+    --width=<width>        Width of the average of a new state [default: 500]
+    --height=<height>      Height of the average of a new state [default: 600]
+    --tolerance=<pixels>   Move the average face onto the mean face points once they drift this far [default: 2]
+    --workers=<num>        Number of processes to load images and find faces [default: 1]
+    --cache=<filename>     SQLite file to cache face points across runs
+    --out=<filename>       Filename to save the average face [default: result.png]
+    --blur                 Flag to blur edges of image [default: False]
+    --background=<bg>      Background of image to be one of (black|transparent|average|blur) [default: black]
+    --version              Show version.
+"""
+from docopt import docopt
+import os
+import numpy as np
+
+from facemorpher import aligner
+from facemorpher import loader
+from facemorpher import cache as cache_module
+from facemorpher import plotter
+from facemorpher.averager import Accumulator, compose_average, list_imgpaths
+
+STATE_VERSION = 2
+DEFAULT_TOLERANCE = 2.0
+
+class RunningAverage(object):
+  """ Average face that is updated in place as images are added or removed.
+
+  Faces are warped onto fixed reference points, so adding or removing an
+  image costs one warp. The mean face points are tracked separately, and
+  once they drift further than tolerance from the reference points, the
+  sum of faces is moved onto the new mean with one warp of the sum.
+
+  Sums are float64, so removing an image that was added after the last
+  move cancels its addition exactly. A move resamples the sum of faces,
+  so the average is then close to, but not the same as, a fresh average.
+  It also means an image added before the move can no longer be
+  subtracted exactly. Removing one reads the remaining images again and
+  warps them onto the mean face points, which gives an exact average again.
+  """
+  def __init__(self, size, tolerance=DEFAULT_TOLERANCE):
+    """
+    :param size: (height, width) of the average
+    :param tolerance: largest drift in pixels of a mean face point from
+      its reference point before the faces are moved onto the mean
+    """
+    self.size = tuple(size)
+    self.tolerance = tolerance
+    self.accumulator = None
+    self.points_sum = None
+    # Image path -> raw face points
+    self.entries = {}
+    # Number of times the sum of faces was moved, and image path -> number
+    # of moves before the image was added
+    self.generation = 0
+    self.generations = {}
+
+  @property
+  def count(self):
+    return len(self.entries)
+
+  def mean_points(self):
+    return self.points_sum / self.count
+
+  def drift(self):
+    """ Largest distance in pixels of a mean face point from its reference point """
+    if self.accumulator is None or self.count == 0:
+      return 0.0
+    offsets = self.mean_points() - self.accumulator.dest_points
+    return float(np.sqrt((offsets ** 2).sum(axis=1)).max())
+
+  def add(self, imgpaths, workers=1, cache=None):
+    """ Add the faces of images that are not in the average yet
+
+    :param imgpaths: array or generator of image paths
+    :param workers: number of processes that load images and locate face points
+    :param cache: landmark cache filepath or :class:`facemorpher.cache.LandmarkCache`
+    :returns: number of faces added
+    """
+    cache = cache_module.open_cache(cache)
+    new_paths = []
+    for path in imgpaths:
+      path = os.path.abspath(path)
+      if path in self.entries or path in new_paths:
+        print('Already averaged %s' % path)
+      else:
+        new_paths.append(path)
+
+    path_points = list(loader.iter_raw_points(new_paths, workers, cache))
+    if len(path_points) == 0:
+      return 0
+
+    # Settle the reference points before any pixels are warped onto them
+    aligned_sum = np.sum([aligner.align_points(points, self.size)
+                          for _, points in path_points], axis=0, dtype=np.float64)
+    if self.points_sum is None:
+      self.points_sum = aligned_sum
+    else:
+      self.points_sum += aligned_sum
+    for path, points in path_points:
+      self.entries[path] = points
+    if self.accumulator is None:
+      self.accumulator = Accumulator(np.int32(self.mean_points()), self.size,
+                                     np.float64, background=True)
+    else:
+      self.rebase_if_drifted()
+
+    for path, _ in path_points:
+      self.generations[path] = self.generation
+    for img, points in loader.iter_aligned(path_points, self.size, workers):
+      self.accumulator.add(img, points)
+    return len(path_points)
+
+  def remove(self, imgpaths, workers=1):
+    """ Remove the faces of images from the average. The images are read
+    again to subtract their pixels, so they must not have changed. If any of
+    them was added before the sum of faces was last moved, the remaining
+    images are read and warped again instead
+
+    :param imgpaths: array or generator of image paths
+    :param workers: number of processes that load images
+    :returns: number of faces removed
+    """
+    path_points = []
+    resampled = False
+    for path in imgpaths:
+      path = os.path.abspath(path)
+      if path in self.entries:
+        path_points.append((path, self.entries.pop(path)))
+        resampled |= self.generations.pop(path) < self.generation
+      else:
+        print('Not in the average %s' % path)
+    if len(path_points) == 0:
+      return 0
+
+    if self.count == 0:
+      self.accumulator = None
+      self.points_sum = None
+    elif resampled:
+      for _, points in path_points:
+        self.points_sum -= aligner.align_points(points, self.size)
+      self.rebuild(workers)
+      print('Warped the {} remaining images again'.format(self.count))
+    else:
+      for img, points in loader.iter_aligned(path_points, self.size, workers):
+        self.accumulator.remove(img, points)
+        self.points_sum -= points
+      self.rebase_if_drifted()
+    return len(path_points)
+
+  def rebase_if_drifted(self):
+    if self.drift() > self.tolerance:
+      self.accumulator.rebase(np.int32(self.mean_points()))
+      self.generation += 1
+
+  def rebuild(self, workers=1):
+    """ Warp every image of the average again onto the mean face points.
+    Reads every image, so they must not have changed """
+    self.accumulator = Accumulator(np.int32(self.mean_points()), self.size,
+                                   np.float64, background=True)
+    for img, points in loader.iter_aligned(list(self.entries.items()), self.size, workers):
+      self.accumulator.add(img, points)
+    self.generation += 1
+    for path in self.generations:
+      self.generations[path] = self.generation
+
+  def render(self, background='black', blur_edges=False):
+    """ Average face image, see :func:`facemorpher.averager.compose_average` """
+    if self.count == 0:
+      raise ValueError('The average has no images')
+    return compose_average(self.accumulator, None, background, blur_edges)
+
+  def save(self, filename):
+    """ Write the state to an .npz file. The file is replaced atomically """
+    arrays = {'version': STATE_VERSION, 'size': self.size,
+              'paths': np.array(list(self.entries), dtype=str)}
+    if self.count > 0:
+      arrays.update(
+        raw_points=np.array(list(self.entries.values())),
+        generations=np.array([self.generations[path] for path in self.entries]),
+        generation=self.generation,
+        points_sum=self.points_sum,
+        dest_points=self.accumulator.dest_points,
+        face_sum=self.accumulator.face_sum,
+        background_sum=self.accumulator.background_sum)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+      np.savez(f, **arrays)
+    os.replace(tmp_filename, filename)
+
+  @classmethod
+  def load(cls, filename, tolerance=DEFAULT_TOLERANCE):
+    """ Read a state written by :meth:`save` """
+    with np.load(filename) as arrays:
+      version = int(arrays['version'])
+      if version not in (1, STATE_VERSION):
+        raise ValueError('Unsupported average state version %d in %s' % (
+          arrays['version'], filename))
+      average = cls(tuple(int(side) for side in arrays['size']), tolerance)
+      paths = list(arrays['paths'])
+      if len(paths) > 0:
+        average.entries = dict(zip(paths, arrays['raw_points']))
+        if version == 1:
+          # Moves were not recorded, so assume every image was resampled
+          average.generation = 1
+          average.generations = dict.fromkeys(paths, 0)
+        else:
+          average.generation = int(arrays['generation'])
+          average.generations = dict(zip(paths, arrays['generations'].tolist()))
+        average.points_sum = arrays['points_sum']
+        average.accumulator = Accumulator(arrays['dest_points'], average.size,
+                                          np.float64, background=True)
+        average.accumulator.face_sum = arrays['face_sum']
+        average.accumulator.background_sum = arrays['background_sum']
+        average.accumulator.count = average.accumulator.weight = len(paths)
+    return average
+
+  def info(self):
+    return {'images': self.count, 'size': '%dx%d' % self.size[::-1],
+            'drift_pixels': round(self.drift(), 2)}
+
+def open_state(filename, size=(600, 500), tolerance=DEFAULT_TOLERANCE):
+  """ Load a state file, or start an empty average of size if it does not exist """
+  if os.path.exists(filename):
+    return RunningAverage.load(filename, tolerance)
+  return RunningAverage(size, tolerance)
+
+def main():
+  args = docopt(__doc__, version='Face Running Average 1.0')
+  filename = args['--state']
+  tolerance = float(args['--tolerance'])
+
+  if args['add']:
+    average = open_state(filename, (int(args['--height']), int(args['--width'])), tolerance)
+    num_added = average.add(list_imgpaths(args['--images']), int(args['--workers']),
+                            args['--cache'])
+    average.save(filename)
+    print('Added {} images'.format(num_added))
+  elif args['remove']:
+    average = RunningAverage.load(filename, tolerance)
+    num_removed = average.remove(list_imgpaths(args['--images']), int(args['--workers']))
+    average.save(filename)
+    print('Removed {} images'.format(num_removed))
+  elif args['render']:
+    average = RunningAverage.load(filename)
+    plt = plotter.Plotter(False, out_filename=args['--out'], save_workers=0)
+    plt.save(average.render(args['--background'], args['--blur']))
+    plt.end()
+  else:
+    average = RunningAverage.load(filename)
+
+  for name, value in sorted(average.info().items()):
+    print('{}: {}'.format(name, value))
+
+
+if __name__ == "__main__":
+  main()
@@ -2,9 +2,23 @@
 Create a video with image frames
 """
 
+import queue
+import shutil
+import struct
+import subprocess
+import threading
 import cv2
 import numpy as np
 
+from facemorpher import instrument
+
+CODECS = ('mjpg', 'h264', 'y4m')
+# JPEG quality of mjpg frames. Close to the size and quality of cv2.VideoWriter's
+MJPEG_QUALITY = 75
+# Largest file the 32-bit sizes and offsets of an AVI 1.0 index address safely
+AVI_MAX_BYTES = 1 << 30
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
 
 def check_write_video(func):
   def inner(self, *args, **kwargs):
@@ -15,22 +29,182 @@ def check_write_video(func):
   return inner
 
 
-class Video(object):
+class MjpegWriter(object):
+  """ Motion JPEG in an AVI file. Frames are JPEG encoded with cv2.imencode,
+  and a repeated frame is encoded once and its bytes are written again.
+  The index of AVI 1.0 limits the file to AVI_MAX_BYTES
+  """
+  def __init__(self, filename, fps, w, h, quality=MJPEG_QUALITY):
+    self.file = open(filename, 'wb')
+    self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    self.size = (w, h)
+    self.fps = fps
+    # (offset from the movi list type, size) of every frame
+    self.index = []
+    self.max_frame_size = 0
+    self.write_headers()
+    self.movi_start = self.file.tell() - 4
+
+  def write_headers(self):
+    w, h = self.size
+    if self.fps == int(self.fps):
+      scale, rate = 1, int(self.fps)
+    else:
+      scale, rate = 1000, int(round(self.fps * 1000))
+    avih = struct.pack('<14I', int(round(1e6 * scale / rate)), 0, 0, AVIF_HASINDEX,
+                       len(self.index), 0, 1, self.max_frame_size, w, h, 0, 0, 0, 0)
+    strh = struct.pack('<4s4sIHHIIIIIIIIhhhh', b'vids', b'MJPG', 0, 0, 0, 0, scale, rate,
+                       0, len(self.index), self.max_frame_size, 0xFFFFFFFF, 0, 0, 0, w, h)
+    strf = struct.pack('<IiiHH4sIiiII', 40, w, h, 1, 24, b'MJPG', w * h * 3, 0, 0, 0, 0)
+    strl = riff_list(b'strl', riff_chunk(b'strh', strh) + riff_chunk(b'strf', strf))
+    hdrl = riff_list(b'hdrl', riff_chunk(b'avih', avih) + strl)
+    self.file.seek(0)
+    self.file.write(b'RIFF' + struct.pack('<I', 0) + b'AVI ' + hdrl)
+    self.file.write(b'LIST' + struct.pack('<I', 0) + b'movi')
+
+  def write(self, img, num_times=1):
+    success, data = cv2.imencode('.jpg', img, self.params)
+    if not success:
+      raise RuntimeError('Could not encode a video frame')
+    chunk = riff_chunk(b'00dc', data.tobytes())
+    if self.file.tell() + num_times * len(chunk) > AVI_MAX_BYTES:
+      raise RuntimeError('mjpg video is larger than %d bytes. Use the h264 codec' % AVI_MAX_BYTES)
+    self.max_frame_size = max(self.max_frame_size, len(data))
+    for i in range(num_times):
+      self.index.append((self.file.tell() - self.movi_start, len(data)))
+      self.file.write(chunk)
+
+  def release(self):
+    movi_end = self.file.tell()
+    self.file.write(riff_chunk(b'idx1', b''.join(
+      struct.pack('<4sIII', b'00dc', AVIIF_KEYFRAME, offset, size)
+      for offset, size in self.index)))
+    riff_end = self.file.tell()
+    # Fill in the frame counts and sizes now that they are known
+    self.write_headers()
+    self.file.seek(4)
+    self.file.write(struct.pack('<I', riff_end - 8))
+    self.file.seek(self.movi_start - 4)
+    self.file.write(struct.pack('<I', movi_end - self.movi_start))
+    self.file.close()
+
+
+def riff_chunk(fourcc, data):
+  """ RIFF chunk of data, padded to an even size """
+  return fourcc + struct.pack('<I', len(data)) + data + b'\0' * (len(data) % 2)
+
+def riff_list(list_type, data):
+  return b'LIST' + struct.pack('<I', len(data) + 4) + list_type + data
+
+
+class FfmpegWriter(object):
+  """ H.264 through a local ffmpeg process fed with raw BGR frames """
   def __init__(self, filename, fps, w, h):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+      raise RuntimeError('ffmpeg executable not found. Install ffmpeg for the h264 codec')
+    self.process = subprocess.Popen(
+      [ffmpeg, '-y', '-loglevel', 'error',
+       '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % (w, h), '-r', str(fps),
+       '-i', '-', '-an', '-c:v', 'libx264', '-preset', 'veryfast',
+       '-pix_fmt', 'yuv420p', filename],
+      stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+  def write(self, img, num_times=1):
+    # Repeats reuse the same bytes and x264 codes them as skipped blocks
+    data = img.tobytes()
+    for i in range(num_times):
+      self.process.stdin.write(data)
+
+  def release(self):
+    self.process.stdin.close()
+    if self.process.wait() != 0:
+      raise RuntimeError('ffmpeg exited with code %d' % self.process.returncode)
+
+
+class Y4mWriter(object):
+  """ Uncompressed YUV4MPEG2 (4:2:0). Repeated frames are converted once """
+  def __init__(self, filename, fps, w, h):
+    if w % 2 or h % 2:
+      raise ValueError('y4m needs an even width and height, got %dx%d' % (w, h))
+    self.file = open(filename, 'wb')
+    self.file.write(('YUV4MPEG2 W%d H%d F%d:1 Ip A1:1 C420jpeg\n' % (w, h, fps)).encode())
+
+  def write(self, img, num_times=1):
+    data = b'FRAME\n' + cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420).tobytes()
+    for i in range(num_times):
+      self.file.write(data)
+
+  def release(self):
+    self.file.close()
+
+
+WRITERS = {'mjpg': MjpegWriter, 'h264': FfmpegWriter, 'y4m': Y4mWriter}
+
+
+class Video(object):
+  def __init__(self, filename, fps, w, h, codec='mjpg', queue_size=8):
+    """
+    :param filename: video filepath. No video is written if None
+    :param fps: frames per second
+    :param w: width of the frames
+    :param h: height of the frames
+    :param codec: one of (mjpg|h264|y4m). h264 needs ffmpeg on the PATH
+    :param queue_size: number of frames queued for a background writer thread,
+      so encoding overlaps with rendering. 0 encodes on the calling thread
+    """
     self.filename = filename
+    self.error = None
+    self.thread = None
 
     if filename is None:
       self.video = None
     else:
-      fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-      self.video = cv2.VideoWriter(filename, fourcc, fps, (w, h), True)
+      if codec not in WRITERS:
+        raise ValueError('Unknown video codec %s. Must be one of %s' % (codec, CODECS))
+      self.video = WRITERS[codec](filename, fps, w, h)
+      if queue_size > 0:
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run, name='video-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      if self.error is None:
+        try:
+          with instrument.stage('encode'):
+            self.video.write(*item)
+        except Exception as e:
+          # Keep draining the queue so write() never blocks on a dead writer
+          self.error = e
+
+  def check_error(self):
+    if self.error is not None:
+      raise self.error
 
   @check_write_video
   def write(self, img, num_times=1):
-    for i in range(num_times):
-      self.video.write(img[..., :3])
+    self.check_error()
+    img = img[..., :3]
+    if self.thread is None:
+      with instrument.stage('encode'):
+        self.video.write(np.ascontiguousarray(img), num_times)
+    else:
+      # Copy, as the caller may reuse its buffer before the frame is encoded
+      frame = np.array(img, order='C')
+      # Time blocked on a full queue, when encoding is the bottleneck
+      with instrument.stage('encode_wait'):
+        self.queue.put((frame, num_times))
 
   @check_write_video
   def end(self):
-    print(self.filename + ' saved')
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
     self.video.release()
+    self.check_error()
+    print(self.filename + ' saved')
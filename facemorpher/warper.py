@@ -1,6 +1,16 @@
+import cv2
 import numpy as np
 import scipy.spatial as spatial
 
+from facemorpher import instrument
+
+ENGINES = ('numpy', 'remap', 'affine_tiles', 'tiled')
+# Barycentric weights down to -EDGE_TOLERANCE still count as in the triangle
+EDGE_TOLERANCE = 1e-9
+DEFAULT_TILE_SIZE = 512
+# Most rows and columns of the images and maps that cv2.remap takes
+REMAP_MAX_SIDE = 32766
+
 def bilinear_interpolate(img, coords):
   """ Interpolates over every image channel
   http://en.wikipedia.org/wiki/Bilinear_interpolation
@@ -31,62 +41,557 @@ def grid_coordinates(points):
   :param points: points to generate grid coordinates
   :returns: array of (x, y) coordinates
   """
-  xmin = np.min(points[:, 0])
-  xmax = np.max(points[:, 0]) + 1
-  ymin = np.min(points[:, 1])
-  ymax = np.max(points[:, 1]) + 1
-  return np.asarray([(x, y) for y in range(ymin, ymax)
-                     for x in range(xmin, xmax)], np.uint32)
-
-def process_warp(src_img, result_img, tri_affines, dst_points, delaunay):
-  """
-  Warp each triangle from the src_image only within the
-  ROI of the destination image (points in dst_points).
-  """
-  roi_coords = grid_coordinates(dst_points)
-  # indices to vertices. -1 if pixel is not in any triangle
-  roi_tri_indices = delaunay.find_simplex(roi_coords)
+  xmin = int(np.min(points[:, 0]))
+  xmax = int(np.max(points[:, 0])) + 1
+  ymin = int(np.min(points[:, 1]))
+  ymax = int(np.max(points[:, 1])) + 1
+  ys, xs = np.mgrid[ymin:ymax, xmin:xmax]
+  return np.column_stack((xs.ravel(), ys.ravel())).astype(np.uint32)
 
-  for simplex_index in range(len(delaunay.simplices)):
-    coords = roi_coords[roi_tri_indices == simplex_index]
-    num_coords = len(coords)
-    out_coords = np.dot(tri_affines[simplex_index],
-                        np.vstack((coords.T, np.ones(num_coords))))
-    x, y = coords.T
-    result_img[y, x] = bilinear_interpolate(src_img, out_coords)
+def triangle_matrices(vertices, points):
+  """ 3 x 3 matrices [[x0, x1, x2], [y0, y1, y2], [1, 1, 1]] of every triangle
 
-  return None
+  :param vertices: *t* x 3 array of triplet indices to corners of triangle
+  :param points: array of [x, y] points
+  :returns: *t* x 3 x 3 array
+  """
+  tris = np.ones((len(vertices), 3, 3))
+  tris[:, :2, :] = np.transpose(np.asarray(points, np.float64)[vertices], (0, 2, 1))
+  return tris
 
 def triangular_affine_matrices(vertices, src_points, dest_points):
   """
   Calculate the affine transformation matrix for each
-  triangle (x,y) vertex from dest_points to src_points
+  triangle (x,y) vertex from dest_points to src_points,
+  solving all triangles in one batched call
 
   :param vertices: array of triplet indices to corners of triangle
   :param src_points: array of [x, y] points to landmarks for source image
   :param dest_points: array of [x, y] points to landmarks for destination image
-  :returns: 2 x 3 affine matrix transformation for a triangle
+  :returns: *t* x 2 x 3 array of affine matrix transformations, one per triangle
+  """
+  src_tris = triangle_matrices(vertices, src_points)
+  dst_tris = triangle_matrices(vertices, dest_points)
+  # mat = src_tri . inv(dst_tri)  <=>  dst_tri^T . mat^T = src_tri^T
+  mats = np.linalg.solve(np.transpose(dst_tris, (0, 2, 1)), np.transpose(src_tris, (0, 2, 1)))
+  return np.transpose(mats, (0, 2, 1))[:, :2, :]
+
+class TriangleRaster(object):
+  """ Labels pixels with the index of the triangle that contains them. Pixels
+  are the integer [x, y] coordinates, as in :func:`grid_coordinates`, so the
+  labels agree with scipy's find_simplex up to ties on shared edges.
+  """
+  def __init__(self, points, simplices):
+    """
+    :param points: *m* x 2 array of [x, y] points
+    :param simplices: *t* x 3 array of triplet indices to corners of triangle
+    """
+    self.inverses = np.linalg.inv(triangle_matrices(simplices, points))
+    corners = np.asarray(points, np.float64)[simplices]
+    # Pixel bounds of every triangle, the upper bound exclusive
+    self.lower = np.ceil(corners.min(axis=1) - EDGE_TOLERANCE).astype(int)
+    self.upper = np.floor(corners.max(axis=1) + EDGE_TOLERANCE).astype(int) + 1
+
+  def fill(self, labels, origin=(0, 0), triangles=None):
+    """ Write the triangle indices into labels. Pixels in no triangle keep their value.
+    Every row of a triangle is one span, found from the bounds that the three
+    barycentric weights put on x, so no per-pixel weights are computed.
+    Where triangles share an edge, the later one wins
+
+    :param labels: 2D int array, modified in place
+    :param origin: (x, y) coordinates of labels[0, 0]
+    :param triangles: optional ascending indices of the triangles to fill.
+      Defaults to all
+    """
+    rows, cols = labels.shape
+    lower = np.maximum(self.lower - origin, 0)
+    upper = np.minimum(self.upper - origin, (cols, rows))
+    index = np.arange(len(lower)) if triangles is None else np.asarray(triangles, np.intp)
+    index = index[(lower[index] < upper[index]).all(axis=1)]
+    heights = upper[index, 1] - lower[index, 1]
+
+    # Triangle and y of every row span
+    tri = np.repeat(index, heights)
+    ys = np.arange(heights.sum()) - np.repeat(np.cumsum(heights) - heights, heights)
+    ys += np.repeat(lower[index, 1], heights)
+    inverses = self.inverses[tri]
+
+    # Weight k is a_k * x + b_k * y + c_k >= -EDGE_TOLERANCE, a bound on x
+    # from below if a_k > 0 and from above if a_k < 0
+    slopes = inverses[:, :, 0]
+    rhs = -EDGE_TOLERANCE - inverses[:, :, 1] * (ys + origin[1])[:, np.newaxis] - inverses[:, :, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      bounds = rhs / slopes
+    start = np.where(slopes > 0, bounds, -np.inf).max(axis=1)
+    stop = np.where(slopes < 0, bounds, np.inf).min(axis=1)
+    stop[((slopes == 0) & (rhs > 0)).any(axis=1)] = -np.inf
+    x0 = np.maximum(np.ceil(start - origin[0]), np.repeat(lower[index, 0], heights))
+    x1 = np.minimum(np.floor(stop - origin[0]) + 1, np.repeat(upper[index, 0], heights))
+
+    widths = np.maximum(x1 - x0, 0).astype(np.intp)
+    flat = np.arange(widths.sum()) - np.repeat(np.cumsum(widths) - widths, widths)
+    flat += np.repeat(ys * cols + x0.astype(np.intp), widths)
+    labels.reshape(-1)[flat] = np.repeat(tri, widths)
+    return labels
+
+def signed_areas(points, simplices):
+  """ Twice the signed area of every triangle. The sign is its orientation """
+  tri = np.asarray(points, np.float64)[simplices]
+  return ((tri[:, 1, 0] - tri[:, 0, 0]) * (tri[:, 2, 1] - tri[:, 0, 1]) -
+          (tri[:, 2, 0] - tri[:, 0, 0]) * (tri[:, 1, 1] - tri[:, 0, 1]))
+
+class Topology(object):
+  """ Triangle list computed once, e.g. on an average shape, and reused to warp
+  every frame and image whose points have the same layout.
   """
-  ones = [1, 1, 1]
-  for tri_indices in vertices:
-    src_tri = np.vstack((src_points[tri_indices, :].T, ones))
-    dst_tri = np.vstack((dest_points[tri_indices, :].T, ones))
-    mat = np.dot(src_tri, np.linalg.inv(dst_tri))[:2, :]
-    yield mat
-
-def warp_image(src_img, src_points, dest_points, dest_shape, dtype=np.uint8):
+  @instrument.timed('triangulate')
+  def __init__(self, points):
+    """
+    :param points: *m* x 2 array of [x, y] points to triangulate
+    """
+    self.simplices = spatial.Delaunay(points).simplices
+    self.orientation = np.sign(signed_areas(points, self.simplices))
+
+  def is_valid(self, points):
+    """ True if no triangle is flipped or collapsed at these points and the
+    triangles still cover the convex hull of the points. Otherwise pixels
+    that a triangulation of the points would warp are left out
+    """
+    areas = signed_areas(points, self.simplices)
+    return bool(np.all(np.sign(areas) == self.orientation)) and self.covers_hull(points, areas)
+
+  def covers_hull(self, points, areas):
+    hull_area = cv2.contourArea(cv2.convexHull(np.asarray(points, np.float32)))
+    # Unflipped triangles cover the hull exactly when their areas add up to it
+    return abs(np.abs(areas).sum() / 2 - hull_area) <= 1e-6 * hull_area
+
+  def labels(self, points, shape):
+    """ Label the pixels of a shape with the fixed triangles, falling back per
+    triangle rather than per shape. Triangles that are flipped or collapsed
+    at these points are left out, and pixels of the convex hull that no kept
+    triangle covers take the triangle of a Delaunay triangulation of the
+    points that contains them. Its triangles follow the kept ones
+
+    :param points: *m* x 2 array of [x, y] points
+    :param shape: (height, width) of the labels
+    :returns: (simplices, raster, labels). labels is -1 outside every triangle
+      and raster is the :class:`TriangleRaster` of simplices
+    """
+    points = np.asarray(points)
+    labels = np.full(shape, -1, np.int32)
+    areas = signed_areas(points, self.simplices)
+    kept = np.sign(areas) == self.orientation
+    if kept.all() and self.covers_hull(points, areas):
+      raster = TriangleRaster(points, self.simplices)
+      return self.simplices, raster, raster.fill(labels)
+
+    delaunay = spatial.Delaunay(points)
+    simplices = np.vstack((self.simplices[kept], delaunay.simplices))
+    raster = TriangleRaster(points, simplices)
+    raster.fill(labels, triangles=np.arange(kept.sum()))
+
+    # Uncovered pixels in or next to the hull, where find_simplex decides
+    hull = np.zeros(shape, np.uint8)
+    polygon = np.int32(np.round(cv2.convexHull(np.asarray(points, np.float32))))
+    cv2.fillConvexPoly(hull, polygon, 1)
+    cv2.polylines(hull, [polygon], True, 1, thickness=3)
+    ys, xs = np.nonzero(hull & (labels < 0))
+    found = delaunay.find_simplex(np.column_stack((xs, ys)).astype(np.float64))
+    inside = found >= 0
+    labels[ys[inside], xs[inside]] = found[inside] + kept.sum()
+    return simplices, raster, labels
+
+class WarpPlan(object):
+  """ Per-pixel triangle and barycentric map of a destination shape.
+
+  Triangulates the destination points once and stores, for every pixel in
+  the ROI covered by a triangle, its triangle index and barycentric weights
+  in flat arrays. Warping any source image onto the same destination points
+  then only needs one gather of the source vertices and one interpolation.
+  """
+  @instrument.timed('triangulate')
+  def __init__(self, dest_points, dest_shape, topology=None):
+    """
+    :param dest_points: *m* x 2 array of [x, y] destination points
+    :param dest_shape: (height, width) of the destination image
+    :param topology: optional :class:`Topology` to reuse instead of
+      triangulating dest_points. Its flipped triangles and uncovered pixels
+      fall back to a triangulation of dest_points, see :meth:`Topology.labels`
+    """
+    self.dest_points = np.asarray(dest_points)
+    self.dest_shape = tuple(dest_shape[:2])
+    self._labels = None
+
+    if topology is not None:
+      self.rasterize(topology)
+    else:
+      self.triangulate()
+    self.vertices = self.simplices[self.tri_indices]
+
+  def triangulate(self):
+    delaunay = spatial.Delaunay(self.dest_points)
+    self.simplices = delaunay.simplices
+
+    roi_coords = grid_coordinates(self.dest_points)
+    # indices to vertices. -1 if pixel is not in any triangle
+    roi_tri_indices = delaunay.find_simplex(roi_coords)
+    inside = roi_tri_indices >= 0
+    coords = roi_coords[inside]
+    self.tri_indices = roi_tri_indices[inside]
+    self.xs, self.ys = coords.T
+
+    # Barycentric weights from scipy's per-simplex affine transforms
+    transform = delaunay.transform[self.tri_indices]
+    delta = coords - transform[:, 2]
+    bary = np.einsum('nij,nj->ni', transform[:, :2], delta)
+    self.weights = np.column_stack((bary, 1 - bary.sum(axis=1)))
+
+  def rasterize(self, topology):
+    """ Assign pixels to the fixed triangles of a topology, whose
+    :class:`TriangleRaster` inverses are also the barycentric transforms
+    """
+    self.simplices, raster, labels = topology.labels(self.dest_points, self.dest_shape)
+    self._labels = labels
+
+    self.ys, self.xs = np.nonzero(labels >= 0)
+    self.tri_indices = labels[self.ys, self.xs]
+    inverses = raster.inverses
+    coords = np.stack((self.xs, self.ys, np.ones(len(self.xs))), axis=1)
+    self.weights = np.einsum('nij,nj->ni', inverses[self.tri_indices], coords)
+
+  def source_coords(self, src_points):
+    """ Coordinates in the source image of every planned pixel
+
+    :param src_points: *m* x 2 array of [x, y] source points
+    :returns: 2 x *n* array. 1st row = xcoords, 2nd row = ycoords
+    """
+    src_points = np.asarray(src_points, np.float64)
+    tri_src = src_points[self.vertices]
+    return np.einsum('nk,nkj->jn', self.weights, tri_src)
+
+  def remap_coords(self, src_points):
+    """ Dense float32 maps for :func:`cv2.remap`. Pixels outside every
+    triangle map to (-1, -1) so they sample the constant black border.
+
+    :param src_points: *m* x 2 array of [x, y] source points
+    :returns: (map_x, map_y) arrays of shape dest_shape
+    """
+    map_x = np.full(self.dest_shape, -1, np.float32)
+    map_y = np.full(self.dest_shape, -1, np.float32)
+    map_x[self.ys, self.xs], map_y[self.ys, self.xs] = self.source_coords(src_points)
+    return map_x, map_y
+
+  def triangle_labels(self):
+    """ Image of triangle indices for every pixel, -1 if not in a triangle """
+    if self._labels is None:
+      self._labels = np.full(self.dest_shape, -1, np.int32)
+      self._labels[self.ys, self.xs] = self.tri_indices
+    return self._labels
+
+def tile_view(buf, rows, cols):
+  """ Contiguous rows x cols view at the start of a flat scratch buffer """
+  return buf[:rows * cols].reshape(rows, cols)
+
+class TiledWarpPlan(object):
+  """ Warp plan for large outputs that holds no per-pixel arrays of the whole
+  image. The destination ROI is walked in square tiles, and every tile is
+  labelled, mapped and sampled in preallocated float32 scratch buffers, so
+  the extra memory of a warp is bounded by the tile size.
+  """
+  @instrument.timed('triangulate')
+  def __init__(self, dest_points, dest_shape, topology=None, tile_size=DEFAULT_TILE_SIZE):
+    """
+    :param dest_points: *m* x 2 array of [x, y] destination points
+    :param dest_shape: (height, width) of the destination image
+    :param topology: optional :class:`Topology` to reuse. Tiles are labelled
+      one at a time, so it is ignored unless it is valid for the whole of
+      dest_points, see :meth:`Topology.is_valid`
+    :param tile_size: width and height of the tiles in pixels
+    """
+    self.dest_points = np.asarray(dest_points)
+    self.dest_shape = tuple(dest_shape[:2])
+    self.tile_size = tile_size
+
+    if topology is not None and topology.is_valid(self.dest_points):
+      self.simplices = topology.simplices
+    else:
+      self.simplices = spatial.Delaunay(self.dest_points).simplices
+    # Label of pixels that are in no triangle
+    self.outside = len(self.simplices)
+
+    self.raster = TriangleRaster(self.dest_points, self.simplices)
+    rows, cols = self.dest_shape
+    xmin, ymin = np.maximum(self.raster.lower.min(axis=0), 0)
+    xmax, ymax = np.minimum(self.raster.upper.max(axis=0), (cols, rows))
+    self.roi = (int(xmin), int(ymin), int(xmax), int(ymax))
+
+    num_pixels = tile_size * tile_size
+    self.labels = np.empty(num_pixels, np.int32)
+    self.map_x = np.empty(num_pixels, np.float32)
+    self.map_y = np.empty(num_pixels, np.float32)
+    self.scratch = np.empty(num_pixels, np.float32)
+    self.grid = np.arange(tile_size, dtype=np.float32)
+
+  def tiles(self):
+    """ (x, y, width, height) of every tile covering the ROI """
+    xmin, ymin, xmax, ymax = self.roi
+    for y in range(ymin, ymax, self.tile_size):
+      for x in range(xmin, xmax, self.tile_size):
+        yield x, y, min(self.tile_size, xmax - x), min(self.tile_size, ymax - y)
+
+  def tile_labels(self, x, y, w, h):
+    """ Triangle index of every pixel of a tile, :attr:`outside` if in none """
+    labels = tile_view(self.labels, h, w)
+    labels.fill(self.outside)
+    return self.raster.fill(labels, (x, y))
+
+  def tile_map(self, coefs, labels, buf):
+    """ One source coordinate of every tile pixel from per-label affine rows
+
+    :param coefs: (triangles + 1) x 3 float32 affine rows in tile coordinates
+    :param labels: tile labels from :meth:`tile_labels`
+    :param buf: flat float32 buffer to write the coordinates into
+    """
+    h, w = labels.shape
+    coords = tile_view(buf, h, w)
+    scratch = tile_view(self.scratch, h, w)
+    np.take(coefs[:, 0], labels, out=coords)
+    coords *= self.grid[:w]
+    np.take(coefs[:, 1], labels, out=scratch)
+    scratch *= self.grid[:h, np.newaxis]
+    coords += scratch
+    np.take(coefs[:, 2], labels, out=scratch)
+    coords += scratch
+    return coords
+
+class BatchWarpPlan(object):
+  """ Triangle labels of a stack of destination shapes that share one
+  :class:`Topology`, e.g. every frame of a morph between two faces. Warping
+  an image onto all of them builds the maps of the whole stack in array
+  operations and samples them with a few tall :func:`cv2.remap` calls.
+  """
+  @instrument.timed('triangulate')
+  def __init__(self, dest_points, dest_shape, topology):
+    """
+    :param dest_points: *k* x *m* x 2 stack of [x, y] destination points
+    :param dest_shape: (height, width) of every destination image
+    :param topology: :class:`Topology` of the destination shapes. Shapes fall
+      back per triangle, see :meth:`Topology.labels`
+    """
+    self.dest_points = np.asarray(dest_points)
+    self.dest_shape = tuple(dest_shape[:2])
+
+    num_shapes = len(self.dest_points)
+    # Triangles of every shape: the fixed ones it keeps and its fallback
+    self.simplices = []
+    self.labels = np.empty((num_shapes,) + self.dest_shape, np.int32)
+    for labels, points in zip(self.labels, self.dest_points):
+      simplices, _, labels[...] = topology.labels(points, self.dest_shape)
+      self.simplices.append(simplices)
+    # Label of pixels that are in no triangle
+    self.outside = max(len(simplices) for simplices in self.simplices)
+    self.labels[self.labels < 0] = self.outside
+    # Labels into the affines of all shapes, flattened
+    self.stack_labels = self.labels + (np.arange(num_shapes, dtype=np.int32) *
+                                       (self.outside + 1))[:, np.newaxis, np.newaxis]
+    self.inside = self.labels != self.outside
+
+  def remap_coords(self, src_points):
+    """ Stacked float32 maps for :func:`cv2.remap`. Pixels outside every
+    triangle map to (-1, -1) so they sample the constant black border.
+
+    :param src_points: *m* x 2 array of [x, y] source points
+    :returns: (map_x, map_y) arrays of shape (*k* x height, width)
+    """
+    num_shapes = len(self.dest_points)
+    affines = np.zeros((num_shapes, self.outside + 1, 2, 3))
+    for shape_affines, simplices, points in zip(affines, self.simplices, self.dest_points):
+      shape_affines[:len(simplices)] = triangular_affine_matrices(simplices, src_points, points)
+    affines[:, -1, :, 2] = -1
+    affines = affines.reshape(-1, 2, 3).astype(np.float32)
+
+    rows, cols = self.dest_shape
+    xs = np.arange(cols, dtype=np.float32)
+    ys = np.arange(rows, dtype=np.float32)[:, np.newaxis]
+    maps = []
+    for coefs in (affines[:, 0], affines[:, 1]):
+      coords = np.take(coefs[:, 0], self.stack_labels)
+      coords *= xs
+      scratch = np.take(coefs[:, 1], self.stack_labels)
+      scratch *= ys
+      coords += scratch
+      coords += np.take(coefs[:, 2], self.stack_labels)
+      maps.append(coords.reshape(num_shapes * rows, cols))
+    return maps
+
+@instrument.timed('warp')
+def warp_numpy(src_img, src_points, plan, result_img):
+  out_coords = plan.source_coords(src_points)
+  height, width = src_img.shape[:2]
+  inside = ((out_coords[0] >= 0) & (out_coords[0] < width - 1) &
+            (out_coords[1] >= 0) & (out_coords[1] < height - 1))
+  if inside.all():
+    result_img[plan.ys, plan.xs] = bilinear_interpolate(src_img, out_coords)
+  else:
+    # Pixels sampled from outside the source image stay black
+    result_img[plan.ys[inside], plan.xs[inside]] = (
+      bilinear_interpolate(src_img, out_coords[:, inside]))
+
+@instrument.timed('warp')
+def warp_remap(src_img, src_points, plan, result_img):
+  map_x, map_y = plan.remap_coords(src_points)
+  if result_img.dtype != np.uint8:
+    src_img = src_img.astype(np.float32)
+  warped = cv2.remap(src_img, map_x, map_y, cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+  result_img[plan.ys, plan.xs] = warped[plan.ys, plan.xs]
+
+@instrument.timed('warp')
+def warp_affine_tiles(src_img, src_points, plan, result_img):
+  if result_img.dtype != np.uint8:
+    src_img = src_img.astype(np.float32)
+  labels = plan.triangle_labels()
+  tri_affines = triangular_affine_matrices(plan.simplices, src_points, plan.dest_points)
+  for simplex_index, mat in enumerate(tri_affines):
+    dst_tri = plan.dest_points[plan.simplices[simplex_index]]
+    x, y, w, h = cv2.boundingRect(np.array([dst_tri], np.int32))
+    # Shift the dest -> src affine to the origin of the bounding box
+    tile_mat = np.copy(mat)
+    tile_mat[:, 2] += np.dot(mat[:, :2], (x, y))
+    tile = cv2.warpAffine(src_img, tile_mat, (w, h),
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    tri_mask = labels[y:y+h, x:x+w] == simplex_index
+    result_img[y:y+h, x:x+w][tri_mask] = tile[:tri_mask.shape[0], :tri_mask.shape[1]][tri_mask]
+
+@instrument.timed('warp')
+def warp_tiled(src_img, src_points, plan, result_img, add=False, weight=1):
+  """ Warp tile by tile with a :class:`TiledWarpPlan`
+
+  :param add: add the warped pixels to result_img instead of writing them,
+    to accumulate a sum without a full size temporary image
+  :param weight: scale of the added pixels
+  """
+  affines = np.zeros((plan.outside + 1, 2, 3))
+  affines[:-1] = triangular_affine_matrices(plan.simplices, src_points, plan.dest_points)
+  # Pixels in no triangle sample the black border
+  affines[-1, :, 2] = -1
+  height, width = src_img.shape[:2]
+  as_float = result_img.dtype != np.uint8
+
+  for x, y, w, h in plan.tiles():
+    labels = plan.tile_labels(x, y, w, h)
+    inside = labels != plan.outside
+    if not inside.any():
+      continue
+
+    # Move the affines to tile coordinates in float64 before the float32 maps
+    tile_affines = np.copy(affines)
+    tile_affines[:, :, 2] += np.dot(affines[:, :, :2], (x, y))
+    tile_affines = tile_affines.astype(np.float32)
+    map_x = plan.tile_map(tile_affines[:, 0], labels, plan.map_x)
+    map_y = plan.tile_map(tile_affines[:, 1], labels, plan.map_y)
+
+    # Only read the source region this tile samples
+    x0 = max(int(map_x[inside].min()), 0)
+    y0 = max(int(map_y[inside].min()), 0)
+    x1 = min(int(map_x[inside].max()) + 2, width)
+    y1 = min(int(map_y[inside].max()) + 2, height)
+    if x0 >= x1 or y0 >= y1:
+      continue
+    src_tile = src_img[y0:y1, x0:x1]
+    if as_float:
+      src_tile = src_tile.astype(np.float32)
+    map_x -= x0
+    map_y -= y0
+    warped = cv2.remap(src_tile, map_x, map_y, cv2.INTER_LINEAR,
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    result_tile = result_img[y:y+h, x:x+w]
+    if add:
+      if weight != 1:
+        warped *= weight
+      np.add(result_tile, warped, out=result_tile, where=inside[..., np.newaxis])
+    else:
+      np.copyto(result_tile, warped, where=inside[..., np.newaxis])
+
+@instrument.timed('warp')
+def warp_batch(src_img, src_points, plan):
+  """ Warp the source image onto every destination shape of a :class:`BatchWarpPlan`
+
+  :param src_img: source image
+  :param src_points: *m* x 2 array of [x, y] source points
+  :returns: *k* x height x width x 3 stack of warped images
+  """
+  src_img = src_img[:, :, :3]
+  rows, cols = plan.dest_shape
+  map_x, map_y = plan.remap_coords(src_points)
+  result = np.empty((len(plan.dest_points) * rows, cols, 3), src_img.dtype)
+  # Remap the stack in as few calls as cv2 allows
+  step = max(REMAP_MAX_SIDE // rows, 1) * rows
+  for start in range(0, len(result), step):
+    cv2.remap(src_img, map_x[start:start+step], map_y[start:start+step],
+              cv2.INTER_LINEAR, dst=result[start:start+step],
+              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+  return result.reshape((-1, rows, cols, 3))
+
+def warp_image(src_img, src_points, dest_points, dest_shape, dtype=np.uint8,
+               plan=None, engine='numpy', out=None, topology=None,
+               tile_size=DEFAULT_TILE_SIZE):
+  """ Warp the source image so its face points land on dest_points
+
+  :param src_img: source image
+  :param src_points: *m* x 2 array of [x, y] source points
+  :param dest_points: *m* x 2 array of [x, y] destination points
+  :param dest_shape: (height, width) of the destination image
+  :param dtype: dtype of the resultant image
+  :param plan: optional :class:`WarpPlan` built from dest_points and
+    dest_shape, or :class:`TiledWarpPlan` for the tiled engine. Reuse one
+    plan to warp several images onto the same points. A plan of the other
+    type raises ValueError
+  :param engine: one of (numpy|remap|affine_tiles|tiled). *numpy* interpolates
+    with :func:`bilinear_interpolate`, *remap* builds dense maps for
+    :func:`cv2.remap`, *affine_tiles* runs :func:`cv2.warpAffine` on
+    the bounding box of each triangle and *tiled* remaps square tiles of
+    the output in bounded memory, for high resolution outputs
+  :param out: optional preallocated (height, width, 3) result image of dtype.
+    It is cleared and written in place
+  :param topology: optional :class:`Topology` used when no plan is supplied
+  :param tile_size: tile width and height of the tiled engine when no plan is supplied
+  :returns: warped image with 3 channels
+  """
+  if engine not in ENGINES:
+    raise ValueError('Unknown warp engine %s. Must be one of %s' % (engine, ENGINES))
+
   # Resultant image will not have an alpha channel
   num_chans = 3
   src_img = src_img[:, :, :3]
 
   rows, cols = dest_shape[:2]
-  result_img = np.zeros((rows, cols, num_chans), dtype)
+  if out is None:
+    result_img = np.zeros((rows, cols, num_chans), dtype)
+  else:
+    result_img = out
+    result_img.fill(0)
 
-  delaunay = spatial.Delaunay(dest_points)
-  tri_affines = np.asarray(list(triangular_affine_matrices(
-    delaunay.simplices, src_points, dest_points)))
+  plan_type = TiledWarpPlan if engine == 'tiled' else WarpPlan
+  if plan is None:
+    if engine == 'tiled':
+      plan = TiledWarpPlan(dest_points, dest_shape, topology, tile_size)
+    else:
+      plan = WarpPlan(dest_points, dest_shape, topology)
+  elif not isinstance(plan, plan_type):
+    raise ValueError('The %s engine needs a %s, not a %s' % (
+      engine, plan_type.__name__, type(plan).__name__))
 
-  process_warp(src_img, result_img, tri_affines, dest_points, delaunay)
+  if engine == 'tiled':
+    warp_tiled(src_img, src_points, plan, result_img)
+  elif engine == 'remap':
+    warp_remap(src_img, src_points, plan, result_img)
+  elif engine == 'affine_tiles':
+    warp_affine_tiles(src_img, src_points, plan, result_img)
+  else:
+    warp_numpy(src_img, src_points, plan, result_img)
 
   return result_img
 
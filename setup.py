@@ -22,7 +22,11 @@ setup(
   ],
   entry_points={'console_scripts': [
       'facemorpher=facemorpher.morpher:main',
-      'faceaverager=facemorpher.averager:main'
+      'faceaverager=facemorpher.averager:main',
+      'facecache=facemorpher.cache:main',
+      'facerunning=facemorpher.running:main',
+      'facemapreduce=facemorpher.mapreduce:main',
+      'facecorpus=facemorpher.corpus:main'
     ]
   },
   data_files=[('readme', ['README.rst'])],
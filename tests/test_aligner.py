@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+import pytest
+
+from facemorpher import aligner
+from facemorpher import warper
+
+SIZE = (300, 250)
+
+def smooth_image(rng, shape, sigma=4):
+  """ Blurred noise stretched to the full intensity range, like a photo
+  without hard edges """
+  img = cv2.GaussianBlur(rng.integers(0, 256, shape + (3,), dtype=np.uint8), (0, 0), sigma)
+  return cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX)
+
+def face_points(rng, shape, face_width):
+  """ Random points in a face sized box, with its corners so the box is the hull """
+  height, width = shape
+  left, top = (width - face_width) // 2, (height - face_width) // 2
+  points = rng.integers(0, face_width, (40, 2)) + (left, top)
+  corners = np.array([[0, 0], [1, 0], [0, 1], [1, 1]]) * (face_width - 1) + (left, top)
+  return np.vstack([points, corners]).astype(np.int32)
+
+# Original image shapes and face widths that upscale, slightly downscale and
+# more than halve the image
+ALIGNMENTS = [((200, 180), 80), ((400, 360), 240), ((1000, 900), 600)]
+
+@pytest.mark.parametrize('shape, face_width', ALIGNMENTS)
+def test_fused_warp_matches_resize_align(shape, face_width):
+  rng = np.random.default_rng(face_width)
+  img = smooth_image(rng, shape)
+  points = face_points(rng, shape, face_width)
+  dest_points = aligner.align_points(face_points(rng, shape, face_width), SIZE)
+
+  crop, aligned_points = aligner.resize_align(img, points.copy(), SIZE)
+  expected = warper.warp_image(crop, aligned_points, dest_points, SIZE)
+  src_img, src_points, _ = aligner.fused_source(img, points, SIZE, antialias=False)
+  result = warper.warp_image(src_img, src_points, dest_points, SIZE)
+
+  # One interpolation instead of two, so detail differs where the two step
+  # path interpolates the resized image again: within 2 levels when
+  # upscaling, 6 when slightly downscaling and 14 when more than halving
+  # this image, with a mean under 1 level
+  diff = np.abs(result.astype(int) - expected)
+  assert diff.max() <= 16
+  assert diff.mean() <= 1
+
+@pytest.mark.parametrize('shape, face_width', ALIGNMENTS)
+def test_warp_align_matches_resize_align(shape, face_width):
+  rng = np.random.default_rng(face_width)
+  img = smooth_image(rng, shape)
+  points = face_points(rng, shape, face_width)
+
+  crop, _ = aligner.resize_align(img, points.copy(), SIZE)
+  src_img, _, matrix = aligner.fused_source(img, points, SIZE, antialias=False)
+  result = aligner.warp_align(src_img, matrix, SIZE)
+
+  # Both sample the same positions once, up to rounding
+  assert np.abs(result.astype(int) - crop).max() <= 1
+
+def test_antialiased_fused_source():
+  rng = np.random.default_rng(0)
+  shape, face_width = ALIGNMENTS[-1]
+  img = smooth_image(rng, shape)
+  points = face_points(rng, shape, face_width)
+
+  crop, _ = aligner.resize_align(img, points.copy(), SIZE)
+  src_img, _, matrix = aligner.fused_source(img, points, SIZE)
+  assert src_img.shape[0] < shape[0]
+  result = aligner.warp_align(src_img, matrix, SIZE)
+
+  # pyrDown filters out the detail that cv2.resize aliases
+  diff = np.abs(result.astype(int) - crop)
+  assert diff.mean() <= 2
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+import scipy.spatial as spatial
+
+from facemorpher import warper
+
+SIZE = (240, 200)
+
+def synthetic_points(rng, size, num_points=40):
+  """ Random landmarks inside the image plus its 4 corners """
+  height, width = size
+  points = np.column_stack((
+    rng.integers(width // 8, width - width // 8, num_points),
+    rng.integers(height // 8, height - height // 8, num_points)))
+  corners = [[1, 1], [width - 2, 1], [1, height - 2], [width - 2, height - 2]]
+  return np.vstack([points, corners]).astype(np.int32)
+
+def reference_warp(src_img, src_points, dest_points, size):
+  """ Pixel by pixel warp: the triangle of every pixel from find_simplex,
+  its source coordinates from the barycentric weights, then bilinear sampling """
+  delaunay = spatial.Delaunay(dest_points)
+  ys, xs = np.mgrid[0:size[0], 0:size[1]]
+  coords = np.column_stack((xs.ravel(), ys.ravel())).astype(np.float64)
+  simplex = delaunay.find_simplex(coords)
+  inside = simplex >= 0
+  coords, simplex = coords[inside], simplex[inside]
+
+  transform = delaunay.transform[simplex]
+  bary = np.einsum('nij,nj->ni', transform[:, :2], coords - transform[:, 2])
+  weights = np.column_stack((bary, 1 - bary.sum(axis=1)))
+  corners = np.asarray(src_points, np.float64)[delaunay.simplices[simplex]]
+  src_coords = np.einsum('ni,nij->nj', weights, corners)
+
+  result = np.zeros(size + (3,), np.float64)
+  x, y = coords.T.astype(int)
+  result[y, x] = warper.bilinear_interpolate(src_img.astype(np.float64), src_coords.T)
+  return result
+
+@pytest.fixture(scope='module')
+def warp_inputs():
+  rng = np.random.default_rng(0)
+  src_img = rng.integers(0, 256, SIZE + (3,), dtype=np.uint8)
+  # Smooth the noise so a one pixel offset is not a large difference
+  src_img = np.uint8(np.cumsum(np.cumsum(src_img, 0), 1) % 256)
+  return src_img, synthetic_points(rng, SIZE), synthetic_points(rng, SIZE)
+
+@pytest.mark.parametrize('engine', warper.ENGINES)
+@pytest.mark.parametrize('dtype', [np.uint8, np.float32])
+def test_engine_matches_reference(warp_inputs, engine, dtype):
+  src_img, src_points, dest_points = warp_inputs
+  expected = reference_warp(src_img, src_points, dest_points, SIZE)
+  result = warper.warp_image(src_img, src_points, dest_points, SIZE, dtype, engine=engine)
+  assert result.dtype == dtype
+  # uint8 engines truncate or round, so allow one intensity level
+  assert np.abs(result.astype(np.float64) - expected).max() <= 1
+
+def test_tiled_engine_small_tiles(warp_inputs):
+  src_img, src_points, dest_points = warp_inputs
+  expected = warper.warp_image(src_img, src_points, dest_points, SIZE, np.float32)
+  result = warper.warp_image(src_img, src_points, dest_points, SIZE, np.float32,
+                             engine='tiled', tile_size=37)
+  assert np.abs(result - expected).max() <= 1
+
+@pytest.mark.parametrize('plan_type, engine', [
+  (warper.WarpPlan, 'tiled'), (warper.TiledWarpPlan, 'remap')])
+def test_plan_must_match_engine(warp_inputs, plan_type, engine):
+  src_img, src_points, dest_points = warp_inputs
+  plan = plan_type(dest_points, SIZE)
+  with pytest.raises(ValueError):
+    warper.warp_image(src_img, src_points, dest_points, SIZE, plan=plan, engine=engine)
+
+@pytest.mark.parametrize('origin', [(0, 0), (37, 91)])
+def test_raster_matches_barycentric_test(warp_inputs, origin):
+  _, _, dest_points = warp_inputs
+  simplices = spatial.Delaunay(dest_points).simplices
+  raster = warper.TriangleRaster(dest_points, simplices)
+  labels = raster.fill(np.full(SIZE, -1, np.int32), origin)
+
+  ys, xs = np.mgrid[0:SIZE[0], 0:SIZE[1]]
+  coords = np.stack((xs + origin[0], ys + origin[1], np.ones(SIZE)), axis=-1)
+  weights = np.einsum('tij,yxj->yxti', raster.inverses, coords)
+  inside = (weights >= -warper.EDGE_TOLERANCE).all(axis=-1)
+  assert np.array_equal(labels >= 0, inside.any(axis=-1))
+  ys, xs = np.nonzero(labels >= 0)
+  assert inside[ys, xs, labels[ys, xs]].all()
+
+def test_topology_falls_back_per_triangle(warp_inputs):
+  _, src_points, dest_points = warp_inputs
+  # Triangles of other points, many of which flip at dest_points
+  topology = warper.Topology(src_points)
+  areas = warper.signed_areas(dest_points, topology.simplices)
+  assert (np.sign(areas) != topology.orientation).any()
+
+  plan = warper.WarpPlan(dest_points, SIZE, topology)
+  expected = warper.WarpPlan(dest_points, SIZE)
+  assert np.array_equal(plan.triangle_labels() >= 0, expected.triangle_labels() >= 0)
+  assert (plan.weights >= -1e-6).all()